@@ -0,0 +1,207 @@
+import numpy as np
+from game_info import DEFAULT_BUILDINGS, QUESTS
+from game import GameState
+from player import Player
+from batched_game import BatchedGameState, EMPTY, QUEST_BUILDING
+from featurize import (MAX_QUESTS, QUEST_SLOT_ACTIONS, BUILDING_ACTIONS, 
+                       COMPLETE_ACTIONS, NUM_ACTIONS)
+
+# Actions are indices into the action vector laid out in featurize.py.
+# A turn is made of one or two decisions by the current player:
+#   1. Place an agent, either at Cliffwatch Inn by choosing one of its 
+#      available quests (QUEST_SLOT_ACTIONS + slot), or at any other 
+#      building (BUILDING_ACTIONS + building index).
+#   2. If the player can then complete any of their active quests, 
+#      choose one to complete (COMPLETE_ACTIONS + active quest index).
+
+def canComplete(player: Player, slot: int) -> bool:
+    '''Return whether the player has enough resources to complete their slot-th active quest.'''
+    return player.canCompleteQuest(QUESTS[player.activeQuestIds[slot]])
+
+def legalActionMask(gameState: GameState, out: np.ndarray = None) -> np.ndarray:
+    '''
+    Return which actions the current player can legally take.
+
+    Args:
+        gameState: the game to find legal actions in.
+        out (optional): a (NUM_ACTIONS,) boolean buffer to write the mask to.
+
+    Returns:
+        the (NUM_ACTIONS,) boolean mask of legal actions, all 
+        False once the game is over.
+    '''
+    if out is None:
+        out = np.zeros(NUM_ACTIONS, dtype=bool)
+    else:
+        out[:] = False
+    player = gameState.players[0]
+    if gameState.isOver():
+        return out
+
+    if gameState.completingQuest:
+        for slot in range(min(len(player.activeQuestIds), MAX_QUESTS)):
+            out[COMPLETE_ACTIONS + slot] = canComplete(player, slot)
+        return out
+
+    if player.agents <= 0:
+        return out
+    for b, occupant in enumerate(gameState.boardState.occupancy):
+        if occupant == EMPTY:
+            if b == QUEST_BUILDING:
+                numQuests = len(gameState.boardState.availableQuestIds)
+                out[QUEST_SLOT_ACTIONS:QUEST_SLOT_ACTIONS + numQuests] = True
+            else:
+                out[BUILDING_ACTIONS + b] = True
+    return out
+
+def legalActions(gameState: GameState) -> list[int]:
+    '''Return the list of actions the current player can legally take.'''
+    return np.flatnonzero(legalActionMask(gameState)).tolist()
+
+def legalActionMasks(gameStates: list[GameState], out: np.ndarray):
+    '''
+    Write the legal action mask of each game into a preallocated buffer.
+
+    Args:
+        gameStates: the games to find legal actions in.
+        out: the (len(gameStates), NUM_ACTIONS) boolean buffer to write to.
+    '''
+    for gameState, row in zip(gameStates, out):
+        legalActionMask(gameState, row)
+
+def legalActionMaskBatch(batch: BatchedGameState, games: np.ndarray = None,
+                         out: np.ndarray = None) -> np.ndarray:
+    '''
+    Return which actions the current player of each game of a 
+    BatchedGameState can legally take, as in legalActionMask.
+
+    Args:
+        batch: the batched game states.
+        games (optional): the indices of the games. Defaults to all games.
+        out (optional): a (len(games), NUM_ACTIONS) boolean buffer to write to.
+
+    Returns:
+        the (len(games), NUM_ACTIONS) boolean masks of legal actions.
+    '''
+    if games is None:
+        games = np.arange(batch.numGames)
+    if out is None:
+        out = np.zeros((len(games), NUM_ACTIONS), dtype=bool)
+    players = batch.turnOrder[games, 0]
+    playing = ~batch.isOver()[games]
+    completing = batch.completingQuest[games] & playing
+    placing = ~batch.completingQuest[games] & playing & (batch.agents[games, players] > 0)
+
+    unoccupied = batch.buildingStates[games] == EMPTY
+    np.logical_and(unoccupied, placing[:, None], out=out[:, BUILDING_ACTIONS:COMPLETE_ACTIONS])
+    out[:, BUILDING_ACTIONS + QUEST_BUILDING] = False
+    np.logical_and(batch.availableQuests[games] != EMPTY, (unoccupied[:, QUEST_BUILDING] & placing)[:, None],
+                   out=out[:, QUEST_SLOT_ACTIONS:BUILDING_ACTIONS])
+    np.logical_and(batch.completableQuests(games, players)[:, :MAX_QUESTS], completing[:, None],
+                   out=out[:, COMPLETE_ACTIONS:])
+    return out
+
+def takeAction(gameState: GameState, action: int):
+    '''
+    Take one decision for the current player, ending their turn 
+    once it is complete. Raises a ValueError, without changing the 
+    game state, if the action is not legal or the game is over.
+
+    Args:
+        gameState: the game to take the action in.
+        action: the index of the action.
+    '''
+    if gameState.isOver():
+        raise ValueError("The game is over.")
+    player = gameState.players[0]
+    if gameState.completingQuest:
+        slot = action - COMPLETE_ACTIONS
+        if not (0 <= slot < min(len(player.activeQuestIds), MAX_QUESTS)):
+            raise ValueError("Must choose one of this player's active quests to complete.")
+        player.completeQuest(QUESTS[player.activeQuestIds[slot]])
+        gameState.completingQuest = False
+        gameState.endTurn()
+        return
+
+    if QUEST_SLOT_ACTIONS <= action < BUILDING_ACTIONS:
+        building = "Quest"
+        questSlot = action - QUEST_SLOT_ACTIONS
+        if questSlot >= len(gameState.boardState.availableQuestIds):
+            raise ValueError("No quest is available in this slot.")
+    elif BUILDING_ACTIONS <= action < COMPLETE_ACTIONS:
+        building = DEFAULT_BUILDINGS[action - BUILDING_ACTIONS]
+        questSlot = 0
+        if building == "Quest":
+            raise ValueError("Place at Cliffwatch Inn by choosing one of its quests.")
+    else:
+        raise ValueError("Must place an agent before completing a quest.")
+    gameState.placeAgent(building, questSlot)
+
+    if any(canComplete(player, slot) for slot in range(min(len(player.activeQuestIds), MAX_QUESTS))):
+        gameState.completingQuest = True
+    else:
+        gameState.endTurn()
+
+def takeActionBatch(batch: BatchedGameState, games: np.ndarray, actions: np.ndarray):
+    '''
+    Take one decision for the current player of each game of a 
+    BatchedGameState, as in takeAction. Raises a ValueError, without 
+    changing any game, if any action is not legal.
+
+    Args:
+        batch: the batched game states.
+        games: the indices of the games to take actions in (no repeats).
+        actions: the index of the action to take in each game.
+    '''
+    games = np.asarray(games)
+    actions = np.asarray(actions)
+    if not np.all(legalActionMaskBatch(batch, games)[np.arange(len(games)), actions]):
+        raise ValueError("Illegal action.")
+
+    completing = batch.completingQuest[games]
+    completers = games[completing]
+    batch.completeQuests(completers, actions[completing] - COMPLETE_ACTIONS)
+    batch.completingQuest[completers] = False
+
+    placers = games[~completing]
+    placements = actions[~completing]
+    atInn = placements < BUILDING_ACTIONS
+    batch.placeAgents(placers, np.where(atInn, QUEST_BUILDING, placements - BUILDING_ACTIONS),
+                      np.where(atInn, placements - QUEST_SLOT_ACTIONS, 0))
+
+    # Players who can now complete a quest do so before their turn ends
+    canComplete = np.any(batch.completableQuests(placers, batch.turnOrder[placers, 0])[:, :MAX_QUESTS], axis=1)
+    batch.completingQuest[placers[canComplete]] = True
+    batch.endTurns(np.concatenate([completers, placers[~canComplete]]))
+
+
+def main():
+    # Test that the legal action masks and the batched engine agree 
+    # with GameState over random games
+    import random
+    from batched_game import _assertMatches
+    random.seed(229)
+    gameStates = [GameState(numPlayers) for numPlayers in [2, 3, 4, 5] for _ in range(8)]
+    # Long games also exhaust the quest stack
+    gameStates += [GameState(numPlayers, numRounds=40) for numPlayers in [2, 3, 4, 5] for _ in range(4)]
+    for numPlayers in [2, 3, 4, 5]:
+        games = [gameState for gameState in gameStates if gameState.numPlayers == numPlayers]
+        batch = BatchedGameState.fromGameStates(games)
+        while not all(gameState.isOver() for gameState in games):
+            masks = np.zeros((len(games), NUM_ACTIONS), dtype=bool)
+            legalActionMasks(games, masks)
+            assert np.array_equal(masks, legalActionMaskBatch(batch))
+            playing = [g for g, gameState in enumerate(games) if not gameState.isOver()]
+            actions = [random.choice(legalActions(games[g])) for g in playing]
+            for g, action in zip(playing, actions):
+                takeAction(games[g], action)
+            takeActionBatch(batch, np.array(playing), np.array(actions))
+            _assertMatches(batch, games)
+    print("Legal actions and takeActionBatch match GameState.")
+
+    # No action can be taken once a game is over
+    try:
+        takeAction(gameStates[0], int(BUILDING_ACTIONS))
+        raise AssertionError("An action was taken in a finished game.")
+    except ValueError:
+        pass
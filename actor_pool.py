@@ -0,0 +1,386 @@
+from multiprocessing import shared_memory
+import random
+import time
+import numpy as np
+import torch
+from q_network import Q_network, ReplayBuffer, PrioritizedReplayBuffer
+from game import GameState
+from game_info import LORD_CARDS
+from featurize import LiveFeatures, stateFeatureLen, rotatePlayers, NUM_ACTIONS
+from actions import takeAction, legalActionMask
+from trajectory import Trajectory, NUM_ROUNDS
+from launcher import worker_context, NETWORK_MODULES
+
+
+class SharedRingBuffer:
+    """Single-producer, single-consumer ring buffer of transitions in shared memory.
+
+    An actor process pushes transitions and the learner drains them, without pickling.
+    Both sides count rows with ever-increasing counters, so the buffer holds
+    rows written - read, starting at row read % capacity.
+    """
+
+    def __init__(self, capacity, state_size, num_players, name=None):
+        """Create a SharedRingBuffer, or attach to an existing one by name.
+
+        Params
+        ======
+            capacity (int): maximum number of transitions in the buffer
+            state_size (int): size of each featurized state
+            num_players (int): number of players of the games, whose lord cards are stored
+            name (str): name of the shared memory block to attach to, or None to create one
+        """
+        self.capacity = capacity
+        self.state_size = state_size
+        self.num_players = num_players
+        fields = [
+            ("counters", np.int64, (2,)), # rows written, rows read
+            ("states", np.float32, (capacity, state_size)),
+            ("next_states", np.float32, (capacity, state_size)),
+            ("actions", np.int64, (capacity,)),
+            ("rewards", np.float32, (capacity,)),
+            ("dones", np.float32, (capacity,)),
+            ("next_masks", np.bool_, (capacity, NUM_ACTIONS)),
+            ("lords", np.uint8, (capacity, num_players)),
+        ]
+        size = sum(np.dtype(dtype).itemsize * int(np.prod(shape)) for _, dtype, shape in fields)
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+        offset = 0
+        for field, dtype, shape in fields:
+            array = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset)
+            setattr(self, field, array)
+            offset += array.nbytes
+        if name is None:
+            self.counters[:] = 0
+
+    def __reduce__(self):
+        # Child processes attach to the same shared memory block
+        return (SharedRingBuffer, (self.capacity, self.state_size, self.num_players, self.shm.name))
+
+    def __len__(self):
+        return int(self.counters[0] - self.counters[1])
+
+    def push(self, states, actions, rewards, next_states, dones, next_masks, lords, stop_event=None):
+        """Write transitions, waiting for the learner to make room if the buffer is full.
+
+        Returns False if stop_event was set while waiting.
+        """
+        for start in range(0, len(states), self.capacity):
+            end = min(start + self.capacity, len(states))
+            while self.capacity - len(self) < end - start:
+                if stop_event is not None and stop_event.is_set():
+                    return False
+                time.sleep(0.001)
+            rows = (self.counters[0] + np.arange(end - start)) % self.capacity
+            self.states[rows] = states[start:end]
+            self.actions[rows] = actions[start:end]
+            self.rewards[rows] = rewards[start:end]
+            self.next_states[rows] = next_states[start:end]
+            self.dones[rows] = dones[start:end]
+            self.next_masks[rows] = next_masks[start:end]
+            self.lords[rows] = lords[start:end]
+            # Publish the rows only once they are fully written
+            self.counters[0] += end - start
+        return True
+
+    def drain_into(self, memory):
+        """Move all transitions currently in the buffer into a ReplayBuffer (with their lord cards if it
+        stores them). Returns how many were moved."""
+        written, read = int(self.counters[0]), int(self.counters[1])
+        if written == read:
+            return 0
+        first = read % self.capacity
+        # At most two contiguous segments, split where the ring wraps
+        for start, end in [(first, min(first + written - read, self.capacity)),
+                           (0, max(first + written - read - self.capacity, 0))]:
+            if end > start:
+                memory.add_batch(self.states[start:end], self.actions[start:end], self.rewards[start:end],
+                                 self.next_states[start:end], self.dones[start:end], self.next_masks[start:end],
+                                 None if memory.lords is None else self.lords[start:end])
+        self.counters[1] = written
+        return written - read
+
+    def close(self):
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+class SharedWeights:
+    """Q_network parameters in shared memory, published by the learner and read by actors.
+
+    A version counter acts as a seqlock: it is odd while the learner is writing,
+    so actors retry any copy during which it changed.
+    """
+
+    def __init__(self, num_params, name=None):
+        """Create a SharedWeights block, or attach to an existing one by name.
+
+        Params
+        ======
+            num_params (int): number of parameters of the Q_network
+            name (str): name of the shared memory block to attach to, or None to create one
+        """
+        self.num_params = num_params
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=8 + 4 * num_params)
+        self.version = np.ndarray((1,), dtype=np.int64, buffer=self.shm.buf)
+        self.params = np.ndarray((num_params,), dtype=np.float32, buffer=self.shm.buf, offset=8)
+        if name is None:
+            self.version[0] = 0
+
+    def __reduce__(self):
+        return (SharedWeights, (self.num_params, self.shm.name))
+
+    def publish(self, q_network):
+        """Copy the parameters of q_network (on any device) into shared memory.
+
+        Returns the version of the published parameters.
+        """
+        self.version[0] += 1
+        with torch.no_grad():
+            self.params[:] = torch.nn.utils.parameters_to_vector(q_network.parameters()).detach().cpu().numpy()
+        self.version[0] += 1
+        return int(self.version[0])
+
+    def read_into(self, q_network, last_version):
+        """Load the shared parameters into q_network if they changed since last_version.
+
+        Returns the version that q_network now holds.
+        """
+        while True:
+            version = int(self.version[0])
+            if version == last_version:
+                return last_version
+            if version % 2 == 0:
+                params = torch.from_numpy(self.params.copy())
+                if int(self.version[0]) == version:
+                    torch.nn.utils.vector_to_parameters(params, q_network.parameters())
+                    return version
+            time.sleep(0.0001)
+
+    def close(self):
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+def play_game(q_network, epsilon, num_players=3, seed=None, log=None, lords=None):
+    """Play one self-play game, with every player choosing epsilon-greedy legal actions.
+
+    Each transition goes from one of a player's decisions to their next one (or to the
+    final state, as if it were their turn), with the change in Player.score as reward.
+    Returns states, actions, rewards, next_states, dones and next_masks (legal action
+    masks of the next states) as arrays with one row per decision.
+    If log is a list, the game's Trajectory (see trajectory.py) is appended to it.
+    If lords is a list, the (decisions, num_players) indices in LORD_CARDS of the lord
+    cards of the players of each transition, in turn order (as featurized), are appended
+    to it, e.g. to rescore the rewards (see scoring.rescoreRewards).
+    """
+    game = GameState(num_players, NUM_ROUNDS, seed=seed)
+    live = LiveFeatures(game)
+    state_size = stateFeatureLen(num_players)
+    pending = {} # player name -> (state, action, score before the action, step, lord cards)
+    transitions = []
+    taken = [] # actions in the order they were taken
+    step_rewards = [] # reward of the transition starting at each step
+
+    while not game.isOver():
+        player = game.players[0]
+        state = live.features.copy()
+        mask = legalActionMask(game)
+        if player.name in pending:
+            last_state, last_action, last_score, last_step, last_lords = pending.pop(player.name)
+            step_rewards[last_step] = player.score() - last_score
+            transitions.append((last_state, last_action, step_rewards[last_step], state, False, mask, last_lords))
+
+        if random.random() < epsilon:
+            action = int(random.choice(np.flatnonzero(mask)))
+        else:
+            with torch.no_grad():
+                q_values = q_network(torch.from_numpy(state).unsqueeze(0))[0]
+            q_values[~torch.from_numpy(mask)] = -float("inf")
+            action = int(q_values.argmax())
+
+        pending[player.name] = (state, action, player.score(), len(taken),
+                                [LORD_CARDS.index(player.lordCard) for player in game.players])
+        taken.append(action)
+        step_rewards.append(0.)
+        takeAction(game, action)
+
+    final_state = live.features[None]
+    final_mask = np.zeros(NUM_ACTIONS, dtype=bool)
+    for position, player in enumerate(game.players):
+        if player.name in pending:
+            last_state, last_action, last_score, last_step, last_lords = pending.pop(player.name)
+            step_rewards[last_step] = player.score() - last_score
+            transitions.append((last_state, last_action, step_rewards[last_step],
+                                rotatePlayers(final_state, num_players, [position])[0], True, final_mask, last_lords))
+
+    if log is not None:
+        log.append(Trajectory(game.seed, num_players, NUM_ROUNDS, np.array(taken, dtype=np.uint8),
+                              np.array(step_rewards, dtype=np.float32)))
+
+    states, actions, rewards, next_states, dones, next_masks, transition_lords = zip(*transitions)
+    if lords is not None:
+        lords.append(np.array(transition_lords, dtype=np.uint8).reshape(-1, num_players))
+    return (np.array(states, dtype=np.float32).reshape(-1, state_size), np.array(actions, dtype=np.int64),
+            np.array(rewards, dtype=np.float32), np.array(next_states, dtype=np.float32).reshape(-1, state_size),
+            np.array(dones, dtype=np.float32), np.array(next_masks, dtype=bool).reshape(-1, NUM_ACTIONS))
+
+
+def run_actor(ring, weights, stop_event, num_players, hidden_size, epsilon, seed, network_class=Q_network):
+    """Actor process: play self-play games with the latest published weights and push their transitions."""
+    torch.set_num_threads(1)
+    random.seed(seed)
+    np.random.seed(seed)
+    q_network = network_class(stateFeatureLen(num_players), NUM_ACTIONS, hidden_size)
+    q_network.eval()
+    version = 0
+    while not stop_event.is_set():
+        version = weights.read_into(q_network, version)
+        lords = []
+        transitions = play_game(q_network, epsilon, num_players, lords=lords)
+        if not ring.push(*transitions, lords[0], stop_event=stop_event):
+            break
+    ring.close()
+    weights.close()
+
+
+class ActorPool:
+    """Pool of self-play actor processes feeding a central learner through shared memory."""
+
+    def __init__(self, num_actors, hidden_size, num_players=3, ring_capacity=4096,
+                 base_epsilon=0.4, epsilon_alpha=7., seed=0, start_method=None, network_class=Q_network):
+        """Initialize an ActorPool object.
+
+        Params
+        ======
+            num_actors (int): number of actor processes
+            hidden_size (int): hidden size of the Q_network, as in DQLAgent
+            num_players (int): number of players in each self-play game
+            ring_capacity (int): transitions held by each actor's ring buffer
+            base_epsilon (float), epsilon_alpha (float): actor i explores with
+                epsilon = base_epsilon ** (1 + epsilon_alpha * i / (num_actors - 1))
+            seed (int): random seed, actor i uses seed + i
+            start_method (str): multiprocessing start method (see launcher.worker_context), or None for the default
+            network_class (type): class of the learner's network, Q_network or Shared_Q_network
+        """
+        self.num_actors = num_actors
+        self.hidden_size = hidden_size
+        self.network_class = network_class
+        self.num_players = num_players
+        self.state_size = stateFeatureLen(num_players)
+        self.seed = seed
+        self.context = worker_context(start_method, NETWORK_MODULES + ("actor_pool",))
+        self.epsilons = [base_epsilon ** (1 + epsilon_alpha * i / max(num_actors - 1, 1))
+                         for i in range(num_actors)]
+        self.rings = [SharedRingBuffer(ring_capacity, self.state_size, num_players) for _ in range(num_actors)]
+        self.weights = None
+        self.version = 0 # version of the last published weights
+        self.stop_event = self.context.Event()
+        self.processes = []
+
+    def start(self, q_network):
+        """Publish the initial weights of q_network and start the actor processes."""
+        num_params = sum(param.numel() for param in q_network.parameters())
+        self.weights = SharedWeights(num_params)
+        self.version = self.weights.publish(q_network)
+        for i in range(self.num_actors):
+            process = self.context.Process(
+                target=run_actor, daemon=True,
+                args=(self.rings[i], self.weights, self.stop_event, self.num_players,
+                      self.hidden_size, self.epsilons[i], self.seed + i, self.network_class))
+            process.start()
+            self.processes.append(process)
+
+    def broadcast(self, q_network):
+        """Publish new weights, which each actor picks up before its next game."""
+        self.version = self.weights.publish(q_network)
+
+    def collect(self, memory):
+        """Move all transitions pushed by the actors into a ReplayBuffer (with action_size=NUM_ACTIONS).
+        Returns how many were moved."""
+        return sum(ring.drain_into(memory) for ring in self.rings)
+
+    def stop(self):
+        """Stop the actor processes and free the shared memory."""
+        self.stop_event.set()
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+        for shared in self.rings + [self.weights]:
+            if shared is not None:
+                shared.close()
+                shared.unlink()
+
+
+def run_learner(agent, memory, pool, num_steps, broadcast_every=100):
+    """Train agent on the transitions produced by an ActorPool.
+
+    Params
+    ======
+        agent (DQLAgent): the learner, whose q_network the actors play with
+        memory (ReplayBuffer): replay buffer the actors' transitions are collected into,
+            created with action_size=NUM_ACTIONS to store the legal action masks. With a
+            PrioritizedReplayBuffer, the loss is weighted by the importance-sampling weights
+            and the priorities are updated with the TD errors of each batch
+        pool (ActorPool): the actors, started by this function and stopped when it returns
+        num_steps (int): number of training steps
+        broadcast_every (int): training steps between weight broadcasts
+
+    Returns the number of transitions collected from the actors.
+    """
+    prioritized = isinstance(memory, PrioritizedReplayBuffer)
+    pool.start(agent.q_network)
+    collected = 0
+    try:
+        step = 0
+        while step < num_steps:
+            collected += pool.collect(memory)
+            if len(memory) < memory.batch_size:
+                time.sleep(0.01)
+                continue
+            if prioritized:
+                batch, weights, indices = memory.sample(tensors=True)
+                memory.update_priorities(indices, agent.train(batch, weights))
+            else:
+                agent.train(memory.sample(tensors=True))
+            step += 1
+            if step % broadcast_every == 0:
+                pool.broadcast(agent.q_network)
+    finally:
+        pool.stop()
+    return collected
+
+
+def main():
+    # Check the weights seqlock, then train a learner on two actors' games
+    from q_network import DQLAgent
+    torch.set_num_threads(1)
+    state_size = stateFeatureLen(3)
+    source, target = (Q_network(state_size, NUM_ACTIONS, 32) for _ in range(2))
+    weights = SharedWeights(sum(param.numel() for param in source.parameters()))
+    version = weights.publish(source)
+    assert weights.read_into(target, 0) == version == 2
+    assert all(torch.equal(a, b) for a, b in zip(source.parameters(), target.parameters()))
+    assert weights.read_into(target, version) == version
+    weights.close()
+    weights.unlink()
+
+    num_steps, broadcast_every = 300, 100
+    for memory_class in [PrioritizedReplayBuffer, ReplayBuffer]:
+        agent = DQLAgent(state_size, NUM_ACTIONS, 64, 32, 1e-3, 0.9, 1., 0.1, 0.99)
+        memory = memory_class(20000, 32, 0, state_size, NUM_ACTIONS, num_players=3)
+        pool = ActorPool(2, 64, ring_capacity=1024)
+        start = time.perf_counter()
+        collected = run_learner(agent, memory, pool, num_steps, broadcast_every)
+        elapsed = time.perf_counter() - start
+        assert collected > 0 and len(memory) == min(collected, 20000)
+        # The initial weights, then one broadcast every broadcast_every steps, 2 versions each
+        assert pool.version == 2 * (1 + num_steps // broadcast_every)
+        print(f"{memory_class.__name__}: {num_steps} steps on {collected} transitions "
+              f"from {pool.num_actors} actors in {elapsed:.1f}s")
@@ -0,0 +1,540 @@
+import random
+import numpy as np
+from game_info import (RESOURCES, QUESTS, LORD_CARDS, DEFAULT_BUILDINGS,
+                       RESOURCE_INDEX, QUEST_REQUIREMENTS, QUEST_REWARDS,
+                       BUILDING_REWARD_MATRIX, agentsPerPlayer)
+from game import GameState
+from player import Player
+
+# Marks empty quest slots and unoccupied buildings in the arrays below
+EMPTY = -1
+
+# Number of quests available at Cliffwatch Inn
+NUM_AVAILABLE_QUESTS = 4
+
+# Resource gains for placing an agent at each building (quests
+# from Cliffwatch Inn are handed out separately)
+BUILDING_RESOURCE_GAINS = BUILDING_REWARD_MATRIX.copy()
+BUILDING_RESOURCE_GAINS[:, RESOURCE_INDEX["Q"]] = 0
+QUEST_BUILDING = DEFAULT_BUILDINGS.index("Quest")
+
+# QUEST_REQUIREMENTS with an extra row of zeros at the end, so that
+# gathering with index EMPTY (-1) gives no requirements
+PADDED_QUEST_REQUIREMENTS = np.vstack([QUEST_REQUIREMENTS, np.zeros(len(RESOURCES), dtype=np.int32)])
+PADDED_QUEST_REQUIREMENTS.flags.writeable = False
+# The same by resource, and the resources which some quest requires
+QUEST_REQUIREMENT_COLUMNS = np.ascontiguousarray(PADDED_QUEST_REQUIREMENTS.T)
+REQUIRED_RESOURCES = np.flatnonzero(QUEST_REQUIREMENT_COLUMNS.any(axis=1))
+
+def questCompletable(resources: np.ndarray, quests: np.ndarray) -> np.ndarray:
+    '''
+    Return which quests players have enough resources to complete.
+
+    Args:
+        resources: the (..., len(RESOURCES)) resource counts of each player.
+        quests: the (..., numQuests) indices in QUESTS of some quests
+            of each player, padded with EMPTY.
+
+    Returns:
+        the (..., numQuests) boolean array, False for EMPTY slots.
+    '''
+    # One comparison per required resource type, which is faster than 
+    # gathering whole requirement rows
+    completable = quests != EMPTY
+    for resource in REQUIRED_RESOURCES:
+        completable &= resources[..., resource, None] >= QUEST_REQUIREMENT_COLUMNS[resource][quests]
+    return completable
+
+def questShortfalls(resources: np.ndarray, quests: np.ndarray) -> np.ndarray:
+    '''
+    Return how many resources of each type players are short of to complete quests.
+
+    Args:
+        resources: the (..., len(RESOURCES)) resource counts of each player.
+        quests: the (..., numQuests) indices in QUESTS of some quests
+            of each player, padded with EMPTY.
+
+    Returns:
+        the (..., numQuests, len(RESOURCES)) shortfalls, zero for EMPTY slots
+        (sum over the last axis for the total number of resources short).
+    '''
+    return np.maximum(PADDED_QUEST_REQUIREMENTS[quests] - resources[..., None, :], 0)
+
+def playerQuestArrays(players: list[Player]):
+    '''
+    Stack the resources and active quests of players for the
+    functions above, e.g. questCompletable(*playerQuestArrays(players)).
+
+    Args:
+        players: the players.
+
+    Returns:
+        the (len(players), len(RESOURCES)) resource counts and the
+        (len(players), len(QUESTS)) active quests padded with EMPTY.
+    '''
+    resources = np.array([player.resourceCounts for player in players], dtype=np.int32).reshape(-1, len(RESOURCES))
+    quests = np.full((len(players), len(QUESTS)), EMPTY, dtype=np.int32)
+    for row, player in zip(quests, players):
+        row[:len(player.activeQuestIds)] = player.activeQuestIds
+    return resources, quests
+
+
+class BatchedGameState():
+    '''
+    Struct-of-arrays version of GameState, which holds many games
+    with the same number of players and steps all of them in lockstep.
+
+    Players are indexed by their position in playerNames (the same
+    indexing used by the building occupation features), and turnOrder
+    holds the player indices of each game in the current turn order.
+    Quests are indexed by their position in QUESTS, and lord cards by
+    their position in LORD_CARDS.
+    '''
+    def __init__(self, numGames: int, numPlayers: int = 3, numRounds: int = 8,
+                 playerNames = None, seeds: list[int] = None):
+        '''
+        Initialize numGames games, following the same setup as GameState:
+        the game seeded with seeds[g] is dealt exactly as GameState(seed=seeds[g]).
+
+        Args:
+            numGames: the number of games to hold
+            numPlayers: the number of players in each game
+            numRounds: the number of rounds in each game
+            playerNames (optional): the names for each player
+            seeds (optional): the seed of the shuffles of each game, drawn
+                from the random module if not given (as in GameState)
+        '''
+        if seeds is None:
+            seeds = [random.getrandbits(32) for _ in range(numGames)]
+        self._allocate(numGames, numPlayers, playerNames)
+        self.roundsLeft[:] = numRounds
+
+        # Shuffle the quest stacks, the lord cards and the turn order with the
+        # same draws, in the same order, as BoardState and GameState
+        for g, seed in enumerate(seeds):
+            rng = random.Random(seed)
+            questStack = list(range(len(QUESTS)))
+            rng.shuffle(questStack)
+            self.questStack[g] = questStack
+            lordCards = list(range(len(LORD_CARDS)))
+            rng.shuffle(lordCards)
+            self.lordCards[g] = lordCards[:numPlayers]
+            turnOrder = list(range(numPlayers))
+            rng.shuffle(turnOrder)
+            self.turnOrder[g] = turnOrder
+        self.stackSize[:] = len(QUESTS)
+
+        # Initialize the four available quests at Cliffwatch Inn
+        allGames = np.arange(numGames)
+        for slot in range(NUM_AVAILABLE_QUESTS):
+            self.availableQuests[:, slot] = self._drawQuests(allGames)
+
+        self.agents[:] = agentsPerPlayer(numPlayers)
+        self.maxAgents[:] = agentsPerPlayer(numPlayers)
+
+        # Deal quest cards to players
+        for _ in range(2):
+            for position in range(numPlayers):
+                self._giveQuests(allGames, self.turnOrder[:, position],
+                                 self._drawQuests(allGames))
+
+        self.newRound()
+
+    def _allocate(self, numGames: int, numPlayers: int, playerNames):
+        '''Allocate the (zeroed) state arrays for numGames games.'''
+        assert numPlayers >= 2 and numPlayers <= 5
+        self.numGames = numGames
+        self.numPlayers = numPlayers
+        self.playerNames = playerNames
+        if playerNames == None:
+            self.playerNames = [
+                "PlayerOne", "PlayerTwo",
+                "PlayerThree", "PlayerFour",
+                "PlayerFive"
+            ][:numPlayers]
+
+        self.roundsLeft = np.zeros(numGames, dtype=np.int32)
+
+        # Board state
+        self.buildingStates = np.full((numGames, len(DEFAULT_BUILDINGS)), EMPTY, dtype=np.int32)
+        self.questStack = np.full((numGames, len(QUESTS)), EMPTY, dtype=np.int32) # Top last
+        self.stackSize = np.zeros(numGames, dtype=np.int32)
+        self.availableQuests = np.full((numGames, NUM_AVAILABLE_QUESTS), EMPTY, dtype=np.int32)
+        # Whether the current player has placed their agent this turn and
+        # still has to choose a quest to complete (as in GameState.completingQuest)
+        self.completingQuest = np.zeros(numGames, dtype=bool)
+
+        # Player states
+        self.turnOrder = np.zeros((numGames, numPlayers), dtype=np.int32)
+        self.lordCards = np.zeros((numGames, numPlayers), dtype=np.int32)
+        self.resources = np.zeros((numGames, numPlayers, len(RESOURCES)), dtype=np.int32)
+        self.agents = np.zeros((numGames, numPlayers), dtype=np.int32)
+        self.maxAgents = np.zeros((numGames, numPlayers), dtype=np.int32)
+        self.activeQuests = np.full((numGames, numPlayers, len(QUESTS)), EMPTY, dtype=np.int32)
+        self.numActiveQuests = np.zeros((numGames, numPlayers), dtype=np.int32)
+        self.completedQuests = np.full((numGames, numPlayers, len(QUESTS)), EMPTY, dtype=np.int32)
+        self.numCompletedQuests = np.zeros((numGames, numPlayers), dtype=np.int32)
+
+    @classmethod
+    def fromGameStates(cls, gameStates: list[GameState]):
+        '''
+        Build a BatchedGameState holding copies of existing games.
+        All games must have the same player names.
+
+        Args:
+            gameStates: the games to copy.
+        '''
+        batch = cls.__new__(cls)
+        batch._allocate(len(gameStates), gameStates[0].numPlayers, gameStates[0].playerNames)
+        batch.setGames(np.arange(len(gameStates)), gameStates)
+        return batch
+
+    def setGames(self, games: np.ndarray, gameStates: list[GameState]):
+        '''
+        Overwrite some games of the batch with copies of existing games
+        (e.g. to start new games in place of finished ones).
+        All games must have the batch's player names.
+
+        Args:
+            games: the indices of the games to overwrite.
+            gameStates: the games to copy, one per index.
+        '''
+        for g, gameState in zip(games, gameStates):
+            assert gameState.playerNames == self.playerNames
+            board = gameState.boardState
+            self.roundsLeft[g] = gameState.roundsLeft
+            self.completingQuest[g] = gameState.completingQuest
+            self.buildingStates[g] = board.occupancy
+            self.stackSize[g] = len(board.questStackIds)
+            self.questStack[g] = EMPTY
+            self.questStack[g, :len(board.questStackIds)] = board.questStackIds
+            self.availableQuests[g] = EMPTY
+            self.availableQuests[g, :len(board.availableQuestIds)] = board.availableQuestIds
+
+            for position, player in enumerate(gameState.players):
+                p = self.playerNames.index(player.name)
+                self.turnOrder[g, position] = p
+                self.lordCards[g, p] = LORD_CARDS.index(player.lordCard)
+                self.resources[g, p] = player.resourceCounts
+                self.agents[g, p] = player.agents
+                self.maxAgents[g, p] = player.maxAgents
+                self.numActiveQuests[g, p] = len(player.activeQuestIds)
+                self.activeQuests[g, p] = EMPTY
+                self.activeQuests[g, p, :len(player.activeQuestIds)] = player.activeQuestIds
+                self.numCompletedQuests[g, p] = len(player.completedQuestIds)
+                self.completedQuests[g, p] = EMPTY
+                self.completedQuests[g, p, :len(player.completedQuestIds)] = player.completedQuestIds
+
+    def _drawQuests(self, games: np.ndarray) -> np.ndarray:
+        '''
+        Draw the top quest from the quest stack of each game,
+        removing it from the stack in the process.
+
+        Args:
+            games: the indices of the games to draw in (no repeats).
+
+        Returns:
+            the drawn quest indices, EMPTY for games whose stack is empty.
+        '''
+        top = self.stackSize[games] - 1
+        hasQuest = top >= 0
+        top = np.maximum(top, 0)
+        quests = np.where(hasQuest, self.questStack[games, top], EMPTY)
+        self.questStack[games[hasQuest], top[hasQuest]] = EMPTY
+        self.stackSize[games] = top
+        return quests
+
+    def _giveQuests(self, games: np.ndarray, players: np.ndarray, quests: np.ndarray):
+        '''Append one quest to the active quests of one player per game.'''
+        self.activeQuests[games, players, self.numActiveQuests[games, players]] = quests
+        self.numActiveQuests[games, players] += 1
+
+    def currentPlayers(self, games: np.ndarray = None) -> np.ndarray:
+        '''Return the index of the player whose turn it is in each game.'''
+        if games is None:
+            return self.turnOrder[:, 0]
+        return self.turnOrder[games, 0]
+
+    def newRound(self, games: np.ndarray = None):
+        '''
+        Reset the board at the beginning of each round,
+        as in GameState.newRound.
+
+        Args:
+            games (optional): the indices of the games to start
+                a new round in. Defaults to all games.
+        '''
+        if games is None:
+            games = np.arange(self.numGames)
+        self.roundsLeft[games] -= 1
+
+        # Reset all buildings
+        self.buildingStates[games] = EMPTY
+
+        # Get new agent at fifth round
+        fifthRound = games[self.roundsLeft[games] == 4]
+        self.maxAgents[fifthRound] += 1
+
+        # Return all agents
+        self.agents[games] = self.maxAgents[games]
+
+    def placeAgents(self, games: np.ndarray, buildings: np.ndarray,
+                    questSlots: np.ndarray = None):
+        '''
+        Place one agent of the current player of each game at a
+        building and give them that building's rewards,
+        as in GameState.placeAgent.
+
+        Args:
+            games: the indices of the games to move in (no repeats).
+            buildings: the index in DEFAULT_BUILDINGS of the building
+                to place at in each game.
+            questSlots (optional): the available quest to take in each
+                game which places at Cliffwatch Inn. Defaults to 0.
+        '''
+        games = np.asarray(games)
+        buildings = np.asarray(buildings)
+        players = self.turnOrder[games, 0]
+        if np.any(self.buildingStates[games, buildings] != EMPTY):
+            raise ValueError("This building is already occupied.")
+        if np.any(self.agents[games, players] <= 0):
+            raise ValueError("This player has no agents left to place.")
+        atInn = buildings == QUEST_BUILDING
+        if questSlots is None:
+            questSlots = np.zeros(len(games), dtype=np.int32)
+        questSlots = np.asarray(questSlots)
+        if np.any(self.availableQuests[games[atInn], questSlots[atInn]] == EMPTY):
+            raise ValueError("No quest is available in this slot.")
+
+        self.agents[games, players] -= 1
+        self.buildingStates[games, buildings] = players
+        self.resources[games, players] += BUILDING_RESOURCE_GAINS[buildings]
+
+        if np.any(atInn):
+            self._takeQuests(games[atInn], players[atInn], questSlots[atInn])
+
+    def _takeQuests(self, games: np.ndarray, players: np.ndarray, slots: np.ndarray):
+        '''
+        Give each player a quest available at Cliffwatch Inn, replacing
+        it with the top quest from the quest stack, as in BoardState.takeQuest.
+        '''
+        quests = self.availableQuests[games, slots]
+        self._giveQuests(games, players, quests)
+
+        refilled = self.stackSize[games] > 0
+        self.availableQuests[games[refilled], slots[refilled]] = self._drawQuests(games[refilled])
+
+        # With an empty quest stack, remove the slot by shifting later ones down
+        emptied = ~refilled
+        if np.any(emptied):
+            self.availableQuests[games[emptied]] = _removeColumns(
+                self.availableQuests[games[emptied]], slots[emptied])
+
+    def completableQuests(self, games: np.ndarray, players: np.ndarray, 
+                          available: bool = False) -> np.ndarray:
+        '''
+        Return which active quests each player has enough resources to complete.
+
+        Args:
+            games: the indices of the games.
+            players: the index of one player in each game.
+            available (optional): whether to check the quests available 
+                at Cliffwatch Inn instead of the active quests.
+
+        Returns:
+            a (len(games), len(QUESTS)) boolean array, indexed like activeQuests
+            (or (len(games), NUM_AVAILABLE_QUESTS), like availableQuests).
+        '''
+        if available:
+            return questCompletable(self.resources[games, players], self.availableQuests[games])
+        # Only look at the slots which some player has filled
+        activeQuests = self.activeQuests[games, players]
+        width = self.numActiveQuests[games, players].max(initial=0)
+        completable = np.zeros(activeQuests.shape, dtype=bool)
+        completable[:, :width] = questCompletable(self.resources[games, players], activeQuests[:, :width])
+        return completable
+
+    def questShortfalls(self, games: np.ndarray, players: np.ndarray,
+                        available: bool = False) -> np.ndarray:
+        '''
+        Return how many resources of each type each player is short of
+        to complete their active quests (see questShortfalls).
+
+        Args:
+            games: the indices of the games.
+            players: the index of one player in each game.
+            available (optional): whether to check the quests available 
+                at Cliffwatch Inn instead of the active quests.
+
+        Returns:
+            a (len(games), len(QUESTS), len(RESOURCES)) integer array, indexed
+            like activeQuests (or (len(games), NUM_AVAILABLE_QUESTS, len(RESOURCES)),
+            like availableQuests).
+        '''
+        if available:
+            return questShortfalls(self.resources[games, players], self.availableQuests[games])
+        activeQuests = self.activeQuests[games, players]
+        width = self.numActiveQuests[games, players].max(initial=0)
+        shortfalls = np.zeros(activeQuests.shape + (len(RESOURCES),), dtype=np.int32)
+        shortfalls[:, :width] = questShortfalls(self.resources[games, players], activeQuests[:, :width])
+        return shortfalls
+
+    def completeQuests(self, games: np.ndarray, slots: np.ndarray,
+                       players: np.ndarray = None):
+        '''
+        Complete one active quest of one player in each game,
+        as in Player.completeQuest.
+
+        Args:
+            games: the indices of the games to move in (no repeats).
+            slots: the index of the quest among each player's active quests.
+            players (optional): the index of the player completing the quest
+                in each game. Defaults to the current players.
+        '''
+        games = np.asarray(games)
+        slots = np.asarray(slots)
+        if players is None:
+            players = self.turnOrder[games, 0]
+        if np.any(slots >= self.numActiveQuests[games, players]):
+            raise ValueError("This agent does not have this quest.")
+        quests = self.activeQuests[games, players, slots]
+
+        # Check if the quests can be completed
+        requirements = QUEST_REQUIREMENTS[quests]
+        if np.any(self.resources[games, players] < requirements):
+            raise ValueError("Do not have enough resources to complete this quest.")
+        self.resources[games, players] += QUEST_REWARDS[quests] - requirements
+
+        self.activeQuests[games, players] = _removeColumns(self.activeQuests[games, players], slots)
+        self.numActiveQuests[games, players] -= 1
+        self.completedQuests[games, players, self.numCompletedQuests[games, players]] = quests
+        self.numCompletedQuests[games, players] += 1
+
+    def endTurns(self, games: np.ndarray = None):
+        '''
+        Pass the turn to the next player in each game, and start a new
+        round in games where no more agents can be placed,
+        as in GameState.endTurn.
+
+        Args:
+            games (optional): the indices of the games to end the turn in.
+                Defaults to all games.
+        '''
+        if games is None:
+            games = np.arange(self.numGames)
+        games = np.asarray(games)
+        self.turnOrder[games] = np.roll(self.turnOrder[games], -1, axis=1)
+
+        # As in GameState.canPlaceAgent, Cliffwatch Inn only counts while it has quests
+        unoccupied = self.buildingStates[games] == EMPTY
+        unoccupied[:, QUEST_BUILDING] &= self.availableQuests[games, 0] != EMPTY
+        roundOver = ((self.agents[games, self.turnOrder[games, 0]] <= 0)
+                     | ~np.any(unoccupied, axis=1))
+        if np.any(roundOver):
+            self.newRound(games[roundOver])
+
+    def isOver(self) -> np.ndarray:
+        '''Return whether all rounds have been played in each game.'''
+        return self.roundsLeft <= 0
+
+
+def _removeColumns(rows: np.ndarray, columns: np.ndarray) -> np.ndarray:
+    '''
+    Remove one column from each row, shifting the later
+    entries left and filling the last column with EMPTY.
+    '''
+    width = rows.shape[1]
+    index = np.arange(width) + (np.arange(width) >= columns[:, None])
+    shifted = np.take_along_axis(rows, np.minimum(index, width - 1), axis=1)
+    shifted[:, -1] = EMPTY
+    return shifted
+
+
+def _assertMatches(batch: BatchedGameState, gameStates: list[GameState]):
+    '''Assert that a batch holds the same state as each of the given games.'''
+    expected = BatchedGameState.fromGameStates(gameStates)
+    for name, value in vars(expected).items():
+        if isinstance(value, np.ndarray):
+            assert np.array_equal(getattr(batch, name), value), name
+
+
+def _assertQueriesMatch(batch: BatchedGameState, gameStates: list[GameState]):
+    '''Assert that the quest queries of a batch agree with Player.canCompleteQuest.'''
+    for p, name in enumerate(batch.playerNames):
+        games = np.arange(batch.numGames)
+        players = np.full(batch.numGames, p)
+        active, available = (batch.completableQuests(games, players, available) for available in (False, True))
+        shortfalls = batch.questShortfalls(games, players).sum(axis=2)
+        for g, gameState in enumerate(gameStates):
+            player = next(player for player in gameState.players if player.name == name)
+            expected = [player.canCompleteQuest(quest) for quest in player.activeQuests]
+            assert active[g, :len(expected)].tolist() == expected and not active[g, len(expected):].any()
+            assert ((shortfalls[g, :len(expected)] == 0) == expected).all()
+            expected = [player.canCompleteQuest(quest) for quest in gameState.boardState.availableQuests]
+            assert available[g, :len(expected)].tolist() == expected and not available[g, len(expected):].any()
+        assert np.array_equal(questCompletable(*playerQuestArrays(
+            [next(player for player in gameState.players if player.name == name) for gameState in gameStates])),
+            active)
+
+
+def main():
+    # Test that the batched engine matches GameState game for game
+    random.seed(229)
+    numGames = 64
+    # The batch deals each game as GameState does with the same seed
+    for numPlayers in [2, 3, 4, 5]:
+        seeds = [random.getrandbits(32) for _ in range(numGames)]
+        gameStates = [GameState(numPlayers, seed=seed) for seed in seeds]
+        batch = BatchedGameState(numGames, numPlayers, seeds=seeds)
+        _assertMatches(batch, gameStates)
+
+        # Then both play the same moves, over all rounds (e.g. the agent gained at the fifth)
+        while not all(gameState.isOver() for gameState in gameStates):
+            games, buildings, questSlots, completions = [], [], [], []
+            for g, gameState in enumerate(gameStates):
+                if gameState.isOver():
+                    continue
+                # Place at a random unoccupied building
+                building = random.choice(gameState.boardState.unoccupiedBuildings())
+                questSlot = random.randrange(len(gameState.boardState.availableQuests))
+                gameState.placeAgent(building, questSlot)
+
+                # Complete a random quest that the player has enough resources for
+                player = gameState.players[0]
+                completable = [i for i, quest in enumerate(player.activeQuests)
+                               if all(player.resources[resource] >= number
+                                      for resource, number in quest.requirements.items())]
+                if completable:
+                    completion = random.choice(completable)
+                    player.completeQuest(player.activeQuests[completion])
+                else:
+                    completion = None
+                gameState.endTurn()
+
+                games.append(g)
+                buildings.append(DEFAULT_BUILDINGS.index(building))
+                questSlots.append(questSlot)
+                completions.append(completion)
+
+            games = np.array(games)
+            batch.placeAgents(games, np.array(buildings), np.array(questSlots))
+            completing = np.array([completion is not None for completion in completions])
+            batch.completeQuests(games[completing],
+                                 np.array([c for c in completions if c is not None], dtype=np.int64))
+            batch.endTurns(games)
+            _assertMatches(batch, gameStates)
+            _assertQueriesMatch(batch, gameStates)
+
+        assert np.all(batch.isOver())
+    print("BatchedGameState matches GameState on", numGames, "seeded games of each player count.")
+
+    # Compare the quest queries to checking quests one by one
+    from timeit import timeit
+    players = [player for gameState in gameStates for player in gameState.players]
+    allGames = np.repeat(np.arange(numGames), batch.numPlayers)
+    allPlayers = np.tile(np.arange(batch.numPlayers), numGames)
+    loop = timeit(lambda: [[player.canCompleteQuest(quest) for quest in player.activeQuests] 
+                           for player in players], number=20) / 20
+    batched = timeit(lambda: batch.completableQuests(allGames, allPlayers), number=20) / 20
+    print(f"Completable quests of {len(players)} players: {loop * 1e3:.2f} ms one by one, "
+          f"{batched * 1e3:.3f} ms batched")
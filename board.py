@@ -1,30 +1,153 @@
-from random import shuffle
-from game_info import DEFAULT_BUILDINGS, QUESTS, Quest
+import random
+from array import array
+from collections.abc import MutableMapping
+from game_info import DEFAULT_BUILDINGS, BUILDING_INDEX, QUESTS, Quest
+from player import QuestListView
+
+# Marks unoccupied buildings in BoardState.occupancy
+EMPTY = -1
+
+class BuildingView(MutableMapping):
+    '''
+    Dictionary-like view of the occupation state of each building of
+    a board: None when unoccupied, or the name of the occupying player.
+    Changes write through to the board's occupancy array, without
+    notifying observers (use BoardState.occupyBuilding for that).
+    '''
+    __slots__ = ("board",)
+
+    def __init__(self, board: "BoardState") -> None:
+        self.board = board
+
+    def __getitem__(self, building: str) -> str:
+        occupant = self.board.occupancy[BUILDING_INDEX[building]]
+        return None if occupant == EMPTY else self.board.playerNames[occupant]
+
+    def __setitem__(self, building: str, playerName: str):
+        self.board.occupancy[BUILDING_INDEX[building]] = (
+            EMPTY if playerName is None else self.board.playerNames.index(playerName))
+
+    def __delitem__(self, building: str):
+        raise TypeError("Cannot remove a building from the board.")
+
+    def __iter__(self):
+        return iter(DEFAULT_BUILDINGS)
+
+    def __len__(self) -> int:
+        return len(DEFAULT_BUILDINGS)
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
 
 class BoardState():
     '''Class to represent the state of the board itself 
     along with cards, but not players.'''
-    def __init__(self) -> None:
+    # Boards are created in large numbers during self-play, so they
+    # store everything in slots, with quests as indices into QUESTS 
+    # and buildings as the index of the occupying player.
+    __slots__ = ("playerNames", "questStackIds", "occupancy", 
+                 "availableQuestIds", "observers")
+
+    def __init__(self, playerNames: list[str] = None, rng: random.Random = None) -> None:
         '''
         Initialize the board state. Creates the quest stack
         and initializes all buildings states.
+
+        Args:
+            playerNames (optional): the names of the players, whose
+                indices are stored as building occupation states
+            rng (optional): the random generator shuffling the quest 
+                stack, or the random module if not given
         '''
-        # Create the quest stack
-        self.questStack = QUESTS.copy()
-        shuffle(self.questStack)
+        self.playerNames = playerNames
+        if playerNames == None:
+            self.playerNames = [
+                "PlayerOne", "PlayerTwo", 
+                "PlayerThree", "PlayerFour",
+                "PlayerFive"
+            ]
+
+        # Create the quest stack (top last), as indices into QUESTS
+        self.questStackIds = array("b", range(len(QUESTS)))
+        (random if rng is None else rng).shuffle(self.questStackIds)
+
+        # Initialize building occupation states, indexed like DEFAULT_BUILDINGS.
+        # Will be EMPTY when unoccupied, the index of player.name in 
+        # playerNames when occupied with one of player's agents.
+        self.occupancy = array("b", [EMPTY] * len(DEFAULT_BUILDINGS))
 
-        # Initialize building occupation states.
-        # Will be None when unoccupied, player.name when occupied 
-        # with one of player's agents.
-        self.buildingStates = {building: None for building in DEFAULT_BUILDINGS}
+        # Observers (see observer.GameObserver) notified of each change
+        self.observers = ()
 
         # Initialize the four available quests at Cliffwatch Inn
-        self.availableQuests = [self.drawQuest() for _ in range(4)]
+        self.availableQuestIds = array("b", [self.questStackIds.pop() for _ in range(4)])
+
+    def clone(self) -> "BoardState":
+        '''Return a copy of the board without its observers, sharing playerNames.'''
+        other = BoardState.__new__(BoardState)
+        other.playerNames = self.playerNames
+        other.questStackIds = self.questStackIds[:]
+        other.occupancy = self.occupancy[:]
+        other.availableQuestIds = self.availableQuestIds[:]
+        other.observers = ()
+        return other
+
+    def snapshot(self, out: array):
+        '''
+        Append the board's mutable state (building occupancy,
+        quest stack and available quests) to out, an integer array.
+        '''
+        out.fromlist(self.occupancy.tolist())
+        for questIds in (self.questStackIds, self.availableQuestIds):
+            out.append(len(questIds))
+            out.fromlist(questIds.tolist())
+
+    def restore(self, snapshot: array, offset: int) -> int:
+        '''
+        Restore the state appended to snapshot by self.snapshot,
+        without notifying observers.
+
+        Args:
+            snapshot: the integer array holding the state.
+            offset: the index in snapshot where the state starts.
+
+        Returns:
+            the index in snapshot where the state ends.
+        '''
+        end = offset + len(self.occupancy)
+        self.occupancy[:] = array("b", snapshot[offset:end])
+        offset = end
+        for questIds in (self.questStackIds, self.availableQuestIds):
+            end = offset + 1 + snapshot[offset]
+            questIds[:] = array("b", snapshot[offset + 1:end])
+            offset = end
+        return offset
+
+    @property
+    def questStack(self) -> QuestListView:
+        '''The quest stack (top last).'''
+        return QuestListView(self.questStackIds)
+
+    @property
+    def availableQuests(self) -> QuestListView:
+        '''The quests available at Cliffwatch Inn.'''
+        return QuestListView(self.availableQuestIds)
+
+    @property
+    def buildingStates(self) -> BuildingView:
+        '''
+        The occupation state of each building: None when 
+        unoccupied, or the name of the occupying player.
+        '''
+        return BuildingView(self)
 
     def clearBuildings(self):
         '''Clears all buildings to their unoccupied states.'''
-        for building in self.buildingStates:
-            self.buildingStates[building] = None
+        for b, occupant in enumerate(self.occupancy):
+            if occupant != EMPTY:
+                self.occupancy[b] = EMPTY
+                for observer in self.observers:
+                    observer.buildingChanged(self, DEFAULT_BUILDINGS[b], self.playerNames[occupant])
     
     def drawQuest(self) -> Quest:
         '''
@@ -34,19 +157,54 @@ class BoardState():
         Returns: 
             The top quest from the quest stack.
         '''
-        return self.questStack.pop()
+        return QUESTS[self.questStackIds.pop()]
     
+    def takeQuest(self, slot: int) -> Quest:
+        '''
+        Take one of the quests available at Cliffwatch Inn, replacing
+        it with the top quest from the quest stack. If the quest stack
+        is empty, the slot is removed instead.
+
+        Args:
+            slot: the index of the quest in availableQuests.
+
+        Returns:
+            The quest that was taken.
+        '''
+        oldQuests = self.availableQuests.copy() if self.observers else None
+        questId = self.availableQuestIds[slot]
+        if self.questStackIds:
+            self.availableQuestIds[slot] = self.questStackIds.pop()
+        else:
+            del self.availableQuestIds[slot]
+        for observer in self.observers:
+            observer.availableQuestsChanged(self, oldQuests)
+        return QUESTS[questId]
+
     def printQuestStack(self) -> None:
         '''Debug function for printing the quest stack.'''
         print("Quest stack (top first):")
-        questStackCopy = self.questStack.copy()
-        for i in range(len(self.questStack)):
-            print(i+1, questStackCopy.pop())
+        for i, quest in enumerate(reversed(self.questStack)):
+            print(i+1, quest)
 
     def occupyBuilding(self, building: str, playerName: str):
         '''Change the occupation state of building from 'None'
         to being occupied by the player named playerName.'''
-        self.buildingStates[building] = playerName
+        b = BUILDING_INDEX[building]
+        oldOccupant = self.occupancy[b]
+        self.occupancy[b] = self.playerNames.index(playerName)
+        for observer in self.observers:
+            observer.buildingChanged(self, building, 
+                                     None if oldOccupant == EMPTY else self.playerNames[oldOccupant])
+
+    def isOccupied(self, building: str) -> bool:
+        '''Return whether building has an agent on it.'''
+        return self.occupancy[BUILDING_INDEX[building]] != EMPTY
+
+    def unoccupiedBuildings(self) -> list[str]:
+        '''Return the buildings which do not have an agent on them.'''
+        return [building for building, occupant in zip(DEFAULT_BUILDINGS, self.occupancy) 
+                if occupant == EMPTY]
 
 
 def main():
@@ -55,4 +213,12 @@ def main():
     for i in range(2):
         print("Drew quest:", boardState.drawQuest())
         boardState.printQuestStack()
-        print()
\ No newline at end of file
+        print()
+    # Changes to the quest and building views write through to the board
+    quest = boardState.questStack.pop()
+    boardState.availableQuests.append(quest)
+    assert boardState.availableQuestIds[-1] == QUESTS.index(quest) and quest not in boardState.questStack
+    boardState.buildingStates[DEFAULT_BUILDINGS[0]] = boardState.playerNames[1]
+    assert boardState.occupancy[0] == 1 and boardState.isOccupied(DEFAULT_BUILDINGS[0])
+    boardState.buildingStates[DEFAULT_BUILDINGS[0]] = None
+    assert DEFAULT_BUILDINGS[0] in boardState.unoccupiedBuildings()
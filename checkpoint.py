@@ -0,0 +1,332 @@
+import copy
+import os
+import queue
+import shutil
+import threading
+import time
+import numpy as np
+import torch
+
+# Layout of a checkpoint directory:
+#   latest                    name of the newest complete checkpoint
+#   step-000000001000/
+#       state.pt              networks, optimizer, epsilon and the replay buffer's scalars
+#       replay/<array>.npy    the replay buffer's arrays, loaded back as memory maps
+# A checkpoint is written into a temporary directory which is renamed once
+# all of its files are on disk, and only then pointed to by latest, so that
+# a run killed at any time leaves its last complete checkpoint intact.
+
+LATEST = "latest"
+
+# Rows of a replay array copied to disk at a time, so that the training
+# thread gets the interpreter between chunks
+WRITE_CHUNK_BYTES = 1 << 26
+
+
+def agent_state_dict(agent):
+    """Return a copy of the training state of a DQLAgent: both networks, the optimizer, epsilon
+    and the number of training steps."""
+    return {
+        "q_network": {key: value.detach().clone() for key, value in agent.q_network.state_dict().items()},
+        "target_q_network": {key: value.detach().clone()
+                             for key, value in agent.target_q_network.state_dict().items()},
+        "optimizer": copy.deepcopy(agent.optimizer.state_dict()),
+        "epsilon": agent.epsilon,
+        "train_steps": agent.train_steps,
+    }
+
+
+def load_agent_state_dict(agent, state):
+    """Restore the training state returned by agent_state_dict into a DQLAgent."""
+    agent.q_network.load_state_dict(state["q_network"])
+    agent.target_q_network.load_state_dict(state["target_q_network"])
+    agent.optimizer.load_state_dict(state["optimizer"])
+    agent.epsilon = state["epsilon"]
+    agent.train_steps = state["train_steps"]
+
+
+def snapshot(agent, memory=None, step=None, extra=None):
+    """Copy everything a checkpoint holds, so that training can go on while it is written.
+
+    Params
+    ======
+        agent (DQLAgent): the agent to save
+        memory (ReplayBuffer): its replay buffer (or a PrioritizedReplayBuffer), if it is saved
+        step (int): number of the checkpoint, agent.train_steps if None
+        extra (dict): other plain Python values to save (numbers, strings, lists, dicts)
+
+    Returns the name of the checkpoint, its state and its replay arrays.
+    """
+    step = agent.train_steps if step is None else step
+    state = {"step": step, "agent": agent_state_dict(agent), "extra": extra, "replay": None}
+    arrays = {}
+    if memory is not None:
+        state["replay"] = {}
+        for key, value in memory.state_dict().items():
+            if isinstance(value, np.ndarray):
+                arrays[key] = value.copy()
+            else:
+                state["replay"][key] = copy.deepcopy(value)
+        state["replay_arrays"] = sorted(arrays)
+    return f"step-{step:012d}", state, arrays
+
+
+def _fsync(path):
+    """Flush a file or directory to disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_array(path, array):
+    """Write an array to a .npy file through a memory map, in chunks."""
+    mapped = np.lib.format.open_memmap(path, mode="w+", dtype=array.dtype, shape=array.shape)
+    rows = max(1, WRITE_CHUNK_BYTES // max(1, array[:1].nbytes))
+    for start in range(0, len(array), rows):
+        mapped[start:start + rows] = array[start:start + rows]
+    mapped.flush()
+    del mapped
+    _fsync(path)
+
+
+def checkpoints(directory):
+    """Names of the complete checkpoints in a directory, oldest first."""
+    if not os.path.isdir(directory):
+        return []
+    return sorted(name for name in os.listdir(directory)
+                  if name.startswith("step-") and os.path.isdir(os.path.join(directory, name)))
+
+
+def write_checkpoint(directory, name, state, arrays, keep=2):
+    """Atomically write a checkpoint (see snapshot) into directory, and point latest to it.
+
+    Params
+    ======
+        directory (str): the directory holding the checkpoints of a run
+        name (str): name of the checkpoint
+        state (dict): everything but the replay arrays, saved with torch.save
+        arrays (dict): replay arrays, written as .npy files
+        keep (int): number of newest checkpoints kept, older ones are deleted
+    """
+    os.makedirs(directory, exist_ok=True)
+    temporary = os.path.join(directory, f".{name}.tmp")
+    if os.path.exists(temporary):
+        shutil.rmtree(temporary)
+    os.makedirs(os.path.join(temporary, "replay"))
+    for key, array in arrays.items():
+        _write_array(os.path.join(temporary, "replay", f"{key}.npy"), array)
+    torch.save(state, os.path.join(temporary, "state.pt"))
+    _fsync(os.path.join(temporary, "state.pt"))
+    _fsync(os.path.join(temporary, "replay"))
+    _fsync(temporary)
+
+    final = os.path.join(directory, name)
+    if os.path.exists(final):
+        shutil.rmtree(final)
+    os.replace(temporary, final)
+    _fsync(directory)
+
+    pointer = os.path.join(directory, f".{LATEST}.tmp")
+    with open(pointer, "w") as file:
+        file.write(name)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(pointer, os.path.join(directory, LATEST))
+    _fsync(directory)
+
+    # Replay arrays mapped from a deleted checkpoint stay readable (on POSIX systems)
+    for old in checkpoints(directory)[:-keep]:
+        if old != name:
+            shutil.rmtree(os.path.join(directory, old))
+
+
+def save_checkpoint(directory, agent, memory=None, step=None, extra=None, keep=2):
+    """Save a checkpoint synchronously (see Checkpointer for saving in the background)."""
+    write_checkpoint(directory, *snapshot(agent, memory, step, extra), keep=keep)
+
+
+def latest_checkpoint(directory):
+    """Return the path of the newest complete checkpoint in directory, or None if there is none."""
+    try:
+        with open(os.path.join(directory, LATEST)) as file:
+            name = file.read().strip()
+    except FileNotFoundError:
+        return None
+    path = os.path.join(directory, name)
+    return path if os.path.isdir(path) else None
+
+
+def load_checkpoint(path, agent, memory=None):
+    """Resume from a checkpoint.
+
+    The replay arrays are memory-mapped copy-on-write rather than read into RAM:
+    pages are read from disk as they are sampled, and new experiences only change
+    the buffer in memory, never the checkpoint.
+
+    Params
+    ======
+        path (str): the checkpoint, e.g. from latest_checkpoint
+        agent (DQLAgent): agent to restore, built with the same sizes as the saved one
+        memory (ReplayBuffer): replay buffer to restore, built with the same sizes as the saved one
+
+    Returns the step and the extra values of the checkpoint.
+    """
+    state = torch.load(os.path.join(path, "state.pt"), weights_only=True)
+    load_agent_state_dict(agent, state["agent"])
+    if memory is not None:
+        if state["replay"] is None:
+            raise ValueError(f"Checkpoint {path} has no replay buffer.")
+        replay = dict(state["replay"])
+        for key in state["replay_arrays"]:
+            replay[key] = np.load(os.path.join(path, "replay", f"{key}.npy"), mmap_mode="c")
+        memory.load_state_dict(replay)
+    return state["step"], state["extra"]
+
+
+class Checkpointer:
+    """Save checkpoints of a training run on a background thread.
+
+    save only copies the state to save, which takes as long as a memcpy of the
+    replay buffer, and a background thread writes it to disk while training goes on.
+    """
+
+    def __init__(self, directory, keep=2):
+        """Initialize a Checkpointer object and start its writing thread.
+
+        Params
+        ======
+            directory (str): the directory holding the checkpoints of the run
+            keep (int): number of newest checkpoints kept
+        """
+        self.directory = directory
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+        self.requests = queue.Queue()
+        # Set when no checkpoint is being written
+        self.idle = threading.Event()
+        self.idle.set()
+        self.error = None
+
+        # Seconds spent in save by the training loop, and writing in the background, per checkpoint
+        self.block_times = []
+        self.write_times = []
+
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def save(self, agent, memory=None, step=None, extra=None, block=False):
+        """Start saving a checkpoint (see snapshot for the arguments).
+
+        If the previous checkpoint is still being written, waits for it with block,
+        or skips this one otherwise. Returns whether the checkpoint was started.
+        Errors of the writing thread are raised by the next call.
+        """
+        self._raise_error()
+        if not self.idle.is_set():
+            if not block:
+                return False
+            self.wait()
+        start = time.perf_counter()
+        request = snapshot(agent, memory, step, extra)
+        self.idle.clear()
+        self.requests.put(request)
+        self.block_times.append(time.perf_counter() - start)
+        return True
+
+    def wait(self):
+        """Wait until the last checkpoint is on disk."""
+        self.idle.wait()
+        self._raise_error()
+
+    def close(self):
+        """Finish writing the last checkpoint and stop the writing thread."""
+        self.idle.wait()
+        self.requests.put(None)
+        self.thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Writing a checkpoint failed.") from error
+
+    def _write(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            start = time.perf_counter()
+            try:
+                write_checkpoint(self.directory, *request, keep=self.keep)
+            except Exception as error:
+                self.error = error
+            self.write_times.append(time.perf_counter() - start)
+            self.idle.set()
+
+
+def main():
+    # Checkpoint a training run in the background, then resume it and check that it goes on identically
+    import pickle
+    import tempfile
+    from q_network import DQLAgent, PrioritizedReplayBuffer
+    from featurize import stateFeatureLen, NUM_ACTIONS
+    torch.set_num_threads(1)
+    state_size, buffer_size, batch_size = stateFeatureLen(3), 20000, 64
+
+    def make_run():
+        torch.manual_seed(0)
+        agent = DQLAgent(state_size, NUM_ACTIONS, 256, batch_size, 1e-3, 0.9, 1., 0.1, 0.99)
+        memory = PrioritizedReplayBuffer(buffer_size, batch_size, 0, state_size, NUM_ACTIONS)
+        return agent, memory
+
+    def train(agent, memory, steps):
+        for _ in range(steps):
+            batch, weights, indices = memory.sample(tensors=True)
+            memory.update_priorities(indices, agent.train(batch, weights))
+
+    agent, memory = make_run()
+    rng = np.random.default_rng(0)
+    memory.add_batch(rng.random((buffer_size, state_size), dtype=np.float32), rng.integers(0, NUM_ACTIONS, buffer_size),
+                     rng.random(buffer_size), rng.random((buffer_size, state_size), dtype=np.float32),
+                     rng.random(buffer_size) < 0.05, rng.random((buffer_size, NUM_ACTIONS)) < 0.5)
+    replay_bytes = sum(array.nbytes for array in memory.state_dict().values() if isinstance(array, np.ndarray))
+
+    with tempfile.TemporaryDirectory() as directory:
+        checkpointer = Checkpointer(directory)
+        train(agent, memory, 20)
+        start = time.perf_counter()
+        checkpointer.save(agent, memory)
+        steps = 0
+        while not checkpointer.idle.is_set():
+            train(agent, memory, 1)
+            steps += 1
+        background = time.perf_counter() - start
+        checkpointer.close()
+        print(f"Checkpoint of {replay_bytes / 2**20:.0f} MB of replay: training blocked "
+              f"{checkpointer.block_times[0] * 1e3:.0f} ms, written in {checkpointer.write_times[0]:.2f} s "
+              f"in the background ({steps} training steps meanwhile, {background:.2f} s)")
+
+        start = time.perf_counter()
+        with open(os.path.join(directory, "pickle"), "wb") as file:
+            pickle.dump((agent_state_dict(agent), memory.state_dict()), file)
+            file.flush()
+            os.fsync(file.fileno())
+        print(f"Synchronous pickle of the same state: training blocked {time.perf_counter() - start:.2f} s")
+
+        # Resume into a fresh run, and train both identically
+        save_checkpoint(directory, agent, memory)
+        assert checkpoints(directory) == [f"step-{20:012d}", f"step-{agent.train_steps:012d}"]
+        resumed_agent, resumed_memory = make_run()
+        start = time.perf_counter()
+        step, _ = load_checkpoint(latest_checkpoint(directory), resumed_agent, resumed_memory)
+        print(f"Resumed step {step} in {(time.perf_counter() - start) * 1e3:.0f} ms, "
+              f"replay states mapped from disk: {isinstance(resumed_memory.states, np.memmap)}")
+        train(agent, memory, 5)
+        train(resumed_agent, resumed_memory, 5)
+        for network in ("q_network", "target_q_network"):
+            assert all(torch.equal(a, b) for a, b in zip(getattr(agent, network).parameters(),
+                                                         getattr(resumed_agent, network).parameters()))
+        assert np.array_equal(memory.sum_tree.tree, resumed_memory.sum_tree.tree)
+        print("Resumed training matches the original run.")
@@ -0,0 +1,128 @@
+import os
+import copy
+import json
+import torch
+import torch.nn as nn
+from featurize import stateFeatureLen, NUM_ACTIONS
+from policy_runtime import METADATA_NAME
+
+# Export a trained Q-network (e.g. DQLAgent.q_network) for inference on CPU-only hosts,
+# as TorchScript or ONNX, optionally with its linear layers quantized to int8. Exported
+# artifacts are served by policy_runtime.RuntimePolicy, which needs none of the training code.
+
+
+def quantize(q_network):
+    """Return a copy of q_network with dynamic int8 quantization of its linear layers: weights are
+    stored as int8, and activations are quantized on the fly with a per-batch scale."""
+    return torch.ao.quantization.quantize_dynamic(copy.deepcopy(q_network).eval(), {nn.Linear}, dtype=torch.qint8)
+
+
+def export_q_network(q_network, path, num_players=3, quantized=False):
+    """Export a Q-network, with the format given by the extension of path.
+
+    TorchScript (.pt) artifacts are traced and frozen, so weights are folded into the graph.
+    ONNX (.onnx) export needs the onnx package, and onnxruntime to quantize.
+
+    Params
+    ======
+        q_network (nn.Module): the network, e.g. a Q_network or Shared_Q_network
+        path (str): the artifact to write, ending in .pt or .onnx
+        num_players (int): number of players of the games the network was trained on
+        quantized (bool): whether to quantize the linear layers to int8 (see quantize)
+
+    Returns the metadata stored in the artifact.
+    """
+    state_size = stateFeatureLen(num_players)
+    metadata = {"num_players": num_players, "state_size": state_size, "action_size": NUM_ACTIONS,
+                "network_class": type(q_network).__name__, "quantized": quantized}
+    example = torch.zeros(2, state_size)
+    q_network = copy.deepcopy(q_network).eval()
+
+    if path.endswith(".onnx"):
+        import onnx
+        target = path + ".float" if quantized else path
+        torch.onnx.export(q_network, (example,), target, input_names=["states"], output_names=["q_values"],
+                          dynamic_axes={"states": {0: "batch"}, "q_values": {0: "batch"}}, dynamo=False)
+        if quantized:
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+            quantize_dynamic(target, path, weight_type=QuantType.QInt8)
+            os.remove(target)
+        model = onnx.load(path)
+        onnx.helper.set_model_props(model, {METADATA_NAME: json.dumps(metadata)})
+        onnx.save(model, path)
+        return metadata
+
+    if quantized:
+        q_network = quantize(q_network)
+    with torch.no_grad():
+        module = torch.jit.freeze(torch.jit.trace(q_network, example))
+    torch.jit.save(module, path, _extra_files={METADATA_NAME: json.dumps(metadata)})
+    return metadata
+
+
+def main():
+    # Export a network, then compare the latency and greedy actions of eager, TorchScript and int8 inference
+    import time
+    import tempfile
+    import numpy as np
+    from q_network import Q_network
+    from game import GameState
+    from actions import legalActionMasks, legalActions, takeAction
+    from featurize import featurizeGameStates
+    from policy_runtime import RuntimePolicy
+    num_players, hidden_size = 3, 256
+    torch.manual_seed(0)
+    q_network = Q_network(stateFeatureLen(num_players), NUM_ACTIONS, hidden_size).eval()
+
+    # States of random games
+    rng = np.random.default_rng(0)
+    games = []
+    for seed in range(40):
+        game = GameState(num_players, seed=seed)
+        while not game.isOver():
+            games.append(game.clone())
+            moves = legalActions(game)
+            takeAction(game, moves[rng.integers(len(moves))])
+    states = np.empty((len(games), stateFeatureLen(num_players)), dtype=np.float32)
+    masks = np.empty((len(games), NUM_ACTIONS), dtype=bool)
+    featurizeGameStates(games, states)
+    legalActionMasks(games, masks)
+
+    directory = tempfile.mkdtemp()
+    runtimes = {}
+    for name, quantized in [("scripted", False), ("quantized", True)]:
+        path = os.path.join(directory, f"{name}.pt")
+        export_q_network(q_network, path, num_players, quantized)
+        runtimes[name] = RuntimePolicy(path)
+        print(f"{name}: {os.path.getsize(path) / 1024:.0f} KiB")
+    try:
+        path = os.path.join(directory, "quantized.onnx")
+        export_q_network(q_network, path, num_players, quantized=True)
+        runtimes["onnx (int8)"] = RuntimePolicy(path)
+    except ImportError as error:
+        print(f"Skipping ONNX: {error}")
+
+    def eager_act(states, masks):
+        with torch.inference_mode():
+            q_values = q_network(torch.from_numpy(states)).numpy()
+        return np.where(masks, q_values, -np.inf).argmax(axis=1)
+    expected = eager_act(states, masks)
+    assert all(runtimes["scripted"].act(state, mask) == action
+               for state, mask, action in zip(states[:5], masks[:5], expected[:5]))
+    assert np.array_equal(runtimes["scripted"].act_games(games[:64]), expected[:64])
+
+    acts = {"eager": eager_act, **{name: runtime.act for name, runtime in runtimes.items()}}
+    for name, act in acts.items():
+        drift = np.mean(act(states, masks) != expected)
+        timings = []
+        for batch_size in [1, 32, 256]:
+            batch, batch_masks = states[:batch_size], masks[:batch_size]
+            best = np.inf
+            for _ in range(3):
+                repeats = max(2048 // batch_size, 20)
+                start = time.perf_counter()
+                for _ in range(repeats):
+                    act(batch, batch_masks)
+                best = min(best, (time.perf_counter() - start) / repeats)
+            timings.append(f"batch {batch_size}: {best * 1e6:.0f} us")
+        print(f"{name:>12}: {', '.join(timings)}; actions differing from eager on {len(states)} states: {drift:.2%}")
@@ -1,23 +1,27 @@
 import numpy as np
-from game_info import RESOURCES, QUESTS, QUEST_TYPES, DEFAULT_BUILDINGS, Quest, NUM_POSSIBLE_BUILDINGS
+from game_info import (RESOURCES, QUESTS, QUEST_TYPES, DEFAULT_BUILDINGS, Quest, NUM_POSSIBLE_BUILDINGS,
+                       RESOURCE_INDEX, QUEST_INDEX, BUILDING_INDEX)
 from player import Player
 from board import BoardState
 from game import GameState
+from batched_game import BatchedGameState, NUM_AVAILABLE_QUESTS, EMPTY
+from observer import GameObserver
+
+# The resources featurized by featurizeResources for each (includeVP, includeQ)
+FEATURIZED_RESOURCES = {
+    (includeVP, includeQ): [resource for resource in RESOURCES 
+                            if (includeVP or resource != "VP") and (includeQ or resource != "Q")]
+    for includeVP in [False, True] for includeQ in [False, True]
+}
 
 def featurizeResources(resources: dict[str, int], includeVP: bool = False, includeQ: bool = False):
     '''Featurize a resource vector.'''
     # TODO (later): change "includeQVP" to "includeQI"
-    possibleResources = RESOURCES.copy() # All resources, incluidng VP, I, and Q
-    if not includeVP:
-        possibleResources.remove("VP")
-    if not includeQ:
-        possibleResources.remove("Q")
-
     # Each element of the feature vector corresponds to one resource type
-    return np.array([resources.get(resource, 0) for resource in possibleResources])
+    return np.array([resources.get(resource, 0) for resource in FEATURIZED_RESOURCES[(includeVP, includeQ)]])
 
-def featurizeQuest(quest: Quest):
-    '''Featurize a quest.'''
+def buildQuestFeatures(quest: Quest):
+    '''Build the feature vector of a quest from its definition.'''
     # One-hot vector for quest type
     typeVector = (np.array(QUEST_TYPES) == quest.type).astype(int)
 
@@ -26,34 +30,93 @@ def featurizeQuest(quest: Quest):
                       featurizeResources(quest.requirements), 
                       featurizeResources(quest.rewards, includeVP=True, includeQ=True)])
 
+# Since the quest deck is fixed, featurize every quest once.
+# Row i holds the features of QUESTS[i].
+QUEST_FEATURES = np.array([buildQuestFeatures(quest) for quest in QUESTS], dtype=np.float32)
+QUEST_FEATURES.flags.writeable = False
+
 # The length of a quest feature vector (for use in zero-blocks)
-QUEST_FEATURE_LEN = len(featurizeQuest(QUESTS[0]))
+QUEST_FEATURE_LEN = QUEST_FEATURES.shape[1]
+
+# QUEST_FEATURES with an extra row of zeros at the end, so that gathering 
+# with index EMPTY (-1) gives the zero-block of an empty quest slot
+PADDED_QUEST_FEATURES = np.vstack([QUEST_FEATURES, np.zeros(QUEST_FEATURE_LEN, dtype=np.float32)])
+PADDED_QUEST_FEATURES.flags.writeable = False
+
+def featurizeQuest(quest: Quest):
+    '''Featurize a quest.'''
+    return QUEST_FEATURES[QUEST_INDEX[quest.name]]
 
 # Define the maximum number of quests a player can have.
 # This determines the number of quest feature vector blocks 
 # there is room for in the overall feature vectors.
 MAX_QUESTS = 15
 
-def featurizePlayer(player: Player):
-    '''Featurize a player state.'''
-    # One element for number of agents
-    agentsVec = np.array([player.agents,])
+# Layout of a player feature vector: agents, resources, 
+# then MAX_QUESTS active and MAX_QUESTS completed quest blocks
+PLAYER_RESOURCES = FEATURIZED_RESOURCES[(True, False)]
+PLAYER_RESOURCE_COLUMNS = np.array([RESOURCE_INDEX[resource] for resource in PLAYER_RESOURCES])
+PLAYER_QUESTS_OFFSET = 1 + len(PLAYER_RESOURCES)
+PLAYER_FEATURE_LEN = PLAYER_QUESTS_OFFSET + 2 * MAX_QUESTS * QUEST_FEATURE_LEN
+
+def boardFeatureLen(numPlayers: int) -> int:
+    '''The length of a board feature vector for a game with numPlayers players.'''
+    return len(DEFAULT_BUILDINGS) * numPlayers + NUM_AVAILABLE_QUESTS * QUEST_FEATURE_LEN
+
+def stateFeatureLen(numPlayers: int) -> int:
+    '''The length of a game state feature vector for a game with numPlayers players.'''
+    return 1 + boardFeatureLen(numPlayers) + numPlayers * PLAYER_FEATURE_LEN
+
+def questIndices(questIds: list[int], out: np.ndarray):
+    '''Write the first len(out) quest indices into out, padded with EMPTY.'''
+    numQuests = min(len(questIds), len(out))
+    out[:numQuests] = questIds[:numQuests]
+    out[numQuests:] = -1
 
-    # Vector of the player's resources
-    resourceVec = featurizeResources(player.resources, includeVP=True)
+def featurizePlayerBatch(agents: np.ndarray, resources: np.ndarray, 
+                         activeQuests: np.ndarray, completedQuests: np.ndarray,
+                         out: np.ndarray):
+    '''
+    Featurize a batch of player states into a preallocated buffer.
+
+    Args:
+        agents: the (batch,) number of agents of each player.
+        resources: the (batch, len(RESOURCES)) resource counts of each player.
+        activeQuests: the (batch, >= MAX_QUESTS) indices in QUESTS of each 
+            player's active quests, padded with EMPTY (-1).
+        completedQuests: the same, for each player's completed quests.
+        out: the (batch, PLAYER_FEATURE_LEN) float32 buffer to write to.
+    '''
+    out[:, 0] = agents
+    out[:, 1:PLAYER_QUESTS_OFFSET] = resources[:, PLAYER_RESOURCE_COLUMNS]
 
     # TODO (later): Add number of Intrigue cards and plot quests
 
-    # Vector of the player's featurized active/completed quests
-    questFeaturesList = []
-    for playerQuests in [player.activeQuests, player.completedQuests]:
-        for i in range(MAX_QUESTS):
-            if i < len(playerQuests):
-                questFeaturesList.append(featurizeQuest(playerQuests[i]))
-            else:
-                questFeaturesList.append(np.zeros(QUEST_FEATURE_LEN))
+    # Gather the quest blocks straight into the buffer (mode='wrap'
+    # sends EMPTY to the zero row and writes without buffering)
+    questBlocks = out[:, PLAYER_QUESTS_OFFSET:].reshape(len(out), 2, MAX_QUESTS, QUEST_FEATURE_LEN)
+    np.take(PADDED_QUEST_FEATURES, activeQuests[:, :MAX_QUESTS], axis=0, 
+            out=questBlocks[:, 0], mode='wrap')
+    np.take(PADDED_QUEST_FEATURES, completedQuests[:, :MAX_QUESTS], axis=0, 
+            out=questBlocks[:, 1], mode='wrap')
+
+def _fillPlayer(player: Player, out: np.ndarray):
+    '''Featurize a player state into a preallocated PLAYER_FEATURE_LEN buffer.'''
+    out[0] = player.agents
+    for i, resource in enumerate(PLAYER_RESOURCES):
+        out[1 + i] = player.resources.get(resource, 0)
+    questIds = np.empty(2 * MAX_QUESTS, dtype=np.intp)
+    questIndices(player.activeQuestIds, questIds[:MAX_QUESTS])
+    questIndices(player.completedQuestIds, questIds[MAX_QUESTS:])
+    np.take(PADDED_QUEST_FEATURES, questIds, axis=0, mode='wrap',
+            out=out[PLAYER_QUESTS_OFFSET:].reshape(2 * MAX_QUESTS, QUEST_FEATURE_LEN))
 
-    return np.hstack([agentsVec, resourceVec] + questFeaturesList)
+def featurizePlayer(player: Player):
+    '''Featurize a player state.'''
+    # Agents, resources, then the player's featurized active/completed quests
+    features = np.empty(PLAYER_FEATURE_LEN, dtype=np.float32)
+    _fillPlayer(player, features)
+    return features
 
 # TODO (later): uncomment the below and complete
 # def featurizeBuilding(rewards: dict[str,int], ownerRewards: dict[str,int],
@@ -87,33 +150,373 @@ def featurizePlayer(player: Player):
 #     # put unbuilt rewards as one rounds worth? or 1.5 or 1.25 or something?
 #     raise Exception("Not yet implemented.")
 
-def featurizeBoardState(boardState: BoardState, playerNames: list[str]):
-    '''Featurize the state of the game board (but not the players).'''
+def featurizeBoardStateBatch(buildingStates: np.ndarray, availableQuests: np.ndarray,
+                             numPlayers: int, out: np.ndarray, 
+                             questFeatures: np.ndarray = PADDED_QUEST_FEATURES):
+    '''
+    Featurize a batch of board states into a preallocated buffer.
+
+    Args:
+        buildingStates: the (batch, len(DEFAULT_BUILDINGS)) index of the player
+            occupying each building, EMPTY (-1) when unoccupied.
+        availableQuests: the (batch, NUM_AVAILABLE_QUESTS) indices in QUESTS of
+            the quests available at Cliffwatch Inn, padded with EMPTY.
+        numPlayers: the number of players in each game.
+        out: the (batch, boardFeatureLen(numPlayers)) float32 buffer to write to.
+        questFeatures (optional): the feature table that availableQuests index into.
+    '''
     # Concatendated one-hot vectors for building occupations by player
-    buildingStateList = []
-    for building in DEFAULT_BUILDINGS:
-        buildingStateVec = np.array(playerNames) == boardState.buildingStates[building]
-        buildingStateList.append(buildingStateVec.astype(int))
-    buildingFeatures = np.hstack(buildingStateList)
+    numBuildingFeatures = len(DEFAULT_BUILDINGS) * numPlayers
+    buildingFeatures = out[:, :numBuildingFeatures].reshape(len(out), len(DEFAULT_BUILDINGS), numPlayers)
+    np.equal(buildingStates[:, :, None], np.arange(numPlayers), out=buildingFeatures)
 
     # TODO (later): do the same but for all possible building spots
 
-    availableQuestFeatures = np.hstack([featurizeQuest(quest) for quest in boardState.availableQuests])
+    questBlocks = out[:, numBuildingFeatures:].reshape(len(out), NUM_AVAILABLE_QUESTS, QUEST_FEATURE_LEN)
+    np.take(questFeatures, availableQuests, axis=0, out=questBlocks, mode='wrap')
 
     # TODO (later): put featurized available buildings (i.e. to build) here
 
-    return np.append(buildingFeatures, availableQuestFeatures)
+def _fillBoardState(boardState: BoardState, playerNames: list[str], out: np.ndarray):
+    '''Featurize a board state into a preallocated boardFeatureLen buffer.'''
+    numPlayers = len(playerNames)
+    out[:len(DEFAULT_BUILDINGS) * numPlayers] = 0
+    for b, occupant in enumerate(boardState.occupancy):
+        if occupant != EMPTY:
+            out[b * numPlayers + occupant] = 1
+    questIds = np.empty(NUM_AVAILABLE_QUESTS, dtype=np.intp)
+    questIndices(boardState.availableQuestIds, questIds)
+    np.take(PADDED_QUEST_FEATURES, questIds, axis=0, mode='wrap',
+            out=out[len(DEFAULT_BUILDINGS) * numPlayers:].reshape(NUM_AVAILABLE_QUESTS, QUEST_FEATURE_LEN))
+
+def featurizeBoardState(boardState: BoardState, playerNames: list[str]):
+    '''Featurize the state of the game board (but not the players).'''
+    features = np.empty(boardFeatureLen(len(playerNames)), dtype=np.float32)
+    _fillBoardState(boardState, playerNames, features)
+    return features
+
+def _fillGameState(gameState: GameState, out: np.ndarray):
+    '''Featurize a game state into a preallocated stateFeatureLen buffer.'''
+    out[0] = gameState.roundsLeft
+    boardEnd = 1 + boardFeatureLen(gameState.numPlayers)
+    _fillBoardState(gameState.boardState, gameState.playerNames, out[1:boardEnd])
+
+    # Featurize players in turn order.
+    for i, player in enumerate(gameState.players):
+        start = boardEnd + i * PLAYER_FEATURE_LEN
+        _fillPlayer(player, out[start:start + PLAYER_FEATURE_LEN])
+    # TODO: Check if there is anything else that needs to be included as a feature.
 
 def featurizeGameState(gameState: GameState):
     '''Featurize the game state.'''
-    numRoundsLeftArr = np.array([gameState.roundsLeft,])
-    boardStateFeatures = featurizeBoardState(gameState.boardState, gameState.playerNames)
+    features = np.empty(stateFeatureLen(gameState.numPlayers), dtype=np.float32)
+    _fillGameState(gameState, features)
+    return features
+
+def featurizeGameStates(gameStates: list[GameState], out: np.ndarray):
+    '''
+    Featurize a batch of game states into a preallocated buffer.
+
+    Args:
+        gameStates: the game states, all with the same number of players.
+        out: the (len(gameStates), stateFeatureLen(numPlayers)) float32 
+            buffer to write to.
+    '''
+    for gameState, row in zip(gameStates, out):
+        _fillGameState(gameState, row)
+
+def featurizeGameStateBatch(batch: BatchedGameState, out: np.ndarray, games: np.ndarray = None):
+    '''
+    Featurize the games of a BatchedGameState into a preallocated 
+    buffer, with the same layout as featurizeGameState.
+
+    Args:
+        batch: the batched game states.
+        out: the (len(games), stateFeatureLen(batch.numPlayers)) float32 
+            buffer to write to.
+        games (optional): the indices of the games to featurize.
+            Defaults to all games.
+    '''
+    if games is None:
+        games = np.arange(batch.numGames)
+    out[:, 0] = batch.roundsLeft[games]
+    boardEnd = 1 + boardFeatureLen(batch.numPlayers)
+    featurizeBoardStateBatch(batch.buildingStates[games], batch.availableQuests[games], 
+                             batch.numPlayers, out[:, 1:boardEnd])
 
     # Featurize players in turn order.
-    playerFeatures = [featurizePlayer(player) for player in gameState.players]
-    # TODO: Check if there is anything else that needs to be included as a feature.
-    
-    return np.hstack([numRoundsLeftArr, boardStateFeatures] + playerFeatures)
+    for position in range(batch.numPlayers):
+        players = batch.turnOrder[games, position]
+        start = boardEnd + position * PLAYER_FEATURE_LEN
+        featurizePlayerBatch(batch.agents[games, players], batch.resources[games, players],
+                             batch.activeQuests[games, players], batch.completedQuests[games, players],
+                             out[:, start:start + PLAYER_FEATURE_LEN])
+
+def rotatePlayers(states: np.ndarray, numPlayers: int, positions: np.ndarray) -> np.ndarray:
+    '''
+    Reorder the player blocks of featurized states as if it were
+    the turn of another player, keeping the turn order.
+
+    Args:
+        states: the (batch, stateFeatureLen(numPlayers)) featurized states.
+        numPlayers: the number of players in each game.
+        positions: the position in the turn order of the player
+            to put first in each state.
+
+    Returns:
+        the reordered states.
+    '''
+    n = len(states)
+    boardEnd = 1 + boardFeatureLen(numPlayers)
+    order = (np.asarray(positions)[:, None] + np.arange(numPlayers)) % numPlayers
+    out = states.copy()
+    out[:, boardEnd:] = np.take_along_axis(
+        states[:, boardEnd:].reshape(n, numPlayers, PLAYER_FEATURE_LEN), order[:, :, None], axis=1).reshape(n, -1)
+    return out
+
+# Compact encoding of featurized states, for storage (see encodeStates). Every feature 
+# is a small non-negative integer, and most of a state is quest blocks, so each state is
+# stored as uint8 codes: roundsLeft, the occupant of each building (as an index in 
+# playerNames), the available quests, then for each player in turn order their agents, 
+# resources and active/completed quests. Quests are stored as indices in QUESTS, and 
+# EMPTY buildings and quest slots as 255 (i.e. EMPTY cast to uint8).
+ENCODED_EMPTY = 255
+ENCODED_PLAYER_LEN = PLAYER_QUESTS_OFFSET + 2 * MAX_QUESTS
+
+def encodedStateLen(numPlayers: int) -> int:
+    '''The length of an encoded state for a game with numPlayers players.'''
+    return 1 + len(DEFAULT_BUILDINGS) + NUM_AVAILABLE_QUESTS + numPlayers * ENCODED_PLAYER_LEN
+
+# The quest block of each code (zeros for ENCODED_EMPTY and other non-quest codes)
+CODE_QUEST_FEATURES = np.zeros((256, QUEST_FEATURE_LEN), dtype=np.float32)
+CODE_QUEST_FEATURES[:len(QUESTS)] = QUEST_FEATURES
+CODE_QUEST_FEATURES.flags.writeable = False
+
+# Quest blocks are matched to their codes exactly, by reading their (small, integer)
+# features as the digits of an integer key in base _QUEST_KEY_BASE
+_QUEST_KEY_BASE = int(QUEST_FEATURES.max()) + 1
+assert np.array_equal(QUEST_FEATURES, QUEST_FEATURES.astype(np.int64)) and _QUEST_KEY_BASE ** QUEST_FEATURE_LEN < 2**63
+_QUEST_KEY_DIGITS = _QUEST_KEY_BASE ** np.arange(QUEST_FEATURE_LEN, dtype=np.int64)
+_questKeys = np.append(QUEST_FEATURES.astype(np.int64) @ _QUEST_KEY_DIGITS, 0)
+_QUEST_KEY_ORDER = np.argsort(_questKeys)
+_SORTED_QUEST_KEYS = _questKeys[_QUEST_KEY_ORDER]
+_SORTED_QUEST_CODES = np.append(np.arange(len(QUESTS)), ENCODED_EMPTY).astype(np.uint8)[_QUEST_KEY_ORDER]
+assert len(np.unique(_SORTED_QUEST_KEYS)) == len(QUESTS) + 1
+
+def _questCodes(questBlocks: np.ndarray, out: np.ndarray) -> bool:
+    '''
+    Write the code of each (..., QUEST_FEATURE_LEN) quest block into out.
+    Returns whether every block is a quest's features or a zero-block.
+    '''
+    keys = questBlocks.astype(np.int64) @ _QUEST_KEY_DIGITS
+    positions = np.minimum(np.searchsorted(_SORTED_QUEST_KEYS, keys), len(_SORTED_QUEST_KEYS) - 1)
+    out[...] = _SORTED_QUEST_CODES[positions]
+    return np.array_equal(_SORTED_QUEST_KEYS[positions], keys)
+
+def encodeStates(states: np.ndarray, numPlayers: int, out: np.ndarray = None) -> np.ndarray:
+    '''
+    Encode featurized states as uint8 codes (see encodedStateLen).
+    The other features must be integers in [0, 255], which is not 
+    checked. Raises a ValueError if a quest block is not a quest.
+
+    Args:
+        states: the (batch, stateFeatureLen(numPlayers)) featurized states.
+        numPlayers: the number of players in each game.
+        out (optional): the (batch, encodedStateLen(numPlayers)) uint8 buffer to write to.
+
+    Returns:
+        the encoded states.
+    '''
+    n = len(states)
+    if out is None:
+        out = np.empty((n, encodedStateLen(numPlayers)), dtype=np.uint8)
+    numBuildings = len(DEFAULT_BUILDINGS)
+    boardEnd = 1 + boardFeatureLen(numPlayers)
+    np.copyto(out[:, 0], states[:, 0], casting='unsafe')
+
+    occupants = states[:, 1:1 + numBuildings * numPlayers].reshape(n, numBuildings, numPlayers)
+    out[:, 1:1 + numBuildings] = np.where(occupants.any(axis=2), occupants.argmax(axis=2), ENCODED_EMPTY)
+    questStart = 1 + numBuildings * numPlayers
+    matched = _questCodes(states[:, questStart:boardEnd].reshape(n, NUM_AVAILABLE_QUESTS, QUEST_FEATURE_LEN),
+                          out[:, 1 + numBuildings:1 + numBuildings + NUM_AVAILABLE_QUESTS])
+
+    players = states[:, boardEnd:].reshape(n, numPlayers, PLAYER_FEATURE_LEN)
+    encodedPlayers = out[:, 1 + numBuildings + NUM_AVAILABLE_QUESTS:].reshape(n, numPlayers, ENCODED_PLAYER_LEN)
+    np.copyto(encodedPlayers[:, :, :PLAYER_QUESTS_OFFSET], players[:, :, :PLAYER_QUESTS_OFFSET], casting='unsafe')
+    matched &= _questCodes(players[:, :, PLAYER_QUESTS_OFFSET:].reshape(n, numPlayers, 2 * MAX_QUESTS, QUEST_FEATURE_LEN),
+                           encodedPlayers[:, :, PLAYER_QUESTS_OFFSET:])
+    if not matched:
+        raise ValueError("Can only encode states whose quest blocks are featurized quests.")
+    return out
+
+def decodeStates(codes: np.ndarray, numPlayers: int, out: np.ndarray = None) -> np.ndarray:
+    '''
+    Decode states encoded by encodeStates back to featurized states.
+
+    Args:
+        codes: the (batch, encodedStateLen(numPlayers)) uint8 encoded states.
+        numPlayers: the number of players in each game.
+        out (optional): the (batch, stateFeatureLen(numPlayers)) float32 buffer to write to.
+
+    Returns:
+        the featurized states.
+    '''
+    n = len(codes)
+    if out is None:
+        out = np.empty((n, stateFeatureLen(numPlayers)), dtype=np.float32)
+    numBuildings = len(DEFAULT_BUILDINGS)
+    boardEnd = 1 + boardFeatureLen(numPlayers)
+    out[:, 0] = codes[:, 0]
+    questStart = 1 + numBuildings
+    featurizeBoardStateBatch(codes[:, 1:questStart], codes[:, questStart:questStart + NUM_AVAILABLE_QUESTS],
+                             numPlayers, out[:, 1:boardEnd], CODE_QUEST_FEATURES)
+
+    encodedPlayers = codes[:, 1 + numBuildings + NUM_AVAILABLE_QUESTS:].reshape(n, numPlayers, ENCODED_PLAYER_LEN)
+    players = out[:, boardEnd:].reshape(n, numPlayers, PLAYER_FEATURE_LEN)
+    players[:, :, :PLAYER_QUESTS_OFFSET] = encodedPlayers[:, :, :PLAYER_QUESTS_OFFSET]
+    np.take(CODE_QUEST_FEATURES, encodedPlayers[:, :, PLAYER_QUESTS_OFFSET:], axis=0, mode='clip',
+            out=players[:, :, PLAYER_QUESTS_OFFSET:].reshape(n, numPlayers, 2 * MAX_QUESTS, QUEST_FEATURE_LEN))
+    return out
+
+class LiveFeatures(GameObserver):
+    '''
+    The feature vector of a GameState (as given by featurizeGameState), 
+    kept up to date by patching only the entries that each mutation of 
+    the game, board or players affects.
+
+    Players are featurized in turn order, so one copy of the vector is 
+    kept per rotation of the turn order. Passing the turn then only 
+    switches which copy is exposed, and reading the features never copies.
+    '''
+    def __init__(self, gameState: GameState, check: bool = False):
+        '''
+        Featurize the game state once and start following its mutations.
+
+        Args:
+            gameState: the game state to featurize.
+            check: whether to compare the live features against 
+                featurizeGameState every time they are read (slow).
+        '''
+        self.gameState = gameState
+        self.check = check
+        self._build()
+        gameState.observers += (self,)
+        gameState.boardState.observers += (self,)
+        for player in gameState.players:
+            player.observers += (self,)
+
+    def detach(self):
+        '''Stop following the game state.'''
+        for observed in [self.gameState, self.gameState.boardState, *self.gameState.players]:
+            observed.observers = tuple(observer for observer in observed.observers
+                                       if observer is not self)
+
+    def _build(self):
+        '''Featurize the game state from scratch, with the current turn order as rotation 0.'''
+        gameState = self.gameState
+        numPlayers = gameState.numPlayers
+        self._boardEnd = 1 + boardFeatureLen(numPlayers)
+        self._seats = {player.name: seat for seat, player in enumerate(gameState.players)}
+        self._rows = np.empty((numPlayers, stateFeatureLen(numPlayers)), dtype=np.float32)
+        _fillGameState(gameState, self._rows[0])
+        playerBlocks = self._rows[0, self._boardEnd:].reshape(numPlayers, PLAYER_FEATURE_LEN)
+        for rotation in range(1, numPlayers):
+            self._rows[rotation, :self._boardEnd] = self._rows[0, :self._boardEnd]
+            self._rows[rotation, self._boardEnd:] = np.roll(playerBlocks, -rotation, axis=0).ravel()
+        self._rotation = 0
+
+        # Start of each seat's player block in each rotation
+        rotations = np.arange(numPlayers)
+        self._rowIndex = rotations[:, None]
+        self._seatStarts = [(self._boardEnd + (seat - rotations) % numPlayers * PLAYER_FEATURE_LEN)[:, None]
+                            for seat in range(numPlayers)]
+
+        # Read-only views to hand out
+        self._views = [row.view() for row in self._rows]
+        for view in self._views:
+            view.flags.writeable = False
+
+    @property
+    def features(self) -> np.ndarray:
+        '''The current (read-only) feature vector of the game state.'''
+        if self.check:
+            self.verify()
+        return self._views[self._rotation]
+
+    def verify(self):
+        '''Check the live features against featurizeGameState.'''
+        expected = featurizeGameState(self.gameState)
+        mismatches = np.flatnonzero(self._views[self._rotation] != expected)
+        if len(mismatches) > 0:
+            raise AssertionError(f"Live features differ from featurizeGameState at {mismatches}.")
+
+    def _writePlayer(self, player: Player, start: int, values: np.ndarray):
+        '''Write values at offset start of a player's block, in every rotation.'''
+        columns = self._seatStarts[self._seats[player.name]] + start + np.arange(len(values))
+        self._rows[self._rowIndex, columns] = values
+
+    def resourceChanged(self, player, resource, oldNumber):
+        if resource in PLAYER_RESOURCES:
+            self._writePlayer(player, 1 + PLAYER_RESOURCES.index(resource), 
+                              [player.resources[resource]])
+
+    def agentsChanged(self, player, oldAgents):
+        self._writePlayer(player, 0, [player.agents])
+
+    def questGained(self, player, quest):
+        slot = len(player.activeQuestIds) - 1
+        if slot < MAX_QUESTS:
+            self._writePlayer(player, PLAYER_QUESTS_OFFSET + slot * QUEST_FEATURE_LEN, 
+                              featurizeQuest(quest))
+
+    def questCompleted(self, player, quest, slot):
+        # Later active quests shift down one block
+        if slot < MAX_QUESTS:
+            questIds = np.empty(MAX_QUESTS - slot, dtype=np.intp)
+            questIndices(player.activeQuestIds[slot:], questIds)
+            self._writePlayer(player, PLAYER_QUESTS_OFFSET + slot * QUEST_FEATURE_LEN,
+                              PADDED_QUEST_FEATURES.take(questIds, axis=0, mode='wrap').ravel())
+        completedSlot = len(player.completedQuestIds) - 1
+        if completedSlot < MAX_QUESTS:
+            self._writePlayer(player, PLAYER_QUESTS_OFFSET + (MAX_QUESTS + completedSlot) * QUEST_FEATURE_LEN,
+                              featurizeQuest(quest))
+
+    def buildingChanged(self, boardState, building, oldState):
+        playerNames = self.gameState.playerNames
+        start = 1 + DEFAULT_BUILDINGS.index(building) * len(playerNames)
+        occupant = boardState.occupancy[BUILDING_INDEX[building]]
+        self._rows[:, start:start + len(playerNames)] = 0
+        if occupant != EMPTY:
+            self._rows[:, start + occupant] = 1
+
+    def availableQuestsChanged(self, boardState, oldQuests):
+        start = 1 + len(DEFAULT_BUILDINGS) * self.gameState.numPlayers
+        _fillBoardState(boardState, self.gameState.playerNames, self._rows[0, 1:self._boardEnd])
+        self._rows[1:, start:self._boardEnd] = self._rows[0, start:self._boardEnd]
+
+    def roundsLeftChanged(self, gameState, oldRoundsLeft):
+        self._rows[:, 0] = gameState.roundsLeft
+
+    def turnOrderChanged(self, gameState, oldPlayers):
+        numPlayers = gameState.numPlayers
+        rotation = self._seats[gameState.players[0].name]
+        if all(self._seats[player.name] == (rotation + i) % numPlayers 
+               for i, player in enumerate(gameState.players)):
+            self._rotation = rotation
+        else:
+            # Not a rotation of the turn order, so start over
+            self._build()
+
+    def stateRestored(self, gameState):
+        self._build()
+
+# Layout of action vectors (and of Q-network outputs, see featurizeAction):
+# one action per quest available at Cliffwatch Inn, one per building 
+# space, and one per active quest slot to complete
+QUEST_SLOT_ACTIONS = 0
+BUILDING_ACTIONS = QUEST_SLOT_ACTIONS + NUM_AVAILABLE_QUESTS
+COMPLETE_ACTIONS = BUILDING_ACTIONS + NUM_POSSIBLE_BUILDINGS
+NUM_ACTIONS = COMPLETE_ACTIONS + MAX_QUESTS
 
 def featurizeAction(gameState: GameState, action: str):
     # The first four elements of the action feature vector 
@@ -164,4 +567,26 @@ def featurizeAction(gameState: GameState, action: str):
 def main():
     # Test the quest featurization
     quest = QUESTS[np.random.randint(len(QUESTS))]
-    print(quest, featurizeQuest(quest))
\ No newline at end of file
+    print(quest, featurizeQuest(quest))
+    assert np.array_equal(featurizeQuest(quest), buildQuestFeatures(quest))
+    # Test that encoded states decode back to the same features
+    from random import choice
+    from actions import legalActions, takeAction
+    for numPlayers in [2, 3, 4, 5]:
+        gameState = GameState(numPlayers)
+        states = []
+        while not gameState.isOver():
+            states.append(featurizeGameState(gameState))
+            takeAction(gameState, choice(legalActions(gameState)))
+        states = np.array(states)
+        codes = encodeStates(states, numPlayers)
+        assert np.array_equal(decodeStates(codes, numPlayers), states)
+        # A quest block which is no quest can't be encoded
+        states[-1, -QUEST_FEATURE_LEN] += 1
+        try:
+            encodeStates(states, numPlayers)
+            raise AssertionError("A state with an unknown quest block was encoded.")
+        except ValueError:
+            states[-1, -QUEST_FEATURE_LEN] -= 1
+        print(f"{numPlayers} players: {states.nbytes // len(states)} bytes/state as float32, "
+              f"{codes.nbytes // len(codes)} bytes/state encoded")
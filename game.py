@@ -1,5 +1,7 @@
-from random import shuffle
-from game_info import Quest, LORD_CARDS, agentsPerPlayer
+import logging
+from random import Random, choice, getrandbits
+from array import array
+from game_info import Quest, LORD_CARDS, BUILDING_REWARDS, agentsPerPlayer
 from player import Player
 from board import BoardState
 
@@ -8,6 +10,11 @@ from board import BoardState
 # the players, while those other classes handle either only the game state
 # itself or only the players themselves (to the extent possible).
 
+# Per-game details (e.g. the lord cards dealt) are logged at DEBUG level, so
+# that workers playing many games stay quiet unless asked, e.g. with
+# logging.getLogger("game").setLevel(logging.DEBUG)
+logger = logging.getLogger(__name__)
+
 class GameState():
     '''
     Class to control the flow of the game, 
@@ -15,7 +22,7 @@ class GameState():
     options. 
     '''
     def __init__(self, numPlayers: int = 3, numRounds: int = 8, 
-                 playerNames = None):
+                 playerNames = None, seed: int = None):
         '''
         Initialize the game state and players.
 
@@ -23,12 +30,22 @@ class GameState():
             numPlayers: the number of players in the game
             numRounds: the number of rounds in the game
             playerNames (optional): the names for each player
+            seed (optional): the seed of all shuffles in the game, drawn
+                from the random module if not given. A game is determined 
+                by its seed and the actions taken (see trajectory.py).
         '''
+        self.seed = getrandbits(32) if seed is None else seed
+        rng = Random(self.seed)
+
         # Initialize the remaining number of rounds
         self.roundsLeft = numRounds
 
-        # Initialize the BoardState
-        self.boardState = BoardState()
+        # Observers (see observer.GameObserver) notified of each change
+        self.observers = ()
+
+        # Whether the current player has placed their agent this 
+        # turn and still has to choose a quest to complete
+        self.completingQuest = False
 
         # Check that we have a valid number of players
         assert numPlayers >= 2 and numPlayers <= 5
@@ -42,24 +59,25 @@ class GameState():
                 "PlayerThree", "PlayerFour",
                 "PlayerFive"
             ][:numPlayers]
+
+        # Initialize the BoardState
+        self.boardState = BoardState(self.playerNames, rng)
         
         # Shuffle the lord cards
         shuffled_lord_cards = LORD_CARDS.copy()
-        print(shuffled_lord_cards[:5])
-        shuffle(shuffled_lord_cards)
-        print(shuffled_lord_cards[:5])
+        rng.shuffle(shuffled_lord_cards)
+        logger.debug("Game %d: lord cards %s", self.seed, shuffled_lord_cards[:numPlayers])
 
         # Initialize the players
         self.players = []
         for i in range(numPlayers):
-            print(shuffled_lord_cards[i])
             self.players.append(Player(self.playerNames[i], agentsPerPlayer(numPlayers),
                                        shuffled_lord_cards[i]))
 
         # This is not only a list of players, but 
         # also represents the turn order. It will 
         # be reordered each turn.
-        shuffle(self.players)
+        rng.shuffle(self.players)
 
         # Deal quest cards to players
         for _ in range(2):
@@ -78,6 +96,8 @@ class GameState():
     def newRound(self):
         '''Reset the board at the beginning of each round.'''
         self.roundsLeft -= 1
+        for observer in self.observers:
+            observer.roundsLeftChanged(self, self.roundsLeft + 1)
         # TODO (later version): put VPs on buildings at bulider's hall
 
         # Reset all buildings
@@ -94,28 +114,137 @@ class GameState():
         for player in self.players:
             player.returnAgents()
 
+    def placeAgent(self, building: str, questSlot: int = 0):
+        '''
+        Place one of the current player's agents at a building 
+        and give the player that building's rewards.
+
+        Args:
+            building: the building to place the agent at.
+            questSlot: the available quest to take when the 
+                building is Cliffwatch Inn.
+        '''
+        currentPlayer = self.players[0]
+        if self.boardState.isOccupied(building):
+            raise ValueError("This building is already occupied.")
+        currentPlayer.placeAgent()
+        self.boardState.occupyBuilding(building, currentPlayer.name)
+
+        for resource, number in BUILDING_REWARDS[building].items():
+            if resource == "Q":
+                for _ in range(number):
+                    currentPlayer.getQuest(self.boardState.takeQuest(questSlot))
+            else:
+                currentPlayer.getResource(resource, number)
+
+    def canPlaceAgent(self) -> bool:
+        '''
+        Return whether the current player has an agent left and a 
+        building to place it at. Cliffwatch Inn only counts while it
+        has quests available: once the quest stack is exhausted, its
+        slots run out (see BoardState.takeQuest).
+        '''
+        if self.players[0].agents <= 0:
+            return False
+        return any(building != "Quest" or self.boardState.availableQuestIds
+                   for building in self.boardState.unoccupiedBuildings())
+
+    def endTurn(self):
+        '''
+        Pass the turn to the next player in the turn order, and 
+        start a new round once they cannot place an agent.
+        '''
+        oldPlayers = self.players
+        self.players = self.players[1:] + self.players[:1]
+        for observer in self.observers:
+            observer.turnOrderChanged(self, oldPlayers)
+        if not self.canPlaceAgent():
+            self.newRound()
+
+    def isOver(self) -> bool:
+        '''Return whether all rounds of the game have been played.'''
+        return self.roundsLeft <= 0
+
+    def clone(self) -> "GameState":
+        '''
+        Return a copy of the game for lookahead search, without its
+        observers. Only the mutable state of the board and players is
+        copied: quests, lord cards and player names are shared.
+        '''
+        other = GameState.__new__(GameState)
+        other.seed = self.seed
+        other.roundsLeft = self.roundsLeft
+        other.observers = ()
+        other.completingQuest = self.completingQuest
+        other.numPlayers = self.numPlayers
+        other.playerNames = self.playerNames
+        other.boardState = self.boardState.clone()
+        other.players = [player.clone() for player in self.players]
+        return other
+
+    def snapshot(self, out: array = None) -> array:
+        '''
+        Save the mutable state of the game, board and players into a
+        flat integer array, which restore can later go back to.
+
+        Args:
+            out (optional): an array to reuse for the snapshot.
+
+        Returns:
+            the snapshot.
+        '''
+        if out is None:
+            out = array("i")
+        else:
+            del out[:]
+        out.append(self.roundsLeft)
+        out.append(self.completingQuest)
+        # Turn order as indices in playerNames, then each player in that order
+        out.fromlist([self.playerNames.index(player.name) for player in self.players])
+        self.boardState.snapshot(out)
+        for player in self.players:
+            player.snapshot(out)
+        return out
+
+    def restore(self, snapshot: array):
+        '''
+        Go back to the state saved by snapshot, in place (e.g. to undo
+        moves during search). Observers are notified with stateRestored.
+
+        Args:
+            snapshot: an array returned by self.snapshot, or by
+                the snapshot of a clone of this game.
+        '''
+        self.roundsLeft = snapshot[0]
+        self.completingQuest = bool(snapshot[1])
+        seats = {self.playerNames.index(player.name): player for player in self.players}
+        self.players = [seats[seat] for seat in snapshot[2:2 + self.numPlayers]]
+        offset = self.boardState.restore(snapshot, 2 + self.numPlayers)
+        for player in self.players:
+            offset = player.restore(snapshot, offset)
+        for observer in self.observers:
+            observer.stateRestored(self)
+
     def takeTurn(self):
         '''Take a single turn in the turn order.'''
-        # TODO: Implement 
+        # Imported here since actions.py builds on this module
+        from actions import legalActions, takeAction
         currentPlayer = self.players[0]
-        possibleMoves = [] # Fill this 
-        move = currentPlayer.selectMove(possibleMoves) # Implement this
-        # Execute this move. Maybe have a different function for 
-        # selecting a building to play at vs other sub-selections
-        # such as a quest to complete or an intrigue card to play?
 
-        # Reorder turn order to show that the player has moved.
-        self.players = self.players[1:] + currentPlayer
+        # A turn is one or two moves (see actions.py): placing an agent, 
+        # then possibly completing a quest. takeAction passes the turn on
+        # to the next player once it is over.
+        while self.players[0] is currentPlayer and not self.isOver():
+            possibleMoves = legalActions(self)
+            move = currentPlayer.selectMove(self, possibleMoves)
+            takeAction(self, move)
 
     def runGame(self):
         '''Umbrella function to run the game.'''
-        while self.roundsLeft > 0:
-            # Keep looping until a player runs out of agents
-            while self.players[0].agents >= 0:
-                self.takeTurn()
-
-            # TODO (later): reorder the players if one of them picked up the castle.
-            self.newRound()
+        # New rounds start (in endTurn) once no more agents can be placed
+        # TODO (later): reorder the players if one of them picked up the castle.
+        while not self.isOver():
+            self.takeTurn()
 
     def displayGame(self) -> None:
         '''Display the state of the game and players.'''
@@ -127,5 +256,41 @@ class GameState():
         
 
 def main():
-    # Test gameState
-    pass 
\ No newline at end of file
+    # Test that undoing every move with snapshot/restore,
+    # and replaying it on a clone, give back the same game
+    from copy import deepcopy
+    from timeit import timeit
+    from actions import legalActions, takeAction
+    from featurize import LiveFeatures
+    for _ in range(20):
+        gameState = GameState()
+        live = LiveFeatures(gameState, check=True)
+        while not gameState.isOver():
+            move = choice(legalActions(gameState))
+            before = gameState.snapshot()
+            other = gameState.clone()
+            takeAction(gameState, move)
+            after = gameState.snapshot()
+            gameState.restore(before)
+            assert gameState.snapshot() == before
+            live.features
+            takeAction(gameState, move)
+            takeAction(other, move)
+            assert gameState.snapshot() == after == other.snapshot()
+            live.features
+    print("snapshot/restore and clone match on 20 games.")
+    live.detach()
+
+    snapshot = gameState.snapshot()
+    for name, copy in [("deepcopy", lambda: deepcopy(gameState)),
+                       ("clone", gameState.clone),
+                       ("snapshot", lambda: gameState.snapshot(snapshot)),
+                       ("restore", lambda: gameState.restore(snapshot))]:
+        print(f"{name}: {timeit(copy, number=2000) / 2000 * 1e6:.1f}us")
+    # Play games long enough to exhaust the quest stack: once Cliffwatch Inn
+    # runs out of quests, rounds end when the other buildings are full
+    for _ in range(20):
+        gameState = GameState(numRounds=40)
+        gameState.runGame()
+        assert gameState.isOver() and not gameState.boardState.questStackIds
+    print("Games of 40 rounds outlast the quest stack.")
@@ -1,4 +1,5 @@
 from collections import namedtuple
+import numpy as np
 
 # Define resources
 RESOURCES = [
@@ -50,6 +51,32 @@ for i,type1 in enumerate(QUEST_TYPES):
         ))
 
 
+# Index of each resource and quest in the array-based game representations
+RESOURCE_INDEX = {resource: i for i, resource in enumerate(RESOURCES)}
+QUEST_INDEX = {quest.name: i for i, quest in enumerate(QUESTS)}
+
+def resourceMatrix(resourceDicts: list[dict[str, int]]):
+    '''
+    Stack resource dictionaries into an integer matrix
+    with one column per entry of RESOURCES.
+
+    Args:
+        resourceDicts: the resource dictionaries, one per row.
+
+    Returns:
+        the (len(resourceDicts), len(RESOURCES)) resource matrix.
+    '''
+    matrix = np.zeros((len(resourceDicts), len(RESOURCES)), dtype=np.int32)
+    for i, resourceDict in enumerate(resourceDicts):
+        for resource, number in resourceDict.items():
+            matrix[i, RESOURCE_INDEX[resource]] = number
+    return matrix
+
+# Requirements and rewards of every quest, indexed by position in QUESTS
+QUEST_REQUIREMENTS = resourceMatrix([quest.requirements for quest in QUESTS])
+QUEST_REWARDS = resourceMatrix([quest.rewards for quest in QUESTS])
+
+
 # Define number of agents per player as a function of number of players
 def agentsPerPlayer(numPlayers: int):
     '''
@@ -79,6 +106,20 @@ for i,type1 in enumerate(QUEST_TYPES):
 # LORD_CARDS.append("Buildings")
 
 
+# Weight of each resource in Player.score, the score used to train
+# RL agents: cubes and gold count as the moves it takes to collect them
+SCORE_WEIGHTS = {"VP": 1.}
+for resource, number in zip(QUEST_TYPE_RESOURCES, ONE_MOVE_RESOURCES):
+    SCORE_WEIGHTS[resource] = 1. / number
+SCORE_WEIGHT_VECTOR = np.array([SCORE_WEIGHTS.get(resource, 0.) for resource in RESOURCES])
+
+# Score bonus for each completed quest of a type on the player's lord card.
+# LORD_QUEST_BONUS[l, t] is the bonus of LORD_CARDS[l] for QUEST_TYPES[t].
+LORD_BONUS = 4
+LORD_QUEST_BONUS = np.array([[LORD_BONUS if questType in lordCard else 0 for questType in QUEST_TYPES]
+                             for lordCard in LORD_CARDS], dtype=np.float64)
+
+
 # Define all buildings
 DEFAULT_BUILDINGS = [ 
     # TODO: Temporary 3 cliffwatch spaces should all give 2 gold?
@@ -103,6 +144,18 @@ DEFAULT_BUILDINGS = [
 # TODO (later): change the below to add all empty building slots
 NUM_POSSIBLE_BUILDINGS = len(DEFAULT_BUILDINGS)
 
+# Index of each building in the array-based game representations
+BUILDING_INDEX = {building: i for i, building in enumerate(DEFAULT_BUILDINGS)}
+
+# Define what a player receives for placing an agent at each building.
+# Each resource building gives as many cubes as one move's worth of
+# quest requirements, and Cliffwatch Inn gives one of its available quests.
+BUILDING_REWARDS = {resource: {resource: number} for resource, number
+                    in zip(QUEST_TYPE_RESOURCES, ONE_MOVE_RESOURCES)}
+BUILDING_REWARDS["Quest"] = {"Q": 1}
+BUILDING_REWARD_MATRIX = resourceMatrix([BUILDING_REWARDS[building] 
+                                         for building in DEFAULT_BUILDINGS])
+
 def main():
     # Verify correctness of quest attributes
     for quest in QUESTS:
@@ -111,6 +164,9 @@ def main():
         for requirementKey in quest.requirements:
             assert requirementKey in RESOURCES, quest
         assert quest.type in QUEST_TYPES
+    for building in DEFAULT_BUILDINGS:
+        for rewardKey in BUILDING_REWARDS[building]:
+            assert rewardKey in RESOURCES, building
 
     # Demonstrate how to access quest data
     print(QUESTS)
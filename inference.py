@@ -0,0 +1,178 @@
+import asyncio
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+import numpy as np
+import torch
+
+
+class BatchedInferenceServer:
+    """Serve epsilon-greedy actions for many concurrent games with one Q_network forward pass per batch.
+
+    Games running in threads call act (or await act_async from asyncio tasks). A background
+    thread collects their requests until max_batch_size are waiting or max_wait seconds have
+    passed since the first one, then answers all of them at once.
+    """
+
+    def __init__(self, q_network, state_size, action_size, max_batch_size=256, max_wait=0.001,
+                 epsilon=0., seed=None, stats_window=10000):
+        """Initialize a BatchedInferenceServer object and start its serving thread.
+
+        Params
+        ======
+            q_network (Q_network): network giving the Q-values of a batch of states
+            state_size (int): size of each featurized state
+            action_size (int): number of actions
+            max_batch_size (int): largest number of states per forward pass
+            max_wait (float): longest time in seconds to wait for a batch to fill up
+            epsilon (float): default exploration rate of requests
+            seed (int): random seed for exploration
+            stats_window (int): number of recent requests and batches kept for stats
+        """
+        self.q_network = q_network
+        self.action_size = action_size
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.epsilon = epsilon
+        self.rng = np.random.default_rng(seed)
+        self.requests = queue.Queue()
+
+        # Preallocated inputs, filled in place for each batch
+        self.inputs = torch.zeros((max_batch_size, state_size))
+        self.inputs_np = self.inputs.numpy()
+        self.epsilons = np.zeros(max_batch_size)
+        self.masks = torch.ones((max_batch_size, action_size), dtype=torch.bool)
+        self.masks_np = self.masks.numpy()
+
+        self.latencies = deque(maxlen=stats_window)
+        self.batch_sizes = deque(maxlen=stats_window)
+        self.finish_times = deque(maxlen=stats_window)
+
+        self.running = True
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def submit(self, state, epsilon=None, legal_mask=None):
+        """Request an action for state, only among legal actions if a mask is given.
+        Returns a Future holding the action, or the error raised while serving its batch."""
+        if not self.running:
+            raise RuntimeError("The inference server is closed.")
+        future = Future()
+        self.requests.put((state, self.epsilon if epsilon is None else epsilon, legal_mask,
+                           future, time.perf_counter()))
+        return future
+
+    def act(self, state, epsilon=None, legal_mask=None):
+        """Return an epsilon-greedy action for state, blocking until its batch is served."""
+        return self.submit(state, epsilon, legal_mask).result()
+
+    async def act_async(self, state, epsilon=None, legal_mask=None):
+        """Return an epsilon-greedy action for state, from an asyncio task."""
+        return await asyncio.wrap_future(self.submit(state, epsilon, legal_mask))
+
+    def _next_batch(self):
+        """Wait for a first request, then collect more until the batch is full or max_wait has passed."""
+        batch = [self.requests.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size and batch[-1] is not None:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self.requests.get(timeout=remaining) if remaining > 0
+                             else self.requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _answer(self, batch):
+        """Return the actions of a batch of requests, from one forward pass."""
+        n = len(batch)
+        for i, (state, epsilon, legal_mask, _, _) in enumerate(batch):
+            self.inputs_np[i] = state
+            self.epsilons[i] = epsilon
+            self.masks_np[i] = True if legal_mask is None else legal_mask
+
+        with torch.no_grad():
+            q_values = self.q_network(self.inputs[:n])
+            greedy = q_values.masked_fill_(~self.masks[:n], -float("inf")).argmax(1).numpy()
+        # Uniformly random legal actions, as the argmax of random scores over legal actions
+        explore = self.rng.random(n) < self.epsilons[:n]
+        random_actions = (self.rng.random((n, self.action_size)) * self.masks_np[:n]).argmax(1)
+        return np.where(explore, random_actions, greedy)
+
+    def _serve(self):
+        while self.running:
+            batch = self._next_batch()
+            if batch[-1] is None: # Sent by close
+                batch.pop()
+            if not batch:
+                continue
+            try:
+                actions = self._answer(batch)
+            except Exception as error:
+                # Fail the whole batch (e.g. a state of the wrong size) and keep serving
+                for _, _, _, future, _ in batch:
+                    future.set_exception(error)
+                continue
+
+            finish_time = time.perf_counter()
+            for (_, _, _, future, submit_time), action in zip(batch, actions):
+                future.set_result(int(action))
+                self.latencies.append(finish_time - submit_time)
+            self.batch_sizes.append(len(batch))
+            self.finish_times.append(finish_time)
+
+    def stats(self, percentiles=(50, 90, 99)):
+        """Return latency percentiles (in ms), throughput (requests/s) and mean batch size over recent requests."""
+        stats = {}
+        if self.latencies:
+            latencies = np.array(self.latencies) * 1000
+            for p, value in zip(percentiles, np.percentile(latencies, percentiles)):
+                stats["latency_p%d_ms" % p] = float(value)
+        if len(self.finish_times) > 1:
+            elapsed = self.finish_times[-1] - self.finish_times[0]
+            # Requests answered after the first batch of the window
+            served = sum(self.batch_sizes) - self.batch_sizes[0]
+            stats["throughput"] = served / elapsed if elapsed > 0 else float("inf")
+        if self.batch_sizes:
+            stats["mean_batch_size"] = float(np.mean(self.batch_sizes))
+        return stats
+
+    def close(self):
+        """Stop the serving thread."""
+        self.running = False
+        self.requests.put(None)
+        self.thread.join()
+
+
+def main():
+    # Compare the batch size / wait trade-off with many games acting in threads
+    from q_network import Q_network
+    from featurize import stateFeatureLen, NUM_ACTIONS
+    state_size = stateFeatureLen(3)
+    q_network = Q_network(state_size, NUM_ACTIONS, 256)
+    states = np.random.rand(64, state_size).astype(np.float32)
+    for max_batch_size, max_wait in [(1, 0.), (32, 0.0005), (64, 0.002)]:
+        server = BatchedInferenceServer(q_network, state_size, NUM_ACTIONS, max_batch_size, max_wait)
+        def run_game(i):
+            for _ in range(200):
+                server.act(states[i])
+        threads = [threading.Thread(target=run_game, args=(i,)) for i in range(len(states))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        server.close()
+        print("max_batch_size", max_batch_size, "max_wait", max_wait, server.stats())
+
+    # A bad request fails its batch without stopping the server
+    server = BatchedInferenceServer(q_network, state_size, NUM_ACTIONS, 8, 0.)
+    try:
+        server.act(np.zeros(state_size + 1, dtype=np.float32))
+        raise AssertionError("A state of the wrong size was served.")
+    except ValueError:
+        pass
+    assert 0 <= server.act(states[0]) < NUM_ACTIONS
+    server.close()
+    print("The server keeps serving after a failed batch.")
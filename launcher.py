@@ -0,0 +1,58 @@
+import multiprocessing as mp
+from multiprocessing import forkserver
+
+# Worker processes (actors, vector env workers, tournament and replay workers) are created
+# from the multiprocessing context returned by worker_context. With "forkserver", they are
+# forked from a server process which imported the modules they need once, so they start
+# with the game tables (QUESTS, LORD_CARDS, ...) built and torch loaded, sharing those pages
+# copy-on-write with the server, instead of importing everything again as with "spawn".
+
+# Modules every game worker needs: the rule tables and the game, featurization and action code
+GAME_MODULES = ("game_info", "player", "board", "game", "batched_game", "featurize", "actions", "scoring")
+
+# Modules of workers running a Q-network
+NETWORK_MODULES = GAME_MODULES + ("torch", "q_network")
+
+
+def worker_context(start_method=None, preload=GAME_MODULES):
+    """Return the multiprocessing context to create worker processes from.
+
+    With start_method="forkserver", the fork server is started with the preload modules
+    imported. There is one fork server per process, started by the first call: the modules
+    of later calls are not preloaded, and their workers import them themselves.
+
+    Params
+    ======
+        start_method (str): multiprocessing start method, or None for the default
+        preload (tuple): modules the fork server imports before forking workers
+    """
+    context = mp.get_context(start_method)
+    if context.get_start_method() == "forkserver":
+        context.set_forkserver_preload(list(preload))
+        forkserver.ensure_running()
+    return context
+
+
+def _startup_task(module):
+    """Import a module in a worker, as its first task would."""
+    __import__(module)
+    return module
+
+
+def main():
+    # Time the start of worker pools, including their first import of the game or network modules
+    import time
+    from concurrent.futures import ProcessPoolExecutor
+    num_workers = 8
+    # The fork server imports its modules once, before forking its first worker
+    start = time.perf_counter()
+    with ProcessPoolExecutor(1, mp_context=worker_context("forkserver", NETWORK_MODULES)) as executor:
+        executor.submit(_startup_task, "game").result()
+    print(f"Fork server started with the network modules in {time.perf_counter() - start:.2f}s")
+    for module in ["featurize", "q_network"]:
+        for start_method in ["spawn", "forkserver"]:
+            start = time.perf_counter()
+            with ProcessPoolExecutor(num_workers, mp_context=worker_context(start_method)) as executor:
+                list(executor.map(_startup_task, [module] * num_workers))
+            print(f"{start_method:>10}: {num_workers} workers importing {module} "
+                  f"in {time.perf_counter() - start:.2f}s")
@@ -0,0 +1,289 @@
+import math
+import random
+import time
+import numpy as np
+import torch
+from featurize import featurizeGameStates, stateFeatureLen, NUM_ACTIONS, QUEST_SLOT_ACTIONS, BUILDING_ACTIONS
+from actions import legalActionMasks, takeAction
+from zobrist import zobristHash, ZobristHash
+
+
+def is_chance_action(game, action):
+    """Whether taking action reveals a quest from the (shuffled) quest stack."""
+    return QUEST_SLOT_ACTIONS <= action < BUILDING_ACTIONS and len(game.boardState.questStackIds) > 0
+
+
+def seat_values(game, to_move_value=0.):
+    """Value of a game for each player, indexed like game.playerNames.
+
+    Each player's Player.score, plus to_move_value for the player to move,
+    minus the mean of the other players' values.
+    """
+    values = np.zeros(game.numPlayers)
+    for player in game.players:
+        values[game.playerNames.index(player.name)] = player.score()
+    values[game.playerNames.index(game.players[0].name)] += to_move_value
+    return values - (values.sum() - values) / (game.numPlayers - 1)
+
+
+class QNetworkEvaluator:
+    """Priors and values of game states from a Q_network.
+
+    The priors are a softmax of the Q-values of the legal actions, and the value
+    of a state for the player to move is their best legal Q-value.
+    """
+
+    def __init__(self, q_network, num_players=3, temperature=1.):
+        """Initialize a QNetworkEvaluator object.
+
+        Params
+        ======
+            q_network (Q_network): network giving the Q-values of a batch of states
+            num_players (int): number of players in the games evaluated
+            temperature (float): temperature of the softmax giving the priors
+        """
+        self.q_network = q_network
+        self.temperature = temperature
+        self.features = np.empty((0, stateFeatureLen(num_players)), dtype=np.float32)
+
+    def __call__(self, games, masks):
+        """Return the priors (len(games), NUM_ACTIONS) and values (len(games),) of games,
+        given their legal action masks."""
+        if len(games) > len(self.features):
+            self.features = np.empty((len(games), self.features.shape[1]), dtype=np.float32)
+        features = self.features[:len(games)]
+        featurizeGameStates(games, features)
+        with torch.no_grad():
+            q_values = self.q_network(torch.from_numpy(features)).numpy()
+        q_values = np.where(masks, q_values, -np.inf)
+        values = q_values.max(axis=1)
+        priors = np.exp((q_values - values[:, None]) / self.temperature)
+        priors /= priors.sum(axis=1, keepdims=True)
+        return priors, values
+
+
+class Node:
+    """A state in the search tree, shared by every path that reaches it.
+
+    Statistics are kept per legal action, from the point of view of the player
+    to move. An action that draws a quest from the stack is a chance edge: its
+    statistics average over the sampled outcomes, which are its children.
+    """
+    __slots__ = ("seat", "actions", "priors", "visits", "value_sums", "children", "values")
+
+    def __init__(self, seat, actions, priors, values=None):
+        self.seat = seat # index in playerNames of the player to move
+        self.actions = actions
+        self.priors = priors
+        self.visits = np.zeros(len(actions))
+        self.value_sums = np.zeros(len(actions))
+        self.children = [set() for _ in actions] # hashes of the states reached by each action
+        self.values = values # values of a terminal state for each player, else None
+
+
+class MCTS:
+    """Monte Carlo Tree Search (PUCT) over GameStates, to be used as a Player.policy.
+
+    Simulations are run in batches: each one descends the tree with a virtual loss on
+    the edges it takes, so that the batch spreads over different leaves, which are then
+    evaluated in one forward pass. Nodes are stored in a transposition table keyed by
+    Zobrist hash, which is kept between moves for the part still reachable from the new root.
+    """
+
+    def __init__(self, evaluator, num_simulations=200, batch_size=16, c_puct=1.5,
+                 virtual_loss=1., temperature=0., max_time=None, seed=None):
+        """Initialize an MCTS object.
+
+        Params
+        ======
+            evaluator (callable): (games, masks) -> (priors, values) for the players
+                to move, e.g. a QNetworkEvaluator
+            num_simulations (int): simulations per move
+            batch_size (int): simulations whose leaves are evaluated together
+            c_puct (float): weight of the priors against the values
+            virtual_loss (float): visits counted as the worst value seen while
+                a simulation through an edge waits for its evaluation
+            temperature (float): moves are chosen with probability proportional to
+                visits ** (1 / temperature), or the most visited if 0
+            max_time (float): optional time limit in seconds per move
+            seed (int): random seed for chance outcomes and move choices
+        """
+        self.evaluator = evaluator
+        self.num_simulations = num_simulations
+        self.batch_size = batch_size
+        self.c_puct = c_puct
+        self.virtual_loss = virtual_loss
+        self.temperature = temperature
+        self.max_time = max_time
+        self.rng = random.Random(seed)
+        self.table = {}
+        self.min_value = math.inf
+        self.max_value = -math.inf
+
+    def __call__(self, game, possible_moves):
+        """Choose a move in game, as a Player.policy."""
+        root = self.search(game)
+        if self.temperature == 0:
+            action = root.actions[np.argmax(root.visits)]
+        else:
+            weights = root.visits ** (1. / self.temperature)
+            action = self.rng.choices(root.actions, weights=weights)[0]
+        # Not an assert, which python -O strips: a stale tree (e.g. a hash collision)
+        # must not play an illegal move
+        if action not in possible_moves:
+            raise ValueError(f"The search chose action {action}, which is not legal here.")
+        return int(action)
+
+    def reset(self):
+        """Forget the whole tree."""
+        self.table = {}
+        self.min_value = math.inf
+        self.max_value = -math.inf
+
+    def search(self, game):
+        """Run the simulations for one move from game. Returns the root Node."""
+        root_key = zobristHash(game)
+        self._prune(root_key)
+        if root_key not in self.table:
+            self._expand({root_key: (game, [])})
+        root = self.table[root_key]
+        if root.values is not None:
+            return root
+
+        start = time.perf_counter()
+        done = 0
+        while done < self.num_simulations:
+            pending = {} # hash -> (game, paths waiting for its evaluation)
+            for _ in range(min(self.batch_size, self.num_simulations - done)):
+                path, key, leaf = self._descend(game, root_key)
+                if leaf is None:
+                    self._backup(path, self.table[key].values)
+                else:
+                    pending.setdefault(key, (leaf, []))[1].append(path)
+            self._expand(pending)
+            done += self.batch_size
+            if self.max_time is not None and time.perf_counter() - start > self.max_time:
+                break
+        return root
+
+    def _descend(self, game, key):
+        """Run one simulation down to a terminal or unexpanded state.
+
+        Returns the path of (node, action index, virtual loss) taken, the hash of the
+        state reached, and a clone of that state if it still has to be evaluated.
+        """
+        game = game.clone()
+        hasher = ZobristHash(game, key)
+        node = self.table[key]
+        path = []
+        while node.values is None:
+            i = self._select(node)
+            loss = self.virtual_loss * (self.min_value if self.min_value < math.inf else 0.)
+            node.visits[i] += self.virtual_loss
+            node.value_sums[i] += loss
+            path.append((node, i, loss))
+
+            action = node.actions[i]
+            if is_chance_action(game, action):
+                # Sample the revealed quest, rather than reading the actual stack order
+                self.rng.shuffle(game.boardState.questStackIds)
+            takeAction(game, action)
+            key = hasher.value
+            node.children[i].add(key)
+            node = self.table.get(key)
+            if node is None:
+                return path, key, game
+        return path, key, None
+
+    def _select(self, node):
+        """Index of the action maximizing the PUCT score of node."""
+        total = node.visits.sum()
+        mean = node.value_sums.sum() / total if total > 0 else 0.
+        q_values = np.divide(node.value_sums, node.visits, out=np.full(len(node.actions), mean),
+                             where=node.visits > 0)
+        if self.max_value > self.min_value:
+            q_values = (q_values - self.min_value) / (self.max_value - self.min_value)
+        else:
+            q_values = np.zeros(len(node.actions))
+        scores = q_values + self.c_puct * node.priors * math.sqrt(max(total, 1.)) / (1. + node.visits)
+        return int(np.argmax(scores))
+
+    def _expand(self, pending):
+        """Evaluate the pending states in one batch, add them to the table and back up their paths."""
+        games = [game for game, _ in pending.values()]
+        masks = np.empty((len(games), NUM_ACTIONS), dtype=bool)
+        legalActionMasks(games, masks)
+        live = [i for i, game in enumerate(games) if not game.isOver() and masks[i].any()]
+        priors, values = self.evaluator([games[i] for i in live], masks[live]) if live else (None, None)
+        evaluations = {i: (priors[j], values[j]) for j, i in enumerate(live)}
+
+        for i, (key, (game, paths)) in enumerate(pending.items()):
+            seat = game.playerNames.index(game.players[0].name)
+            if i in evaluations:
+                actions = np.flatnonzero(masks[i])
+                node_priors, value = evaluations[i]
+                node = Node(seat, actions, node_priors[actions] / node_priors[actions].sum())
+                leaf_values = seat_values(game, value)
+            else:
+                leaf_values = seat_values(game)
+                node = Node(seat, np.zeros(0, dtype=np.int64), np.zeros(0), leaf_values)
+            self.table[key] = node
+            for path in paths:
+                self._backup(path, leaf_values)
+
+    def _backup(self, path, values):
+        """Replace the virtual losses along path with the leaf values."""
+        for node, i, loss in path:
+            value = values[node.seat]
+            node.visits[i] += 1. - self.virtual_loss
+            node.value_sums[i] += value - loss
+            self.min_value = min(self.min_value, value)
+            self.max_value = max(self.max_value, value)
+
+    def _prune(self, root_key):
+        """Drop the nodes that cannot be reached from the state hashed to root_key."""
+        if root_key not in self.table:
+            self.table = {}
+            return
+        reachable = {root_key: self.table[root_key]}
+        stack = [root_key]
+        while stack:
+            for children in self.table[stack.pop()].children:
+                for key in children:
+                    if key not in reachable and key in self.table:
+                        reachable[key] = self.table[key]
+                        stack.append(key)
+        self.table = reachable
+
+
+def main():
+    # Play MCTS (with an untrained network) against random players
+    from q_network import Q_network
+    from game import GameState
+    from actions import legalActions
+    num_players = 3
+    q_network = Q_network(stateFeatureLen(num_players), NUM_ACTIONS, 256)
+    q_network.eval()
+    mcts = MCTS(QNetworkEvaluator(q_network, num_players), num_simulations=200, batch_size=16, seed=0)
+    game = GameState(num_players)
+    searcher = game.players[0]
+    searcher.policy = mcts
+    moves, reused, search_time = 0, 0, 0.
+    while not game.isOver():
+        player = game.players[0]
+        if player is searcher:
+            reused += zobristHash(game) in mcts.table
+            start = time.perf_counter()
+            move = player.selectMove(game, legalActions(game))
+            search_time += time.perf_counter() - start
+            moves += 1
+            # All virtual losses were replaced by actual visits
+            root = mcts.table[zobristHash(game)]
+            assert np.allclose(root.visits, np.round(root.visits))
+        else:
+            move = player.selectMove(game, legalActions(game))
+        takeAction(game, move)
+    print(f"{moves} searched moves, {reused} with a reused subtree, {search_time / moves * 1000:.1f}ms/move "
+          f"({mcts.num_simulations * moves / search_time:.0f} simulations/s)")
+    print("scores:", {player.name + (" (MCTS)" if player is searcher else ""): player.score()
+                      for player in game.players})
@@ -0,0 +1,46 @@
+class GameObserver():
+    '''
+    Base class for objects which follow the mutations of a game, such as
+    incrementally maintained features or hashes.
+
+    An observer is attached by adding it to the observers tuple of the
+    GameState, BoardState and Players it follows. Each method is called
+    right after the corresponding mutation, with whatever is needed to
+    undo it, and does nothing by default.
+    '''
+    def resourceChanged(self, player, resource: str, oldNumber: int):
+        '''A player's count of one resource changed from oldNumber.'''
+        pass
+
+    def agentsChanged(self, player, oldAgents: int):
+        '''A player's number of available agents changed from oldAgents.'''
+        pass
+
+    def questGained(self, player, quest):
+        '''A quest was appended to a player's active quests.'''
+        pass
+
+    def questCompleted(self, player, quest, slot: int):
+        '''The quest at index slot of a player's active quests was
+        moved to the end of their completed quests.'''
+        pass
+
+    def buildingChanged(self, boardState, building: str, oldState):
+        '''A building's occupation state changed from oldState.'''
+        pass
+
+    def availableQuestsChanged(self, boardState, oldQuests: list):
+        '''The quests available at Cliffwatch Inn changed from oldQuests.'''
+        pass
+
+    def roundsLeftChanged(self, gameState, oldRoundsLeft: int):
+        '''The number of rounds left changed from oldRoundsLeft.'''
+        pass
+
+    def turnOrderChanged(self, gameState, oldPlayers: list):
+        '''The turn order (i.e. gameState.players) changed from oldPlayers.'''
+        pass
+
+    def stateRestored(self, gameState):
+        '''The whole game was restored from a snapshot (see GameState.restore).'''
+        pass
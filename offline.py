@@ -0,0 +1,268 @@
+import queue
+import threading
+import time
+import numpy as np
+import torch
+from transition_log import TransitionLog
+
+# Offline training of a DQLAgent on transition logs (see transition_log.py), without playing
+# any games: OfflineLoader streams shuffled minibatches from the memory-mapped logs, prepared
+# by background threads, and train_offline feeds them to DQLAgent.train.
+
+
+class OfflineLoader:
+    """Shuffled minibatches of the transitions of some logs, prepared on background threads.
+
+    Shuffling is two-level, so that reads stay sequential on disk: each epoch visits the
+    blocks of block_rows consecutive transitions in a random order, and the transitions of
+    each window of window_blocks blocks (the shuffle buffer) are shuffled together. Worker
+    threads each read a window at a time from the memory maps and split it into batches in
+    reusable batch tensors, in the layout of ReplayBuffer.sample(tensors=True).
+
+    Iterating yields batches until num_epochs is over (or forever), each valid until the next
+    one is taken, since its tensors are then reused.
+    """
+
+    def __init__(self, logs, batch_size, block_rows=256, window_blocks=64, num_threads=2,
+                 prefetch=8, num_epochs=None, pin_memory=None, seed=None):
+        """Initialize an OfflineLoader object.
+
+        Params
+        ======
+            logs (list): TransitionLogs, or paths of transition logs, with the same fields
+            batch_size (int): transitions per batch
+            block_rows (int): consecutive transitions read together, the unit of the epoch shuffle
+            window_blocks (int): blocks shuffled together, i.e. the size of the shuffle buffer in blocks
+            num_threads (int): threads reading windows and filling batches
+            prefetch (int): number of batches ready ahead of training
+            num_epochs (int): passes over the logs, or None to loop forever
+            pin_memory (bool): whether to allocate the batches in page-locked memory, for fast
+                (asynchronous) copies to a GPU; defaults to whether CUDA is available
+            seed (int): random seed of the shuffles
+        """
+        self.logs = [TransitionLog(log) if isinstance(log, str) else log for log in logs]
+        self.fields = self.logs[0].fields
+        if any(log.fields != self.fields for log in self.logs):
+            raise ValueError("All logs must have the same fields.")
+        self.batch_size = batch_size
+        self.window_blocks = window_blocks
+        self.num_threads = num_threads
+        self.num_epochs = num_epochs
+        self.rng = np.random.default_rng(seed)
+        if pin_memory is None:
+            pin_memory = torch.cuda.is_available()
+
+        # Blocks as (log, chunk, start, stop), never spanning chunks
+        self.blocks = [(l, c, start, min(start + block_rows, rows))
+                       for l, log in enumerate(self.logs) for c, rows in enumerate(log.chunk_rows)
+                       for start in range(0, int(rows), block_rows)]
+        if not self.blocks:
+            raise ValueError("The logs hold no transitions.")
+
+        # Batch tensors: (batch, 1) actions, rewards and dones, as sampled from a ReplayBuffer
+        self.batches = queue.Queue()
+        for _ in range(prefetch + num_threads + 1):
+            self.batches.put(tuple(
+                torch.empty((batch_size,) + (shape or (1,)), dtype=_torch_dtype(dtype), pin_memory=pin_memory)
+                for _, dtype, shape in self.fields))
+        self.windows = queue.Queue(num_threads)
+        self.ready = queue.Queue(prefetch)
+        self.stop_event = threading.Event()
+        self.error = None
+        self.current = None
+        self.finished_threads = 0
+
+        # Seconds the training loop waited for a batch, and spent between batches, and the
+        # seconds each worker thread spent reading from the logs (summed by stats)
+        self.wait_time = 0.
+        self.total_time = 0.
+        self.read_times = [0.] * num_threads
+        self.num_batches = 0
+        self.last_time = None
+
+        self.threads = [threading.Thread(target=self._plan, daemon=True)]
+        self.threads += [threading.Thread(target=self._fill, args=(i, np.random.default_rng(child)), daemon=True)
+                         for i, child in enumerate(np.random.SeedSequence(seed).spawn(num_threads))]
+        for thread in self.threads:
+            thread.start()
+
+    def __len__(self):
+        """Number of transitions in the logs."""
+        return sum(len(log) for log in self.logs)
+
+    def _plan(self):
+        """Hand out windows of blocks, in a new random order each epoch."""
+        epoch = 0
+        while self.num_epochs is None or epoch < self.num_epochs:
+            order = self.rng.permutation(len(self.blocks))
+            for start in range(0, len(order), self.window_blocks):
+                window = [self.blocks[i] for i in order[start:start + self.window_blocks]]
+                if not self._put(self.windows, window):
+                    return
+            epoch += 1
+        for _ in range(self.num_threads):
+            self._put(self.windows, None)
+
+    def _put(self, target, item):
+        """Put an item on a queue unless the loader is closed. Returns whether it was put."""
+        while not self.stop_event.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, source):
+        """Get an item from a queue, or None once the loader is closed."""
+        while not self.stop_event.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def _fill(self, index, rng):
+        """Worker thread number index: read windows and split them into shuffled batches. The
+        transitions left over after the last full batch of a window go to the thread's next window."""
+        leftover = None
+        try:
+            while True:
+                window = self._get(self.windows)
+                if window is None:
+                    break
+                start = time.perf_counter()
+                parts = [[column[start_row:stop_row] for column in self.logs[l].chunk(c)]
+                         for l, c, start_row, stop_row in window]
+                if leftover is not None:
+                    parts.append(leftover)
+                columns = [np.concatenate(column) for column in zip(*parts)]
+                # Only this thread updates its total, so no lock is needed
+                self.read_times[index] += time.perf_counter() - start
+                order = rng.permutation(len(columns[0]))
+                full = len(order) - len(order) % self.batch_size
+                for batch_start in range(0, full, self.batch_size):
+                    rows = order[batch_start:batch_start + self.batch_size]
+                    batch = self._get(self.batches)
+                    if batch is None:
+                        return
+                    for tensor, column in zip(batch, columns):
+                        # Scalar fields fill (batch, 1) tensors
+                        np.take(column, rows, axis=0, out=tensor.numpy().reshape((len(rows),) + column.shape[1:]))
+                    if not self._put(self.ready, batch):
+                        return
+                leftover = [column[order[full:]] for column in columns]
+        except Exception as error:
+            self.error = error
+        self._put(self.ready, None)
+
+    def __iter__(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            yield batch
+
+    def next_batch(self):
+        """Return the next batch, or None once all epochs are over or the loader is closed. The
+        previous batch's tensors are reused from then on. Errors of the worker threads are raised here."""
+        now = time.perf_counter()
+        if self.current is not None:
+            self.batches.put(self.current)
+            self.current = None
+        while True:
+            # Poll, since closed worker threads put nothing more
+            if self.stop_event.is_set():
+                return None
+            try:
+                batch = self.ready.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if batch is not None:
+                break
+            if self.error is not None:
+                error, self.error = self.error, None
+                raise RuntimeError("Reading a transition log failed.") from error
+            self.finished_threads += 1
+            if self.finished_threads == self.num_threads:
+                return None
+        got = time.perf_counter()
+        if self.last_time is not None:
+            self.wait_time += got - now
+            self.total_time += got - self.last_time
+        self.last_time = got
+        self.num_batches += 1
+        self.current = batch
+        return batch
+
+    def stats(self):
+        """Throughput of the loader: batches/s taken by the training loop, the fraction of its
+        time spent waiting for a batch (i.e. on I/O), and the worker threads' time reading."""
+        return {"batches_per_second": (self.num_batches - 1) / self.total_time if self.total_time else 0.,
+                "wait_fraction": self.wait_time / self.total_time if self.total_time else 0.,
+                "read_seconds": sum(self.read_times)}
+
+    def close(self):
+        """Stop the worker threads."""
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+
+
+def _torch_dtype(dtype):
+    return torch.from_numpy(np.empty(0, dtype=dtype)).dtype
+
+
+def train_offline(agent, loader, num_steps=None):
+    """Train a DQLAgent on the batches of an OfflineLoader, for num_steps steps or until the
+    loader runs out. Returns the number of training steps."""
+    steps = 0
+    for batch in loader:
+        agent.train(batch)
+        steps += 1
+        if steps == num_steps:
+            break
+    return steps
+
+
+def main():
+    # Log synthetic transitions, check that an epoch yields each of them at most once, then train on them
+    import os
+    import tempfile
+    from transition_log import TransitionLogWriter
+    from featurize import stateFeatureLen, NUM_ACTIONS
+    from q_network import DQLAgent
+    torch.set_num_threads(1)
+    num_players, batch_size = 3, 64
+    state_size = stateFeatureLen(num_players)
+    path = os.path.join(tempfile.mkdtemp(), "transitions.log")
+    writer = TransitionLogWriter(path, num_players, chunk_rows=2048)
+    rng = np.random.default_rng(0)
+    num_transitions = 40000
+    for start in range(0, num_transitions, 1000):
+        states = rng.random((1000, state_size), dtype=np.float32)
+        masks = rng.random((1000, NUM_ACTIONS)) < 0.5
+        # Rewards number the transitions
+        writer.append(states, rng.integers(0, NUM_ACTIONS, 1000), np.arange(start, start + 1000, dtype=np.float32),
+                      np.roll(states, 1, axis=0), (rng.random(1000) < 0.05).astype(np.float32), masks)
+    writer.close()
+
+    loader = OfflineLoader([path], batch_size, num_epochs=1, seed=0)
+    seen = np.concatenate([batch[2][:, 0].numpy().copy() for batch in loader])
+    assert len(np.unique(seen)) == len(seen) > num_transitions - loader.num_threads * batch_size
+    assert not np.array_equal(seen[:1000], np.sort(seen[:1000]))
+    print(f"One epoch: {len(seen)} of {num_transitions} transitions, each at most once, "
+          f"{loader.stats()['batches_per_second']:.0f} batches/s")
+    loader.close()
+
+    agent = DQLAgent(state_size, NUM_ACTIONS, 256, batch_size, 1e-3, 0.9, 1., 0.1, 0.99)
+    loader = OfflineLoader([path], batch_size, seed=0)
+    start = time.perf_counter()
+    steps = train_offline(agent, loader, num_steps=500)
+    elapsed = time.perf_counter() - start
+    stats = loader.stats()
+    loader.close()
+    assert loader.next_batch() is None
+    print(f"Trained {steps} steps offline in {elapsed:.2f}s ({steps / elapsed:.0f} steps/s), "
+          f"{stats['batches_per_second']:.0f} batches/s, waiting for data {stats['wait_fraction']:.1%} of the time, "
+          f"{stats['read_seconds']:.2f}s reading")
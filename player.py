@@ -1,8 +1,100 @@
-from random import shuffle
-from game_info import RESOURCES, Quest
+from random import shuffle, choice
+from array import array
+from collections.abc import MutableMapping, MutableSequence, Sequence
+from game_info import RESOURCES, RESOURCE_INDEX, QUESTS, QUEST_INDEX, SCORE_WEIGHTS, LORD_BONUS, Quest
+
+# The resources a player holds, in the order of the resources dictionary
+PLAYER_RESOURCES = ["Purple", "White", "Black", "Orange", "Gold", "VP"]
+
+class ResourceView(MutableMapping):
+    '''
+    Dictionary-like view of a player's resource counts, which are 
+    stored in an integer array indexed like RESOURCES.
+    '''
+    __slots__ = ("counts",)
+
+    def __init__(self, counts: array) -> None:
+        self.counts = counts
+
+    def __getitem__(self, resource: str) -> int:
+        if resource not in PLAYER_RESOURCES:
+            raise KeyError(resource)
+        return self.counts[RESOURCE_INDEX[resource]]
+
+    def __setitem__(self, resource: str, number: int):
+        if resource not in PLAYER_RESOURCES:
+            raise KeyError(resource)
+        self.counts[RESOURCE_INDEX[resource]] = number
+
+    def __delitem__(self, resource: str):
+        raise TypeError("Cannot remove a resource type from a player.")
+
+    def __iter__(self):
+        return iter(PLAYER_RESOURCES)
+
+    def __len__(self) -> int:
+        return len(PLAYER_RESOURCES)
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+class QuestListView(MutableSequence):
+    '''
+    List-like view of some quests, which are stored in an array of 
+    indices into QUESTS. Changes write through to the array, without
+    notifying observers (use Player.getQuest and completeQuest for that).
+    '''
+    __slots__ = ("questIds",)
+
+    def __init__(self, questIds: array) -> None:
+        self.questIds = questIds
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [QUESTS[questId] for questId in self.questIds[index]]
+        return QUESTS[self.questIds[index]]
+
+    def __setitem__(self, index, quest):
+        if isinstance(index, slice):
+            self.questIds[index] = array("b", [QUEST_INDEX[q.name] for q in quest])
+        else:
+            self.questIds[index] = QUEST_INDEX[quest.name]
+
+    def __delitem__(self, index):
+        del self.questIds[index]
+
+    def __len__(self) -> int:
+        return len(self.questIds)
+
+    def __iter__(self):
+        return (QUESTS[questId] for questId in self.questIds)
+
+    def insert(self, index: int, quest: Quest):
+        self.questIds.insert(index, QUEST_INDEX[quest.name])
+
+    def copy(self) -> list[Quest]:
+        '''Return the quests as a new list.'''
+        return list(self)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Sequence):
+            return NotImplemented
+        return list(self) == list(other)
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return repr(list(self))
 
 # Player state class
 class Player():
+    # Players are created in large numbers during self-play, so 
+    # they store everything in slots, with resources as an integer 
+    # array and quests as indices into QUESTS.
+    __slots__ = ("name", "lordCard", "resourceCounts", "resources", 
+                 "activeQuestIds", "completedQuestIds", "agents", "maxAgents", 
+                 "observers", "policy")
+
     def __init__(self, name: str, numAgents: int, 
                  lordCard: tuple[str]) -> None:
         '''
@@ -16,23 +108,80 @@ class Player():
         self.name = name 
         self.lordCard = lordCard
 
-        self.resources = {
-            "Purple": 0,
-            "White": 0,
-            "Black": 0,
-            "Orange": 0,
-            "Gold": 0,
-            "VP": 0
-        }
+        # Resource counts indexed like RESOURCES, also 
+        # available as a dictionary through self.resources
+        self.resourceCounts = array("i", [0] * len(RESOURCES))
+        self.resources = ResourceView(self.resourceCounts)
         for resource in self.resources:
             assert resource in RESOURCES
 
-        self.activeQuests = []
-        self.completedQuests = []
+        # Indices in QUESTS of the active/completed quests
+        self.activeQuestIds = array("b")
+        self.completedQuestIds = array("b")
         # self.plotQuests = [] # Completed plot quests
         # self.intrigues = []
         self.agents = numAgents
-        # self.maxAgents = numAgents # THis should be a property of the game state, not the players state
+        self.maxAgents = numAgents
+
+        # Observers (see observer.GameObserver) notified of each change
+        self.observers = ()
+
+        # Function (gameState, possibleMoves) -> move used by selectMove.
+        # Moves are chosen uniformly at random when this is None.
+        self.policy = None
+
+    def clone(self) -> "Player":
+        '''
+        Return a copy of this player without its observers. The
+        name, lord card and policy are shared with the copy.
+        '''
+        other = Player.__new__(Player)
+        other.name = self.name
+        other.lordCard = self.lordCard
+        other.resourceCounts = self.resourceCounts[:]
+        other.resources = ResourceView(other.resourceCounts)
+        other.activeQuestIds = self.activeQuestIds[:]
+        other.completedQuestIds = self.completedQuestIds[:]
+        other.agents = self.agents
+        other.maxAgents = self.maxAgents
+        other.observers = ()
+        other.policy = self.policy
+        return other
+
+    def snapshot(self, out: array):
+        '''
+        Append the player's mutable state (resources, agents
+        and quests) to out, an integer array.
+        '''
+        out.extend(self.resourceCounts)
+        out.append(self.agents)
+        out.append(self.maxAgents)
+        for questIds in (self.activeQuestIds, self.completedQuestIds):
+            out.append(len(questIds))
+            out.fromlist(questIds.tolist())
+
+    def restore(self, snapshot: array, offset: int) -> int:
+        '''
+        Restore the state appended to snapshot by self.snapshot,
+        without notifying observers.
+
+        Args:
+            snapshot: the integer array holding the state.
+            offset: the index in snapshot where the state starts.
+
+        Returns:
+            the index in snapshot where the state ends.
+        '''
+        end = offset + len(self.resourceCounts)
+        self.resourceCounts[:] = snapshot[offset:end]
+        self.agents = snapshot[end]
+        self.maxAgents = snapshot[end + 1]
+        offset = end + 2
+        for questIds in (self.activeQuestIds, self.completedQuestIds):
+            end = offset + 1 + snapshot[offset]
+            questIds[:] = array("b", snapshot[offset + 1:end])
+            offset = end
+        return offset
 
     def getQuest(self, quest: Quest):
         '''
@@ -41,7 +190,34 @@ class Player():
         Args: 
             quest: the quest to receive.
         '''
-        self.activeQuests.append(quest)
+        self.activeQuestIds.append(QUEST_INDEX[quest.name])
+        for observer in self.observers:
+            observer.questGained(self, quest)
+
+    @property
+    def activeQuests(self) -> QuestListView:
+        '''The player's active quests.'''
+        return QuestListView(self.activeQuestIds)
+
+    @property
+    def completedQuests(self) -> QuestListView:
+        '''The player's completed quests.'''
+        return QuestListView(self.completedQuestIds)
+
+    def selectMove(self, gameState, possibleMoves: list[int]) -> int:
+        '''
+        Select this player's next move.
+
+        Args:
+            gameState: the game being played.
+            possibleMoves: the legal actions (see actions.py).
+
+        Returns:
+            the selected action.
+        '''
+        if self.policy is not None:
+            return self.policy(gameState, possibleMoves)
+        return choice(possibleMoves)
 
     # TODO (Later version): uncomment this
     # def getIntrigue(self, intrigue: Intrigue):
@@ -69,31 +245,54 @@ class Player():
         if number <= 0:
             raise ValueError("Cannot receive nonnegative resource count.")
         
-        self.resources[resource] += number
+        self.resourceCounts[RESOURCE_INDEX[resource]] += number
+        for observer in self.observers:
+            observer.resourceChanged(self, resource, self.resources[resource] - number)
 
     def getAgent(self):
         '''Receive an additional agent (for future use).'''
         self.maxAgents += 1
         self.agents += 1
+        for observer in self.observers:
+            observer.agentsChanged(self, self.agents - 1)
+
+    def placeAgent(self):
+        '''Use one of this player's agents.'''
+        if self.agents <= 0:
+            raise ValueError("This player has no agents left to place.")
+        self.agents -= 1
+        for observer in self.observers:
+            observer.agentsChanged(self, self.agents + 1)
 
     def returnAgents(self):
         '''Return all of this player's agents.'''
+        oldAgents = self.agents
         self.agents = self.maxAgents
+        for observer in self.observers:
+            observer.agentsChanged(self, oldAgents)
         
+    def canCompleteQuest(self, quest: Quest) -> bool:
+        '''Return whether the player has enough resources to complete quest.'''
+        for resource, number in quest.requirements.items():
+            if number > self.resourceCounts[RESOURCE_INDEX[resource]]:
+                return False
+        return True
+
     def completeQuest(self, quest: Quest):
         # Make sure the agent has this quest
-        if quest not in self.activeQuests:
+        questId = QUEST_INDEX[quest.name]
+        if questId not in self.activeQuestIds:
             raise ValueError("This agent does not have this quest.")
 
         # Check if the quest can be completed
-        validCompletion = True
-        for resource in quest.requirements:
-            if quest.requirements[resource] > self.resources[resource]:
-                validCompletion = False
+        validCompletion = self.canCompleteQuest(quest)
                 
         if validCompletion:
+            counts = self.resourceCounts
+            oldResources = {resource: counts[RESOURCE_INDEX[resource]] 
+                            for resource in [*quest.requirements, *quest.rewards]}
             for resource,number in quest.requirements.items():
-                self.resources[resource] -= number
+                counts[RESOURCE_INDEX[resource]] -= number
             for resource,number in quest.rewards.items():
                 if resource not in RESOURCES:
                     raise ValueError("Invalid resource type.")
@@ -104,16 +303,22 @@ class Player():
                     # TODO (later version): Implement this
                     raise Exception("This is impossible! Intrigue cards do not exist yet!")
                 else:
-                    self.resources[resource] += number
+                    counts[RESOURCE_INDEX[resource]] += number
+
+            slot = self.activeQuestIds.index(questId)
+            self.completedQuestIds.append(questId)
+            del self.activeQuestIds[slot]
 
-            self.completedQuests.append(quest)
-            self.activeQuests.remove(quest)
+            for observer in self.observers:
+                for resource, oldNumber in oldResources.items():
+                    observer.resourceChanged(self, resource, oldNumber)
+                observer.questCompleted(self, quest, slot)
 
         else:
             raise ValueError("Do not have enough resources to complete this quest.")
         
         # Check that all resource counts are still nonnegative
-        for resourceNumber in self.resources.values():
+        for resourceNumber in self.resourceCounts:
             assert resourceNumber >= 0
     
     def score(self):
@@ -143,20 +348,17 @@ class Player():
         #   to punish the agent for giving other players
         #   free stuff. Would need to code it up in a 
         #   non-circular way though.
+        # (see scoring.py for scoring many players at once, and
+        # for subtracting the other players' scores)
         score = 0.
         for resource,number in self.resources.items():
-            if resource in ["Purple", "White", "VP"]:
-                score += number 
-            elif resource in ["Orange", "Black"]:
-                score += number / 2.
-            elif resource == "Gold":
-                score += number / 4.
-            else:
+            if resource not in SCORE_WEIGHTS:
                 raise ValueError("Invalid resource type.")
+            score += SCORE_WEIGHTS[resource] * number
 
-        for quest in self.completedQuests:
-            if quest.type in self.lordCard:
-                score += 4 
+        for questId in self.completedQuestIds:
+            if QUESTS[questId].type in self.lordCard:
+                score += LORD_BONUS 
             # TODO (later version): add check for lordCard = "Buildings"
 
         return score 
\ No newline at end of file
@@ -0,0 +1,82 @@
+import json
+import numpy as np
+from featurize import featurizeGameStates
+from actions import legalActionMasks
+
+# Runtime side of export.py: serves an exported Q-network without the training code
+# (q_network.py and its dependencies), e.g. on CPU-only hosts. TorchScript artifacts
+# need torch, ONNX artifacts onnxruntime, each imported only when loading one.
+
+# Name of the metadata stored in exported artifacts (see export.export_q_network)
+METADATA_NAME = "metadata.json"
+
+
+class RuntimePolicy:
+    """Masked greedy actions of an exported Q-network, for featurized states or GameStates.
+
+    Can also be used as a Player.policy.
+    """
+
+    def __init__(self, path, num_threads=None):
+        """Load an artifact written by export.export_q_network.
+
+        Params
+        ======
+            path (str): the .pt (TorchScript) or .onnx artifact
+            num_threads (int): intra-op threads of the runtime, or None for its default
+        """
+        if path.endswith(".onnx"):
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            if num_threads is not None:
+                options.intra_op_num_threads = num_threads
+            self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+            self.metadata = json.loads(self.session.get_modelmeta().custom_metadata_map[METADATA_NAME])
+            self.module = None
+        else:
+            import torch
+            if num_threads is not None:
+                torch.set_num_threads(num_threads)
+            extra_files = {METADATA_NAME: ""}
+            self.module = torch.jit.load(path, map_location="cpu", _extra_files=extra_files)
+            self.module.eval()
+            self.metadata = json.loads(extra_files[METADATA_NAME])
+            self.session = None
+        self.num_players = self.metadata["num_players"]
+        self.state_size = self.metadata["state_size"]
+        self.action_size = self.metadata["action_size"]
+        # Buffers reused by act_games
+        self.features = np.empty((0, self.state_size), dtype=np.float32)
+        self.masks = np.empty((0, self.action_size), dtype=bool)
+
+    def q_values(self, states):
+        """Return the (batch, action_size) Q-values of (batch, state_size) float32 featurized states."""
+        states = np.ascontiguousarray(states, dtype=np.float32)
+        if self.session is not None:
+            return self.session.run(None, {"states": states})[0]
+        import torch
+        with torch.inference_mode():
+            return self.module(torch.from_numpy(states)).numpy()
+
+    def act(self, states, masks):
+        """Return the legal action with the highest Q-value for featurized states and their
+        legal action masks, either one state (an int) or a batch (an int64 array)."""
+        states, masks = np.asarray(states), np.asarray(masks, dtype=bool)
+        if states.ndim == 1:
+            return int(self.act(states[None], masks[None])[0])
+        q_values = np.where(masks, self.q_values(states), -np.inf)
+        return q_values.argmax(axis=1)
+
+    def act_games(self, games):
+        """Return the greedy legal action of the player to move in each of a list of GameStates."""
+        if len(games) > len(self.features):
+            self.features = np.empty((len(games), self.state_size), dtype=np.float32)
+            self.masks = np.empty((len(games), self.action_size), dtype=bool)
+        features, masks = self.features[:len(games)], self.masks[:len(games)]
+        featurizeGameStates(games, features)
+        legalActionMasks(games, masks)
+        return self.act(features, masks)
+
+    def __call__(self, game, possible_moves):
+        """Choose a move in game, as a Player.policy."""
+        return int(self.act_games([game])[0])
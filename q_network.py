@@ -1,12 +1,13 @@
 import torch
 import torch.nn as nn 
-import pprint
+import torch.nn.functional as F
 import numpy as np
 import random
-from collections import deque, namedtuple
-
-
-pp = pprint.PrettyPrinter()
+from game_info import DEFAULT_BUILDINGS
+from scoring import rescoreRewards
+from featurize import (encodeStates, decodeStates, encodedStateLen, stateFeatureLen, boardFeatureLen,
+                       QUEST_FEATURE_LEN, PLAYER_QUESTS_OFFSET, PLAYER_FEATURE_LEN, MAX_QUESTS,
+                       NUM_AVAILABLE_QUESTS, BUILDING_ACTIONS, COMPLETE_ACTIONS)
 
 
 # hyper-parameters
@@ -51,13 +52,83 @@ class Q_network(nn.Module):
         x = self.layers(x)
         return x
 
+class Shared_Q_network(nn.Module):
+    '''
+    Q_network with the same input and output, which shares its weights across the blocks
+    of the featurized state (see featurize.py) instead of reading it as one flat vector.
+
+    One small encoder is applied to every player block, with the player's active and
+    completed quest blocks pooled by a shared linear layer (i.e. summed before it). A context
+    layer combines the board with the player encodings, in turn order. The Q-values of taking
+    an available quest or completing an active quest are scored per slot by one shared head,
+    from the context and an encoding of the quest by one shared quest encoder (empty slots are
+    masked out), and those of the buildings from the context.
+    '''
+    def __init__(self, state_dim, action_dim, hidden_dim, quest_dim=32, player_dim=64):
+        super(Shared_Q_network, self).__init__()
+        self.num_players = next((num_players for num_players in range(2, 6)
+                                 if stateFeatureLen(num_players) == state_dim), None)
+        if self.num_players is None:
+            raise ValueError("state_dim is not the length of a featurized state.")
+        if action_dim != COMPLETE_ACTIONS + MAX_QUESTS:
+            raise ValueError("action_dim must be featurize.NUM_ACTIONS.")
+        self.quest_start = 1 + len(DEFAULT_BUILDINGS) * self.num_players
+        self.board_end = 1 + boardFeatureLen(self.num_players)
+
+        self.quest_encoder = nn.Sequential(nn.Linear(QUEST_FEATURE_LEN, quest_dim), nn.ReLU())
+        self.player_encoder = nn.Sequential(
+            nn.Linear(PLAYER_QUESTS_OFFSET + 2 * QUEST_FEATURE_LEN, player_dim), nn.ReLU())
+        self.context = nn.Sequential(
+            nn.Linear(self.quest_start + quest_dim + self.num_players * player_dim, hidden_dim), nn.ReLU())
+        self.building_head = nn.Linear(hidden_dim, COMPLETE_ACTIONS - BUILDING_ACTIONS)
+        # Head scoring the quest slots (the available quests, then the active quests of the player
+        # to act): Linear(concat(quest, context)) split into its quest and context parts, with
+        # a learned bias per slot telling apart taking a quest from completing one
+        self.slot_quest = nn.Linear(quest_dim, player_dim, bias=False)
+        self.slot_context = nn.Linear(hidden_dim, player_dim, bias=False)
+        self.slot_bias = nn.Parameter(torch.zeros(NUM_AVAILABLE_QUESTS + MAX_QUESTS, player_dim))
+        self.slot_out = nn.Linear(player_dim, 1)
+
+    def encode_quests(self, blocks):
+        '''Encode (..., QUEST_FEATURE_LEN) quest blocks, with zeros for empty blocks.'''
+        return self.quest_encoder(blocks) * blocks.ne(0).any(-1, keepdim=True)
+
+    def forward(self, x):
+        n = x.shape[0]
+        players = x[:, self.board_end:].reshape(n, self.num_players, PLAYER_FEATURE_LEN)
+        quests = players[:, :, PLAYER_QUESTS_OFFSET:].reshape(n, self.num_players, 2, MAX_QUESTS, QUEST_FEATURE_LEN)
+        encoded_players = self.player_encoder(
+            torch.cat([players[:, :, :PLAYER_QUESTS_OFFSET], quests.sum(3).flatten(2)], 2))
+        # Players are in turn order, so the first one is the player to act
+        slots = self.encode_quests(torch.cat([
+            x[:, self.quest_start:self.board_end].reshape(n, NUM_AVAILABLE_QUESTS, QUEST_FEATURE_LEN),
+            quests[:, 0, 0]], 1))
+        context = self.context(torch.cat(
+            [x[:, :self.quest_start], slots[:, :NUM_AVAILABLE_QUESTS].sum(1), encoded_players.flatten(1)], 1))
+        slot_values = self.slot_out(torch.relu(
+            self.slot_quest(slots) + self.slot_context(context)[:, None] + self.slot_bias)).squeeze(2)
+        return torch.cat([slot_values[:, :NUM_AVAILABLE_QUESTS], self.building_head(context),
+                          slot_values[:, NUM_AVAILABLE_QUESTS:]], 1)
+
+def _torch_version():
+    '''(major, minor) version of torch, e.g. (2, 4) for "2.4.0+cu121".'''
+    return tuple(int(part) for part in torch.__version__.split(".")[:2])
+
 class DQLAgent:
     '''
     DQL agent will explore using epsilon-greedy policy and then train the Q_network
 
     '''
 
-    def __init__(self, state_size, action_size, hidden_size, batch_size, lr, gamma, eps_start, eps_end, eps_decay):
+    def __init__(self, state_size, action_size, hidden_size, batch_size, lr, gamma, eps_start, eps_end, eps_decay,
+                 network_class=Q_network, double_dqn=False, huber=False, tau=0.001, target_update_every=1):
+        '''
+        network_class is the class of both Q-networks (Q_network or Shared_Q_network). With double_dqn,
+        next actions are picked by the q_network and valued by the target_q_network. With huber,
+        TD errors are penalized by the Huber loss instead of the squared error. Every
+        target_update_every training steps, the target_q_network moves a fraction tau of the way
+        towards the q_network (tau=1 copies it).
+        '''
 
         # Store variables for the class
         self.state_size = state_size
@@ -69,20 +140,31 @@ class DQLAgent:
         self.eps_start = eps_start
         self.eps_end = eps_end
         self.eps_decay = eps_decay
-        self.loss_fn = nn.MSELoss()
-        self.tau = 0.001
-
-        # Define the two Q-networks to be used: 
-        self.q_network = Q_network(state_size, action_size, hidden_size)
-        self.target_q_network = Q_network(state_size, action_size, hidden_size)
+        self.loss_fn = nn.HuberLoss() if huber else nn.MSELoss()
+        self.double_dqn = double_dqn
+        self.huber = huber
+        self.tau = tau
+        self.target_update_every = target_update_every
+        self.train_steps = 0
+
+        # Define the two Q-networks to be used (Q_network or Shared_Q_network): 
+        self.q_network = network_class(state_size, action_size, hidden_size)
+        self.target_q_network = network_class(state_size, action_size, hidden_size)
         
         # Initialise both of them to have the same weights 
         self.target_q_network.load_state_dict(self.q_network.state_dict())
         
-        # Disable dropout for target_q_network which is only used for evaluation 
+        # Disable dropout for target_q_network which is only used for evaluation, and never train it
         self.target_q_network.eval()
+        self.target_q_network.requires_grad_(False)
+        self.q_parameters = list(self.q_network.parameters())
+        self.target_parameters = list(self.target_q_network.parameters())
 
-        self.optimizer = torch.optim.Adam(self.q_network.parameters(), lr=self.lr)
+        # fused: one multi-tensor kernel updates all parameters, on CPU only since torch 2.4;
+        # otherwise foreach: a few multi-tensor kernels
+        fused = self.q_parameters[0].is_cuda or _torch_version() >= (2, 4)
+        self.optimizer = torch.optim.Adam(self.q_network.parameters(), lr=self.lr,
+                                          **({"fused": True} if fused else {"foreach": True}))
 
         # replay buffer: 
         self.memory = []
@@ -90,54 +172,81 @@ class DQLAgent:
         # epsilon for epsilon-greedy algorithm to do exploration
         self.epsilon = self.eps_start
 
-    def act(self, current_state):
-        # use epsilon-greedy algorithm to do exploration
-        
+    def act(self, current_state, legal_mask=None):
+        # use epsilon-greedy algorithm to do exploration, only among legal actions if a mask is given
+        if legal_mask is not None and not np.any(legal_mask):
+            raise ValueError("No legal action to choose from (e.g. the game is over).")
+
         if random.random() < self.epsilon:
-            action = random.randrange(self.action_size)
+            if legal_mask is None:
+                action = random.randrange(self.action_size)
+            else:
+                action = int(random.choice(np.flatnonzero(legal_mask)))
         else:
             with torch.no_grad():  # We don't need gradients right now so do not need to build computation graphs 
                 # q_network expects a batch of inputs. 
-                state = torch.from_numpy(state).float().unsqueeze(0)
+                state = torch.from_numpy(current_state).float().unsqueeze(0)
                 q_values = self.q_network(state)
+                if legal_mask is not None:
+                    q_values[0, ~torch.from_numpy(legal_mask)] = -float("inf")
                 # choose action with the highest Q_value in this state 
                 action = q_values.argmax().item()
         return action
 
 
-    def train(self, batch):
-        '''
-        Train the Q_network using vanilla DQL algorithm
+    def train(self, batch, weights=None):
         '''
-        states, actions, rewards, next_states, end_state = zip(*batch)
+        Train the Q_network using vanilla (or double) DQL algorithm
 
-        # vertically stack the components so that each tensor has shape (batch_size, _) where _ could be state_dim, action_dim, or 1 (for rewards)
-        states = torch.from_numpy(np.vstack(states)).float()
-        actions = torch.from_numpy(np.vstack(actions)).long()
-        rewards = torch.from_numpy(np.vstack(rewards)).float()
-        next_states = torch.from_numpy(np.vstack(next_states)).float()
-        end_state = torch.from_numpy(np.vstack(end_state).astype(np.uint8)).float()
+        The batch holds the arrays (or tensors) from ReplayBuffer.sample: states, actions, rewards,
+        next_states, end states and (if stored) the legal action masks of the next states. Any
+        further arrays (e.g. lord cards) are ignored.
+
+        If importance-sampling weights are given (e.g. from PrioritizedReplayBuffer.sample),
+        each example's loss is scaled by its weight. Returns the TD errors of the batch.
+        '''
+        # each array from ReplayBuffer.sample has shape (batch_size, _) where _ could be state_dim or 1 (for actions, rewards and end states).
+        # Tensors from ReplayBuffer.sample(tensors=True) are used as they are, and arrays without copying.
+        states, actions, rewards, next_states, end_state = (torch.as_tensor(x) for x in batch[:5])
+        # Legal action masks of the next states, if the replay buffer stores them
+        next_masks = torch.as_tensor(batch[5]) if len(batch) > 5 else None
 
-        # Compute Q-values for current states and next states
-        
         # Q_values of each state-action pair. 
         current_q_values = self.q_network(states).gather(1, actions) # tensor will have shape (batch_size, 1)
 
-        # Q_value of next state and the best possible action from the next state. 
-        next_q_values = self.q_network(next_states).max(1)[0].unsqueeze(1) # tensor will have shape (batch_size, 1)
-                                                                           
-        target_q_values = rewards + (self.gamma * next_q_values * (1 - end_state)) # tensor will have shape (batch_size, 1)
+        # Q_value of next state, from the target_q_network, for the best possible action from the next state
+        with torch.no_grad():
+            next_q_values = self.target_q_network(next_states)
+            # With double DQL, the q_network picks the best action and the target_q_network values it
+            choice_q_values = self.q_network(next_states) if self.double_dqn else next_q_values
+            if next_masks is not None:
+                # Only legal actions can be taken
+                choice_q_values = choice_q_values.masked_fill_(~next_masks, -float("inf"))
+            next_q_values = next_q_values.gather(1, choice_q_values.argmax(1, keepdim=True)) # shape (batch_size, 1)
+            # States which end the game, or without any legal action, are worth nothing
+            worthless = end_state != 0
+            if next_masks is not None:
+                worthless |= ~next_masks.any(1, keepdim=True)
+            target_q_values = next_q_values.masked_fill_(worthless, 0.).mul_(self.gamma).add_(rewards) # shape (batch_size, 1)
 
         # Compute the loss and update the q_network (NOT the target_q_network)
-        loss = self.loss_fn(current_q_values, target_q_values.detach())
-        self.optimizer.zero_grad()
+        if weights is None:
+            loss = self.loss_fn(current_q_values, target_q_values)
+        elif self.huber:
+            loss = (torch.as_tensor(weights, device=current_q_values.device) * F.huber_loss(current_q_values, target_q_values, reduction="none")).mean()
+        else:
+            loss = (torch.as_tensor(weights, device=current_q_values.device) * (current_q_values - target_q_values).pow(2)).mean()
+        self.optimizer.zero_grad(set_to_none=True)
         loss.backward()
         self.optimizer.step()
-        self.target_q_network.load_state_dict(self.q_network.state_dict())
-        
-        # update target_q_network parameters 
-        for target_param, param in zip(self.target_q_network.parameters(), self.q_network.parameters()):
-            target_param.data.copy_(self.tau * param + (1 - self.tau) * target_param)
+
+        # soft update of the target_q_network parameters, as one fused operation over all of them
+        self.train_steps += 1
+        if self.train_steps % self.target_update_every == 0:
+            with torch.no_grad():
+                torch._foreach_lerp_(self.target_parameters, self.q_parameters, self.tau)
+
+        return (target_q_values - current_q_values.detach()).squeeze(1).cpu().numpy()
 
 
     def update_epsilon(self, episode, min_epsilon):
@@ -145,9 +254,10 @@ class DQLAgent:
     
 
 class ReplayBuffer:
-    """Fixed-size buffer to store experience tuples."""
+    """Fixed-size ring buffer of experience arrays."""
 
-    def __init__(self, buffer_size, batch_size, seed):
+    def __init__(self, buffer_size, batch_size, seed, state_size, action_size=None, num_players=None,
+                 store_lords=False):
         """Initialize a ReplayBuffer object.
 
         Params
@@ -155,28 +265,395 @@ class ReplayBuffer:
             buffer_size (int): maximum size of buffer
             batch_size (int): size of each training batch
             seed (int): random seed
+            state_size (int): size of each featurized state
+            action_size (int): number of actions, to also store the legal action masks
+                of next states (or None not to)
+            num_players (int): number of players of the featurized games, to store states
+                encoded as uint8 (see featurize.encodeStates) and decode them when sampled,
+                or None to store them as float32
+            store_lords (bool): whether to also store the lord cards of the players of each
+                experience (see actor_pool.play_game), to recompute rewards with rescore
         """
         self.buffer_size = buffer_size
         self.batch_size = batch_size
-        self.seed = random.seed(seed)
-        self.memory = deque(maxlen=buffer_size)
-        self.experience = namedtuple("Experience", field_names=["state", "action", "reward", "next_state", "end_state"])
+        self.num_players = num_players
+        self.rng = np.random.default_rng(seed)
+
+        # Preallocated storage, one row per experience
+        if num_players is None:
+            stored_size, stored_dtype = state_size, np.float32
+        else:
+            assert state_size == stateFeatureLen(num_players)
+            stored_size, stored_dtype = encodedStateLen(num_players), np.uint8
+        self.states = np.zeros((buffer_size, stored_size), dtype=stored_dtype)
+        self.actions = np.zeros((buffer_size, 1), dtype=np.int64)
+        self.rewards = np.zeros((buffer_size, 1), dtype=np.float32)
+        self.next_states = np.zeros((buffer_size, stored_size), dtype=stored_dtype)
+        self.dones = np.zeros((buffer_size, 1), dtype=np.float32)
+        self.next_masks = None if action_size is None else np.zeros((buffer_size, action_size), dtype=bool)
+        self.state_players = next((players for players in range(2, 6) if stateFeatureLen(players) == state_size), None)
+        if store_lords and self.state_players is None:
+            raise ValueError("Can only store lord cards with states of featurized games.")
+        self.lords = np.zeros((buffer_size, self.state_players), dtype=np.uint8) if store_lords else None
+
+        # Next row to write to, and number of rows filled
+        self.position = 0
+        self.size = 0
+
+        # Reusable output arrays for sample()
+        self.sample_states = np.empty((batch_size, state_size), dtype=np.float32)
+        self.sample_actions = np.empty((batch_size, 1), dtype=np.int64)
+        self.sample_rewards = np.empty((batch_size, 1), dtype=np.float32)
+        self.sample_next_states = np.empty((batch_size, state_size), dtype=np.float32)
+        self.sample_dones = np.empty((batch_size, 1), dtype=np.float32)
+        self.sample_next_masks = None if action_size is None else np.empty((batch_size, action_size), dtype=bool)
+        # Reusable arrays for the sampled encoded states
+        self.sample_codes = np.empty((batch_size, stored_size), dtype=stored_dtype)
+        # Tensors sharing memory with the output arrays, for sample(tensors=True)
+        self.sample_tensors = tuple(torch.from_numpy(array) for array in (
+            self.sample_states, self.sample_actions, self.sample_rewards, self.sample_next_states, self.sample_dones)
+            + (() if action_size is None else (self.sample_next_masks,)))
+
+    def _encode(self, states):
+        """Convert (n, state_size) states to their stored form."""
+        if self.num_players is None:
+            return states
+        return encodeStates(np.asarray(states, dtype=np.float32), self.num_players)
+
+    def _gather_states(self, stored, indices, out):
+        """Gather the stored states at the given rows into out, decoding them if needed."""
+        if self.num_players is None:
+            np.take(stored, indices, axis=0, out=out)
+        else:
+            np.take(stored, indices, axis=0, out=self.sample_codes)
+            decodeStates(self.sample_codes, self.num_players, out)
 
-    def add(self, state, action, reward, next_state, end_state):
+    def add(self, state, action, reward, next_state, end_state, next_mask=None, lords=None):
         """Add a new experience to memory."""
-        e = self.experience(state, action, reward, next_state, end_state)
-        self.memory.append(e)
-
-    def sample(self):
-        """Randomly sample a batch of experiences from memory."""
-        experiences = random.sample(self.memory, k=self.batch_size)
-        states = np.vstack([e.state for e in experiences if e is not None])
-        actions = np.vstack([e.action for e in experiences if e is not None])
-        rewards = np.vstack([e.reward for e in experiences if e is not None])
-        next_states = np.vstack([e.next_state for e in experiences if e is not None])
-        dones = np.vstack([e.done for e in experiences if e is not None])
-        return (states, actions, rewards, next_states, dones)
+        if self.next_masks is not None:
+            self.next_masks[self.position] = next_mask
+        if self.lords is not None:
+            self.lords[self.position] = lords
+        self.states[self.position] = self._encode(np.reshape(state, (1, -1)))[0]
+        self.actions[self.position] = action
+        self.rewards[self.position] = reward
+        self.next_states[self.position] = self._encode(np.reshape(next_state, (1, -1)))[0]
+        self.dones[self.position] = end_state
+        self.position = (self.position + 1) % self.buffer_size
+        self.size = min(self.size + 1, self.buffer_size)
+
+    def add_batch(self, states, actions, rewards, next_states, end_states, next_masks=None, lords=None):
+        """Add a batch of experiences (e.g. one from each of many games) to memory.
+
+        Params
+        ======
+            states (array): (n, state_size) states
+            actions (array): (n,) actions
+            rewards (array): (n,) rewards
+            next_states (array): (n, state_size) next states
+            end_states (array): (n,) whether each next state ends its game
+            next_masks (array): (n, action_size) legal action masks of the next states,
+                if the buffer stores them
+            lords (array): (n, num_players) lord cards of the players of each experience,
+                if the buffer stores them
+        """
+        n = len(states)
+        if n > self.buffer_size:
+            # Only the last buffer_size experiences would survive anyway
+            states, actions, rewards, next_states, end_states = (
+                x[-self.buffer_size:] for x in (states, actions, rewards, next_states, end_states))
+            if next_masks is not None:
+                next_masks = next_masks[-self.buffer_size:]
+            if lords is not None:
+                lords = lords[-self.buffer_size:]
+            n = self.buffer_size
+        rows = (self.position + np.arange(n)) % self.buffer_size
+        if self.next_masks is not None:
+            self.next_masks[rows] = next_masks
+        if self.lords is not None:
+            self.lords[rows] = lords
+        self.states[rows] = self._encode(states)
+        self.actions[rows, 0] = actions
+        self.rewards[rows, 0] = rewards
+        self.next_states[rows] = self._encode(next_states)
+        self.dones[rows, 0] = end_states
+        self.position = (self.position + n) % self.buffer_size
+        self.size = min(self.size + n, self.buffer_size)
+
+    def sample_indices(self):
+        """Draw the rows of a training batch uniformly (with replacement)."""
+        return self.rng.integers(0, self.size, size=self.batch_size)
+
+    def gather(self, indices, tensors=False):
+        """Gather the experiences at the given rows into the reusable sample arrays.
+
+        The returned arrays (or, with tensors, torch tensors sharing their memory)
+        are overwritten by the next call.
+        """
+        self._gather_states(self.states, indices, self.sample_states)
+        np.take(self.actions, indices, axis=0, out=self.sample_actions)
+        np.take(self.rewards, indices, axis=0, out=self.sample_rewards)
+        self._gather_states(self.next_states, indices, self.sample_next_states)
+        np.take(self.dones, indices, axis=0, out=self.sample_dones)
+        batch = (self.sample_states, self.sample_actions, self.sample_rewards, 
+                 self.sample_next_states, self.sample_dones)
+        if self.next_masks is not None:
+            np.take(self.next_masks, indices, axis=0, out=self.sample_next_masks)
+            batch += (self.sample_next_masks,)
+        return self.sample_tensors if tensors else batch
+
+    def sample(self, tensors=False):
+        """Randomly sample a batch of experiences from memory.
+
+        The returned arrays (or, with tensors, torch tensors sharing their memory)
+        are reused, and overwritten by the next call.
+        """
+        return self.gather(self.sample_indices(), tensors)
 
     def __len__(self):
         """Return the current size of internal memory."""
-        return len(self.memory)
\ No newline at end of file
+        return self.size
+
+    def stored_arrays(self):
+        """Names of the arrays holding the experiences, one row per experience."""
+        return ["states", "actions", "rewards", "next_states", "dones"] + (
+            [] if self.next_masks is None else ["next_masks"]) + ([] if self.lords is None else ["lords"])
+
+    def rescore(self, chunk_size=65536, **score_options):
+        """Recompute the rewards of all experiences from their states and lord cards,
+        e.g. after changing the score weights, without replaying any games.
+
+        Params
+        ======
+            chunk_size (int): number of experiences rescored at a time
+            score_options: weights, bonusTable, opponents and opponentWeight of scoring.rescoreRewards
+        """
+        if self.lords is None:
+            raise ValueError("Can only rescore a buffer which stores lord cards.")
+        for start in range(0, self.size, chunk_size):
+            end = min(start + chunk_size, self.size)
+            self.rewards[start:end, 0] = rescoreRewards(
+                self.states[start:end], self.next_states[start:end], self.state_players,
+                self.lords[start:end], encoded=self.num_players is not None, **score_options)
+
+    def state_dict(self):
+        """Return the contents of the buffer: its filled rows (as views, not copies),
+        write position and random generator state."""
+        state = {"position": self.position, "size": self.size, "rng": self.rng.bit_generator.state}
+        for name in self.stored_arrays():
+            state[name] = getattr(self, name)[:self.size]
+        return state
+
+    def load_state_dict(self, state):
+        """Restore the contents returned by state_dict.
+
+        The arrays of a full buffer are used as they are, so that arrays mapped from
+        disk (see checkpoint.py) are only read in as they are sampled. Those of a
+        partly filled one are copied into the buffer's own arrays.
+        """
+        if state["size"] > self.buffer_size:
+            raise ValueError("Replay buffer state holds more experiences than the buffer.")
+        for name in self.stored_arrays():
+            array, stored = state[name], getattr(self, name)
+            if array.shape[1:] != stored.shape[1:] or array.dtype != stored.dtype or len(array) != state["size"]:
+                raise ValueError(f"Replay buffer state has {array.dtype} {name} of shape {array.shape}, "
+                                 f"expected {stored.dtype} rows of shape {stored.shape[1:]}.")
+            if state["size"] == self.buffer_size:
+                setattr(self, name, array)
+            else:
+                stored[:state["size"]] = array
+        self.position = state["position"]
+        self.size = state["size"]
+        self.rng.bit_generator.state = state["rng"]
+
+
+class SumTree:
+    """Array-based binary tree of priorities, where each node holds the sum (or min) of its children.
+
+    All operations take batches of leaf indices and run one vectorized step per tree level.
+    """
+
+    def __init__(self, size, operation=np.add, empty_value=0.):
+        """Initialize a SumTree object.
+
+        Params
+        ======
+            size (int): number of leaves
+            operation (ufunc): how to combine two children, np.add for a sum-tree or np.minimum for a min-tree
+            empty_value (float): value of unused leaves, 0 for a sum-tree or np.inf for a min-tree
+        """
+        self.capacity = 1
+        while self.capacity < size:
+            self.capacity *= 2
+        self.operation = operation
+        # Node 1 is the root, and the children of node i are 2i and 2i + 1
+        self.tree = np.full(2 * self.capacity, empty_value, dtype=np.float64)
+
+    def update(self, indices, values):
+        """Set the leaves at the given indices to values, and update their ancestors."""
+        nodes = np.asarray(indices) + self.capacity
+        if len(nodes) == 0:
+            return
+        self.tree[nodes] = values
+        nodes = np.unique(nodes // 2)
+        while nodes[0] >= 1:
+            self.tree[nodes] = self.operation(self.tree[2 * nodes], self.tree[2 * nodes + 1])
+            nodes = np.unique(nodes // 2)
+
+    def root(self):
+        """Return the sum (or min) over all leaves."""
+        return self.tree[1]
+
+    def leaves(self, indices):
+        """Return the values of the leaves at the given indices."""
+        return self.tree[np.asarray(indices) + self.capacity]
+
+    def find_prefix_sums(self, targets):
+        """For each target, find the first leaf whose prefix sum exceeds it (sum-trees only)."""
+        nodes = np.ones(len(targets), dtype=np.int64)
+        targets = np.array(targets, dtype=np.float64)
+        while nodes[0] < self.capacity:
+            left = self.tree[2 * nodes]
+            go_right = targets >= left
+            targets -= left * go_right
+            nodes = 2 * nodes + go_right
+        return nodes - self.capacity
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    """Replay buffer which samples experiences in proportion to their TD error (prioritized experience replay)."""
+
+    def __init__(self, buffer_size, batch_size, seed, state_size, action_size=None, num_players=None,
+                 store_lords=False, alpha=0.6, beta=0.4, beta_increment=1e-4, epsilon=1e-5):
+        """Initialize a PrioritizedReplayBuffer object.
+
+        Params
+        ======
+            buffer_size (int): maximum size of buffer
+            batch_size (int): size of each training batch
+            seed (int): random seed
+            state_size (int): size of each featurized state
+            action_size (int): number of actions, to also store next states' legal action masks
+            num_players (int): number of players, to store states encoded as uint8 (see ReplayBuffer)
+            store_lords (bool): whether to also store the lord cards of each experience (see ReplayBuffer)
+            alpha (float): how strongly to prioritize, 0 for uniform sampling
+            beta (float): initial strength of the importance-sampling correction, annealed towards 1
+            beta_increment (float): increase of beta after each sample
+            epsilon (float): added to each |TD error| so that no experience has zero priority
+        """
+        super(PrioritizedReplayBuffer, self).__init__(buffer_size, batch_size, seed, state_size, action_size,
+                                                      num_players, store_lords)
+        self.alpha = alpha
+        self.beta = beta
+        self.beta_increment = beta_increment
+        self.epsilon = epsilon
+
+        # Priorities (already raised to the power alpha)
+        self.sum_tree = SumTree(buffer_size)
+        self.min_tree = SumTree(buffer_size, np.minimum, np.inf)
+        # New experiences get the largest priority seen so far, so each is trained on at least once
+        self.max_priority = 1.
+
+        # Reusable output array for the importance-sampling weights
+        self.sample_weights = np.empty((batch_size, 1), dtype=np.float32)
+        self.sample_weights_tensor = torch.from_numpy(self.sample_weights)
+
+    def _set_new_priorities(self, rows):
+        """Give newly written rows the maximum priority."""
+        self.sum_tree.update(rows, self.max_priority)
+        self.min_tree.update(rows, self.max_priority)
+
+    def add(self, state, action, reward, next_state, end_state, next_mask=None, lords=None):
+        """Add a new experience to memory."""
+        row = self.position
+        super(PrioritizedReplayBuffer, self).add(state, action, reward, next_state, end_state, next_mask, lords)
+        self._set_new_priorities([row])
+
+    def add_batch(self, states, actions, rewards, next_states, end_states, next_masks=None, lords=None):
+        """Add a batch of experiences (e.g. one from each of many games) to memory."""
+        n = min(len(states), self.buffer_size)
+        rows = (self.position + np.arange(n)) % self.buffer_size
+        super(PrioritizedReplayBuffer, self).add_batch(states, actions, rewards, next_states, end_states,
+                                                       next_masks, lords)
+        self._set_new_priorities(rows)
+
+    def sample_indices(self):
+        """Draw the rows of a training batch in proportion to their priorities, one per equal-mass segment."""
+        segment = self.sum_tree.root() / self.batch_size
+        targets = (np.arange(self.batch_size) + self.rng.random(self.batch_size)) * segment
+        # Guard against rounding past the last filled leaf
+        return np.minimum(self.sum_tree.find_prefix_sums(targets), self.size - 1)
+
+    def sample(self, tensors=False):
+        """Sample a batch of experiences in proportion to their priorities.
+
+        Returns the batch of ReplayBuffer.sample (the reused states, actions, rewards, next_states,
+        dones and, if stored, next_masks), the (batch_size, 1) importance-sampling weights, to be
+        passed to DQLAgent.train, and the sampled rows, to be passed back to update_priorities
+        along with the TD errors. The weights are kept out of the batch so that they are never
+        mistaken for next_masks. With tensors, the arrays and weights are torch tensors sharing their memory.
+        """
+        indices = self.sample_indices()
+        batch = self.gather(indices, tensors)
+
+        # w_i = (N * P(i))^-beta, normalized by the largest possible weight
+        total = self.sum_tree.root()
+        probabilities = self.sum_tree.leaves(indices) / total
+        max_weight = (self.size * self.min_tree.root() / total) ** -self.beta
+        self.sample_weights[:, 0] = (self.size * probabilities) ** -self.beta / max_weight
+        self.beta = min(1., self.beta + self.beta_increment)
+        return batch, self.sample_weights_tensor if tensors else self.sample_weights, indices
+
+    def state_dict(self):
+        """Return the contents of the buffer (see ReplayBuffer.state_dict), with its priorities."""
+        state = super(PrioritizedReplayBuffer, self).state_dict()
+        state.update(sum_tree=self.sum_tree.tree, min_tree=self.min_tree.tree,
+                     max_priority=float(self.max_priority), beta=float(self.beta))
+        return state
+
+    def load_state_dict(self, state):
+        """Restore the contents returned by state_dict."""
+        super(PrioritizedReplayBuffer, self).load_state_dict(state)
+        for tree in ("sum_tree", "min_tree"):
+            if state[tree].shape != getattr(self, tree).tree.shape:
+                raise ValueError("Replay buffer state has priorities for a buffer of another size.")
+            getattr(self, tree).tree = state[tree]
+        self.max_priority = state["max_priority"]
+        self.beta = state["beta"]
+
+    def update_priorities(self, indices, td_errors):
+        """Set the priorities of sampled experiences from their new TD errors."""
+        priorities = (np.abs(td_errors) + self.epsilon) ** self.alpha
+        self.sum_tree.update(indices, priorities)
+        self.min_tree.update(indices, priorities)
+        self.max_priority = max(self.max_priority, priorities.max())
+
+
+def main():
+    # Train on prioritized samples end to end, with and without stored legal action masks
+    state_size, action_size, batch_size = 10, 4, 8
+    rng = np.random.default_rng(0)
+    for masks in [False, True]:
+        agent = DQLAgent(state_size, action_size, 16, batch_size, 1e-3, 0.9, 1., 0.1, 0.99, huber=masks)
+        memory = PrioritizedReplayBuffer(1000, batch_size, 0, state_size, action_size if masks else None)
+        n = 100
+        memory.add_batch(rng.random((n, state_size), dtype=np.float32), rng.integers(0, action_size, n),
+                         rng.random(n, dtype=np.float32), rng.random((n, state_size), dtype=np.float32),
+                         (rng.random(n) < 0.1).astype(np.float32),
+                         rng.random((n, action_size)) < 0.7 if masks else None)
+        for tensors in [False, True]:
+            batch, weights, indices = memory.sample(tensors=tensors)
+            assert len(batch) == (6 if masks else 5)
+            td_errors = agent.train(batch, weights)
+            assert td_errors.shape == (batch_size,) and np.isfinite(td_errors).all()
+            memory.update_priorities(indices, td_errors)
+            assert np.allclose(memory.sum_tree.leaves(indices), (np.abs(td_errors) + memory.epsilon) ** memory.alpha)
+    print("Trained on prioritized samples, with and without next-state masks.")
+
+    # Acting without any legal action is an error, whether exploring or not
+    for agent.epsilon in [1., 0.]:
+        try:
+            agent.act(np.zeros(state_size, dtype=np.float32), np.zeros(action_size, dtype=bool))
+            raise AssertionError("An action was chosen without any legal action.")
+        except ValueError:
+            pass
@@ -0,0 +1,224 @@
+import numpy as np
+from game_info import QUESTS, QUEST_TYPES, SCORE_WEIGHT_VECTOR, LORD_QUEST_BONUS
+from batched_game import BatchedGameState
+from featurize import (PLAYER_RESOURCE_COLUMNS, PLAYER_QUESTS_OFFSET, PLAYER_FEATURE_LEN, QUEST_FEATURE_LEN,
+                       MAX_QUESTS, ENCODED_PLAYER_LEN, boardFeatureLen, encodedStateLen)
+
+# Player.score for many players at once: a weight vector over RESOURCES
+# applied to resource counts, plus a lord card x quest type bonus table
+# applied to counts of completed quests by type. Any weights and table
+# can be passed instead of Player.score's, e.g. to reshape the rewards
+# stored in a replay buffer (see rescoreRewards).
+
+# Quests are counted by type by summing their type packed into an integer,
+# 1 << (TYPE_COUNT_BITS * type), which leaves room to count all of QUESTS
+TYPE_COUNT_BITS = 5
+assert len(QUESTS) < 1 << TYPE_COUNT_BITS
+
+# Packed type of each quest, with EMPTY quest slots (index -1) counted as no quest
+QUEST_PACKED_TYPES = np.array([1 << (TYPE_COUNT_BITS * QUEST_TYPES.index(quest.type)) for quest in QUESTS] + [0],
+                              dtype=np.int32)
+
+# Packed type of each uint8 quest code of an encoded state (see featurize.encodeStates)
+CODE_PACKED_TYPES = np.zeros(256, dtype=np.int32)
+CODE_PACKED_TYPES[:len(QUESTS)] = QUEST_PACKED_TYPES[:-1]
+
+def _unpackTypeCounts(packed: np.ndarray) -> np.ndarray:
+    '''Unpack (...) sums of packed quest types into (..., len(QUEST_TYPES)) counts.'''
+    shifts = TYPE_COUNT_BITS * np.arange(len(QUEST_TYPES), dtype=np.int32)
+    return (packed[..., None] >> shifts) & ((1 << TYPE_COUNT_BITS) - 1)
+
+def questTypeCounts(quests: np.ndarray) -> np.ndarray:
+    '''
+    Count quests by type.
+
+    Args:
+        quests: the (..., numQuests) indices in QUESTS of some
+            quests, padded with EMPTY.
+
+    Returns:
+        the (..., len(QUEST_TYPES)) number of quests of each type.
+    '''
+    return _unpackTypeCounts(QUEST_PACKED_TYPES[quests].sum(axis=-1))
+
+def scores(resources: np.ndarray, questTypes: np.ndarray, lordCards: np.ndarray,
+           weights: np.ndarray = SCORE_WEIGHT_VECTOR, bonusTable: np.ndarray = LORD_QUEST_BONUS) -> np.ndarray:
+    '''
+    Compute Player.score for any number of players.
+
+    Args:
+        resources: the (..., len(weights)) resource counts of each player.
+        questTypes: the (..., len(QUEST_TYPES)) number of completed
+            quests of each type of each player.
+        lordCards: the (...) index in LORD_CARDS of the lord card of each player.
+        weights (optional): the weight of each resource.
+        bonusTable (optional): the (len(LORD_CARDS), len(QUEST_TYPES)) bonus
+            of each lord card for each completed quest of each type.
+
+    Returns:
+        the (...) score of each player.
+    '''
+    return resources @ weights + np.einsum("...t,...t->...", bonusTable[lordCards], questTypes)
+
+def relativeScores(scores: np.ndarray, opponents: str = "mean", weight: float = 1.) -> np.ndarray:
+    '''
+    Subtract the scores of each player's opponents from their score, so
+    that helping the other players is punished.
+
+    Args:
+        scores: the (..., numPlayers) scores of the players of each game.
+        opponents (optional): how to combine the scores of the opponents,
+            "mean", "max" or "sum".
+        weight (optional): the weight of the opponents' combined score.
+
+    Returns:
+        the (..., numPlayers) relative scores.
+    '''
+    numPlayers = scores.shape[-1]
+    total = scores.sum(axis=-1, keepdims=True)
+    if opponents == "mean":
+        others = (total - scores) / (numPlayers - 1)
+    elif opponents == "sum":
+        others = total - scores
+    elif opponents == "max":
+        # The best opponent of the leader is the runner-up
+        ranked = np.sort(scores, axis=-1)
+        others = np.where(scores >= ranked[..., -1:], ranked[..., -2:-1], ranked[..., -1:])
+    else:
+        raise ValueError("opponents must be 'mean', 'max' or 'sum'.")
+    return scores - weight * others
+
+def batchScores(batch: BatchedGameState, games: np.ndarray = None,
+                weights: np.ndarray = SCORE_WEIGHT_VECTOR, bonusTable: np.ndarray = LORD_QUEST_BONUS) -> np.ndarray:
+    '''
+    Compute Player.score for every player of the games of a BatchedGameState.
+
+    Args:
+        batch: the batched game states.
+        games (optional): the indices of the games. Defaults to all games.
+        weights, bonusTable (optional): as in scores.
+
+    Returns:
+        the (len(games), numPlayers) scores, indexed by player like batch.resources.
+    '''
+    if games is None:
+        games = np.arange(batch.numGames)
+    return scores(batch.resources[games], questTypeCounts(batch.completedQuests[games]),
+                  batch.lordCards[games], weights, bonusTable)
+
+def stateScores(states: np.ndarray, numPlayers: int, lordCards: np.ndarray, encoded: bool = False,
+                weights: np.ndarray = SCORE_WEIGHT_VECTOR, bonusTable: np.ndarray = LORD_QUEST_BONUS) -> np.ndarray:
+    '''
+    Compute Player.score for every player of featurized states, from their
+    resource features and the quest types of their completed quest blocks
+    (only the first MAX_QUESTS completed quests of each player are featurized).
+
+    Args:
+        states: the (batch, stateFeatureLen(numPlayers)) featurized states,
+            or with encoded, the (batch, encodedStateLen(numPlayers)) encoded
+            states (see featurize.encodeStates).
+        numPlayers: the number of players in each game.
+        lordCards: the (batch, numPlayers) index in LORD_CARDS of the lord card
+            of each player, in turn order like the player features.
+        encoded (optional): whether the states are encoded.
+        weights, bonusTable (optional): as in scores.
+
+    Returns:
+        the (batch, numPlayers) scores, in turn order.
+    '''
+    n = len(states)
+    weights = np.asarray(weights)[PLAYER_RESOURCE_COLUMNS]
+    if encoded:
+        players = states[:, encodedStateLen(numPlayers) - numPlayers * ENCODED_PLAYER_LEN:].reshape(
+            n, numPlayers, ENCODED_PLAYER_LEN)
+        questTypes = _unpackTypeCounts(CODE_PACKED_TYPES[players[:, :, PLAYER_QUESTS_OFFSET + MAX_QUESTS:]].sum(axis=2))
+    else:
+        players = states[:, 1 + boardFeatureLen(numPlayers):].reshape(n, numPlayers, PLAYER_FEATURE_LEN)
+        # Each quest block starts with the one-hot quest type
+        completed = players[:, :, PLAYER_QUESTS_OFFSET + MAX_QUESTS * QUEST_FEATURE_LEN:]
+        questTypes = completed.reshape(n, numPlayers, MAX_QUESTS, QUEST_FEATURE_LEN)[..., :len(QUEST_TYPES)].sum(axis=2)
+    return scores(players[:, :, 1:PLAYER_QUESTS_OFFSET].astype(np.float64), questTypes, lordCards, weights, bonusTable)
+
+def rescoreRewards(states: np.ndarray, nextStates: np.ndarray, numPlayers: int, lordCards: np.ndarray,
+                   encoded: bool = False, weights: np.ndarray = SCORE_WEIGHT_VECTOR,
+                   bonusTable: np.ndarray = LORD_QUEST_BONUS, opponents: str = None,
+                   opponentWeight: float = 1.) -> np.ndarray:
+    '''
+    Recompute the rewards of stored transitions with other score weights, without
+    replaying their games. Each transition goes from one of a player's decisions
+    to their next one (or the end of the game), with the player to move first in
+    both states (see actor_pool.play_game), and its reward is the change in their score.
+
+    Args:
+        states, nextStates: the featurized (or encoded) states of the transitions.
+        numPlayers, lordCards, encoded: as in stateScores, with the lord cards
+            in turn order from the player to move.
+        weights, bonusTable (optional): as in scores.
+        opponents (optional): how to combine the opponents' scores (see
+            relativeScores) to subtract from the player's, or None not to.
+        opponentWeight (optional): the weight of the opponents' combined score.
+
+    Returns:
+        the (batch,) rewards.
+    '''
+    before = stateScores(states, numPlayers, lordCards, encoded, weights, bonusTable)
+    after = stateScores(nextStates, numPlayers, lordCards, encoded, weights, bonusTable)
+    if opponents is not None:
+        before = relativeScores(before, opponents, opponentWeight)
+        after = relativeScores(after, opponents, opponentWeight)
+    return (after - before)[:, 0]
+
+
+def main():
+    # Check the batched scores against Player.score on random games
+    import time
+    from actor_pool import play_game
+    from q_network import Q_network
+    from featurize import stateFeatureLen, encodeStates, NUM_ACTIONS
+    from game import GameState
+    from actions import legalActions, takeAction
+    gameStates = [GameState() for _ in range(64)]
+    rng = np.random.default_rng(0)
+    for gameState in gameStates:
+        for _ in range(rng.integers(0, 60)):
+            if gameState.isOver():
+                break
+            moves = legalActions(gameState)
+            takeAction(gameState, moves[rng.integers(len(moves))])
+    batch = BatchedGameState.fromGameStates(gameStates)
+    expected = np.array([[player.score() for player in sorted(gameState.players, key=lambda p: p.name)]
+                         for gameState in gameStates])
+    names = sorted(gameStates[0].playerNames)
+    order = [names.index(name) for name in batch.playerNames]
+    assert np.allclose(batchScores(batch), expected[:, order])
+    print("batchScores matches Player.score on", len(gameStates), "games.")
+
+    # Rescore self-play transitions with Player.score's weights, then compare speeds
+    q_network = Q_network(stateFeatureLen(3), NUM_ACTIONS, 64)
+    lords, games = [], []
+    for _ in range(20):
+        games.append(play_game(q_network, 0.5, num_players=3, lords=lords))
+    states, actions, rewards, nextStates, dones, nextMasks = [np.concatenate(arrays) for arrays in zip(*games)]
+    lords = np.concatenate(lords)
+    assert np.allclose(rescoreRewards(states, nextStates, 3, lords), rewards)
+    codes, nextCodes = encodeStates(states, 3), encodeStates(nextStates, 3)
+    assert np.allclose(rescoreRewards(codes, nextCodes, 3, lords, encoded=True), rewards)
+    print("rescoreRewards matches play_game's rewards on", len(rewards), "transitions.")
+
+    many = np.tile(codes, (50, 1)), np.tile(nextCodes, (50, 1)), np.tile(lords, (50, 1))
+    start = time.perf_counter()
+    relative = rescoreRewards(*many[:2], 3, many[2], encoded=True, opponents="mean")
+    elapsed = time.perf_counter() - start
+    print(f"Rescored {len(relative)} encoded transitions (relative to the opponents) "
+          f"in {elapsed * 1e3:.0f} ms ({len(relative) / elapsed / 1e6:.1f}M/s)")
+
+    players = [player for gameState in gameStates for player in gameState.players] * 20
+    start = time.perf_counter()
+    for player in players:
+        player.score()
+    loop = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(20):
+        batchScores(batch)
+    print(f"Player.score: {loop / len(players) * 1e6:.2f} us/player, "
+          f"batchScores: {(time.perf_counter() - start) / len(players) * 1e6:.3f} us/player")
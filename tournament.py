@@ -0,0 +1,368 @@
+import os
+import sys
+import math
+import random
+import time
+import multiprocessing as mp
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from itertools import combinations
+import numpy as np
+from game import GameState
+from game_info import SCORE_WEIGHTS, LORD_BONUS
+from featurize import featurizeGameState, stateFeatureLen, NUM_ACTIONS
+from actions import takeAction
+from trajectory import NUM_ROUNDS
+from launcher import worker_context, GAME_MODULES
+
+# torch is only imported by the policies that need it, so that workers
+# playing heuristic or random policies start without it
+
+# Elo points per natural unit of the logistic rating scale
+ELO_SCALE = 400 / math.log(10)
+
+# Outcome of a head-to-head match (see Tournament.match): the number of seed groups and games
+# played, the mean score of a against b (1 per pairwise win, 1/2 per draw), the Elo difference
+# of a over b it implies with the half width of its 95% confidence interval, the SPRT
+# log-likelihood ratio and decision ("H1": a is stronger, "H0": it is not, or None)
+MatchResult = namedtuple("MatchResult", ["a", "b", "groups", "games", "score", "elo", "elo_ci",
+                                         "llr", "decision", "elapsed"])
+
+
+class GreedyScorePolicy:
+    """Heuristic bot, as a Player.policy: take the move that raises the player's Player.score
+    the most, looking one move ahead on a clone of the game, plus a share of the value of their
+    most promising active quest (its VP and lord bonus, less the moves still needed to collect
+    its requirements). Ties are broken at random."""
+
+    def __init__(self, quest_weight=0.5):
+        """Initialize a GreedyScorePolicy object.
+
+        Params
+        ======
+            quest_weight (float): weight of the value of the most promising active quest
+        """
+        self.quest_weight = quest_weight
+
+    def value(self, player):
+        """Player.score of player plus the weighted value of their most promising active quest."""
+        best = 0.
+        for quest in player.activeQuests:
+            missing = sum(max(number - player.resources[resource], 0) * SCORE_WEIGHTS[resource]
+                          for resource, number in quest.requirements.items())
+            bonus = LORD_BONUS if quest.type in player.lordCard else 0
+            best = max(best, quest.rewards.get("VP", 0) + bonus - missing)
+        return player.score() + self.quest_weight * best
+
+    def __call__(self, game, possible_moves):
+        player_name = game.players[0].name
+        best_moves, best_value = [], -math.inf
+        for move in possible_moves:
+            lookahead = game.clone()
+            takeAction(lookahead, move)
+            value = self.value(next(player for player in lookahead.players if player.name == player_name))
+            if value > best_value:
+                best_moves, best_value = [move], value
+            elif value == best_value:
+                best_moves.append(move)
+        return random.choice(best_moves)
+
+
+class QNetworkPolicy:
+    """Greedy legal move of a Q-network, as a Player.policy.
+
+    Holds the weights rather than the network, so that it pickles cheaply to
+    tournament workers, which build the network (and import torch) on their first move.
+    """
+
+    def __init__(self, state_dict, hidden_size, num_players=3, network_class=None):
+        """Initialize a QNetworkPolicy object.
+
+        Params
+        ======
+            state_dict (dict): weights of the network
+            hidden_size (int): hidden size of the network, as in DQLAgent
+            num_players (int): number of players in the games played
+            network_class (type): Q_network (the default) or Shared_Q_network
+        """
+        self.state_dict = state_dict
+        self.hidden_size = hidden_size
+        self.num_players = num_players
+        self.network_class = network_class
+        self.q_network = None
+
+    @classmethod
+    def from_checkpoint(cls, path, hidden_size, num_players=3, network_class=None):
+        """Load the online network of a checkpoint written by checkpoint.save_checkpoint."""
+        import torch
+        state = torch.load(os.path.join(path, "state.pt"), weights_only=True)
+        return cls(state["agent"]["q_network"], hidden_size, num_players, network_class)
+
+    def __getstate__(self):
+        return {**self.__dict__, "q_network": None}
+
+    def __call__(self, game, possible_moves):
+        import torch
+        if self.q_network is None:
+            from q_network import Q_network
+            network_class = self.network_class or Q_network
+            self.q_network = network_class(stateFeatureLen(self.num_players), NUM_ACTIONS, self.hidden_size)
+            self.q_network.load_state_dict(self.state_dict)
+            self.q_network.eval()
+        with torch.no_grad():
+            q_values = self.q_network(torch.from_numpy(featurizeGameState(game)).unsqueeze(0))[0].numpy()
+        return int(possible_moves[np.argmax(q_values[possible_moves])])
+
+
+def seatings(a, b, num_players):
+    """Every distinct assignment of policies a and b to the positions in the first turn order,
+    alternating a and b around the table and rotated through all positions."""
+    lineups = [tuple((a, b)[(i + first) % 2] for i in range(num_players)) for first in range(2)]
+    return sorted({lineup[r:] + lineup[:r] for lineup in lineups for r in range(num_players)})
+
+
+# Policies of a tournament worker process, by name (None plays random moves)
+worker_policies = {}
+
+
+def init_worker(policies):
+    """Initialize a tournament worker process with the policies of the tournament."""
+    worker_policies.update(policies)
+    # Loaded if any policy holds tensors
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(1)
+
+
+def play_group(a, b, seed, num_players, num_rounds):
+    """Play the games of one seed between policies a and b, one per seating (see seatings),
+    so that each policy gets every position and lord card of the deal.
+
+    Returns the pairwise points of a against b and of b against a, summed over the games,
+    and the number of games.
+    """
+    a_points, b_points = 0., 0.
+    games = seatings(a, b, num_players)
+    for seating in games:
+        random.seed(seed)
+        if "torch" in sys.modules:
+            sys.modules["torch"].manual_seed(seed)
+        game = GameState(num_players, num_rounds, seed=seed)
+        names = {}
+        for player, name in zip(game.players, seating):
+            player.policy = worker_policies[name]
+            names[player.name] = name
+        game.runGame()
+        a_scores = [player.score() for player in game.players if names[player.name] == a]
+        b_scores = [player.score() for player in game.players if names[player.name] == b]
+        for a_score in a_scores:
+            for b_score in b_scores:
+                a_points += (a_score > b_score) + (a_score == b_score) / 2
+                b_points += (b_score > a_score) + (a_score == b_score) / 2
+    return a_points, b_points, len(games)
+
+
+def elo_ratings(points, prior_draws=1.):
+    """Fit Elo ratings (Bradley-Terry by maximum likelihood) to pairwise results.
+
+    Params
+    ======
+        points (array): (k, k) points scored by each policy against each other one,
+            1 per win and 1/2 per draw
+        prior_draws (float): draws added between each pair that played, which keeps
+            the ratings of unbeaten or winless policies finite
+
+    Returns the (k,) ratings, with a mean of 0, and the (k,) half widths of their 95% confidence intervals.
+    """
+    played = (points + points.T) > 0
+    wins = points + prior_draws / 2 * played
+    games = wins + wins.T
+    ratings = np.zeros(len(points))
+    for _ in range(100):
+        expected = 1 / (1 + np.exp(ratings[None, :] - ratings[:, None]))
+        gradient = (wins - games * expected).sum(axis=1)
+        information = games * expected * (1 - expected)
+        information = np.diag(information.sum(axis=1)) - information
+        # The ratings are only defined up to a constant, hence the pseudo-inverse
+        covariance = np.linalg.pinv(information)
+        step = covariance @ gradient
+        ratings += step - step.mean()
+        if np.abs(step).max() < 1e-9:
+            break
+    return ratings * ELO_SCALE, 1.96 * np.sqrt(np.maximum(np.diag(covariance), 0)) * ELO_SCALE
+
+
+def score_elo(score):
+    """Elo difference implied by a mean pairwise score."""
+    score = min(max(score, 1e-6), 1 - 1e-6)
+    return -400 * math.log10(1 / score - 1)
+
+
+class SPRT:
+    """Sequential probability ratio test between two Elo differences, on the mean scores of
+    seed groups (whose games are correlated, since they share a deal), with a normal
+    approximation of their distribution as in chess engine testing."""
+
+    def __init__(self, elo0=0., elo1=20., alpha=0.05, beta=0.05, min_groups=8):
+        """Initialize an SPRT object.
+
+        Params
+        ======
+            elo0 (float): Elo difference of the null hypothesis
+            elo1 (float): Elo difference of the alternative hypothesis
+            alpha (float): probability of accepting H1 when H0 holds
+            beta (float): probability of accepting H0 when H1 holds
+            min_groups (int): groups played before any decision, so that the variance is meaningful
+        """
+        self.score0 = 1 / (1 + 10 ** (-elo0 / 400))
+        self.score1 = 1 / (1 + 10 ** (-elo1 / 400))
+        self.lower = math.log(beta / (1 - alpha))
+        self.upper = math.log((1 - beta) / alpha)
+        self.min_groups = min_groups
+
+    def llr(self, scores):
+        """Log-likelihood ratio of H1 against H0 given the mean score of each group."""
+        if len(scores) < 2:
+            return 0.
+        # Floored so that a clean sweep does not divide by zero
+        variance = max(np.var(scores), 1e-4)
+        return len(scores) * (self.score1 - self.score0) * (2 * np.mean(scores) - self.score0 - self.score1) \
+            / (2 * variance)
+
+    def decide(self, scores):
+        """Return "H1", "H0" or None (keep playing), and the log-likelihood ratio."""
+        llr = self.llr(scores)
+        if len(scores) < self.min_groups:
+            return None, llr
+        if llr >= self.upper:
+            return "H1", llr
+        if llr <= self.lower:
+            return "H0", llr
+        return None, llr
+
+
+class Tournament:
+    """Head-to-head matches between policies on a process pool, with Elo ratings.
+
+    Policies are Player.policy callables (or None for random moves), e.g. a QNetworkPolicy,
+    a GreedyScorePolicy or an mcts.MCTS, and must pickle to the worker processes.
+    Every match plays GameState games of num_players seats, with the two policies
+    alternating around the table, in groups of games sharing a seed with the seats
+    rotated (see seatings), which cancels out most of the luck of the deal.
+    """
+
+    def __init__(self, policies, num_players=3, num_rounds=NUM_ROUNDS, num_workers=None, seed=0,
+                 start_method=None):
+        """Initialize a Tournament object and start its worker processes.
+
+        Params
+        ======
+            policies (dict): policy by name
+            num_players (int): number of players in each game, 2 to 5
+            num_rounds (int): number of rounds in each game
+            num_workers (int): number of worker processes, or None for the number of CPUs
+            seed (int): seed of the first group of games, the next groups use the following seeds
+            start_method (str): multiprocessing start method (see launcher.worker_context), or None for the default
+        """
+        assert 2 <= num_players <= 5
+        self.names = list(policies)
+        self.num_players = num_players
+        self.num_rounds = num_rounds
+        self.next_seed = seed
+        self.num_workers = num_workers or mp.cpu_count()
+        # points[i, j]: pairwise points scored by policy i against policy j
+        self.points = np.zeros((len(self.names), len(self.names)))
+        self.executor = ProcessPoolExecutor(self.num_workers, mp_context=worker_context(start_method, GAME_MODULES + ("tournament",)),
+                                            initializer=init_worker, initargs=(policies,))
+
+    def match(self, a, b, max_groups=100, sprt=None):
+        """Play groups of games between policies a and b, until max_groups or an SPRT decision.
+
+        Params
+        ======
+            a, b (str): names of the policies, e.g. the candidate and the baseline
+            max_groups (int): maximum number of seed groups to play
+            sprt (SPRT): sequential test stopping the match once the result is clear, or None
+
+        Returns a MatchResult. Every game played counts towards the ratings.
+        """
+        start = time.perf_counter()
+        i, j = self.names.index(a), self.names.index(b)
+        scores, games, decision, llr = [], 0, None, 0.
+        pending = set()
+        submitted = 0
+        while submitted < max_groups or pending:
+            # Keep a few groups per worker in flight, so that an early stop wastes little
+            while submitted < max_groups and decision is None and len(pending) < 2 * self.num_workers:
+                pending.add(self.executor.submit(play_group, a, b, self.next_seed, self.num_players,
+                                                 self.num_rounds))
+                self.next_seed += 1
+                submitted += 1
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                a_points, b_points, group_games = future.result()
+                self.points[i, j] += a_points
+                self.points[j, i] += b_points
+                scores.append(a_points / (a_points + b_points))
+                games += group_games
+            if decision is None and sprt is not None:
+                decision, llr = sprt.decide(scores)
+                if decision is not None:
+                    # Finish the groups already running, but start no more
+                    for future in pending:
+                        future.cancel()
+                    pending = {future for future in pending if not future.cancelled()}
+                    submitted = max_groups
+        score = float(np.mean(scores))
+        # Delta method on the standard error of the group scores
+        error = np.std(scores) / math.sqrt(len(scores)) if len(scores) > 1 else 0.5
+        slope = ELO_SCALE / max(score * (1 - score), 1e-6)
+        return MatchResult(a, b, len(scores), games, score, score_elo(score), 1.96 * error * slope,
+                           llr, decision, time.perf_counter() - start)
+
+    def round_robin(self, **match_options):
+        """Play a match between every pair of policies. Returns the MatchResults."""
+        return [self.match(a, b, **match_options) for a, b in combinations(self.names, 2)]
+
+    def gauntlet(self, candidate, opponents=None, **match_options):
+        """Play a match between candidate and each opponent (by default all other policies).
+        Returns the MatchResults."""
+        if opponents is None:
+            opponents = [name for name in self.names if name != candidate]
+        return [self.match(candidate, opponent, **match_options) for opponent in opponents]
+
+    def ratings(self, prior_draws=1.):
+        """Elo ratings of the policies from all games played so far (see elo_ratings).
+        Returns (rating, 95% confidence half width) by name."""
+        ratings, intervals = elo_ratings(self.points, prior_draws)
+        return {name: (rating, interval) for name, rating, interval in zip(self.names, ratings, intervals)}
+
+    def close(self):
+        """Stop the worker processes."""
+        self.executor.shutdown(cancel_futures=True)
+
+
+def main():
+    # Rate random, greedy and untrained network players, and gate the greedy bot with an SPRT
+    from q_network import Q_network
+    num_players = 3
+    q_network = Q_network(stateFeatureLen(num_players), NUM_ACTIONS, 64)
+    policies = {"random": None, "greedy": GreedyScorePolicy(),
+                "untrained": QNetworkPolicy(q_network.state_dict(), 64, num_players)}
+    tournament = Tournament(policies, num_players, num_workers=2)
+
+    sprt = SPRT(elo0=0., elo1=50.)
+    for result in tournament.gauntlet("greedy", max_groups=60, sprt=sprt):
+        print(f"greedy vs {result.b}: score {result.score:.3f}, {result.elo:+.0f} +/- {result.elo_ci:.0f} Elo, "
+              f"LLR {result.llr:.2f} -> {result.decision} after {result.groups} groups "
+              f"({result.games} games, {result.games / result.elapsed:.1f} games/s)")
+    result = tournament.match("untrained", "random", max_groups=6)
+    print(f"untrained vs random: score {result.score:.3f} over {result.games} games")
+    for name, (rating, interval) in sorted(tournament.ratings().items(), key=lambda item: -item[1][0]):
+        print(f"{name:>10}: {rating:+6.0f} +/- {interval:.0f}")
+    tournament.close()
+
+    # The fitted ratings reproduce known ones on simulated results
+    true = np.array([0., 100., 300.])
+    expected = 1 / (1 + 10 ** ((true[None, :] - true[:, None]) / 400))
+    ratings, _ = elo_ratings(10000 * expected * (1 - np.eye(3)), prior_draws=0.)
+    assert np.allclose(ratings - ratings.mean(), true - true.mean(), atol=1e-6)
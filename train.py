@@ -72,7 +72,7 @@ max_steps = ...
 agent = DQLAgent(state_size, action_size, hidden_size, batch_size, learning_rate, gamma, epsilon_start, epsilon_end, epsilon_decay)
 
 # Create an instance of the ReplayBuffer class
-memory = ReplayBuffer(buffer_size, batch_size, seed)
+memory = ReplayBuffer(buffer_size, batch_size, seed, state_size)
 
 # Train the agent
 for episode in range(max_episodes):
@@ -93,7 +93,7 @@ for episode in range(max_episodes):
         if len(memory) < batch_size: 
             continue
         
-        batch = memory.sample(batch_size)
+        batch = memory.sample(tensors=True)
 
         # Train the Q-network using the sampled batch of experience tuples
         agent.train(batch)
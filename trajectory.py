@@ -0,0 +1,162 @@
+from collections import namedtuple
+import numpy as np
+from game import GameState
+from batched_game import BatchedGameState
+from featurize import featurizeGameStateBatch, stateFeatureLen, rotatePlayers, NUM_ACTIONS
+from actions import legalActionMaskBatch, takeAction, takeActionBatch
+from launcher import worker_context, GAME_MODULES
+
+# Number of rounds of self-play games
+NUM_ROUNDS = 8
+
+# A finished game stored as the seed of its GameState and the actions taken, with the
+# reward of the transition starting at each action (see actor_pool.play_game). Every
+# shuffle in a game comes from its seed, so this is enough to rebuild all of its states.
+Trajectory = namedtuple("Trajectory", ["seed", "num_players", "num_rounds", "actions", "rewards"])
+
+
+def replay_game(trajectory, num_steps=None):
+    """Rebuild the GameState of a trajectory after its first num_steps actions (or all of them)."""
+    game = GameState(trajectory.num_players, trajectory.num_rounds, seed=trajectory.seed)
+    for action in trajectory.actions[:num_steps]:
+        takeAction(game, int(action))
+    return game
+
+
+def replay_transitions(trajectories, lords=None):
+    """Rebuild the transitions of trajectories with the same number of players.
+
+    All games are stepped in lockstep in a BatchedGameState and featurized in bulk.
+    Returns states, actions, rewards, next_states, dones and next_masks as in
+    actor_pool.play_game, with one row per action in trajectory order.
+    If lords is a list, the lord cards of each transition are appended to it as in play_game.
+    """
+    num_players = trajectories[0].num_players
+    assert all(trajectory.num_players == num_players for trajectory in trajectories)
+    lengths = np.array([len(trajectory.actions) for trajectory in trajectories])
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    total = offsets[-1]
+    actions = np.concatenate([trajectory.actions for trajectory in trajectories]).astype(np.int64)
+    rewards = np.concatenate([trajectory.rewards for trajectory in trajectories]).astype(np.float32)
+
+    state_size = stateFeatureLen(num_players)
+    states = np.empty((total, state_size), dtype=np.float32)
+    masks = np.empty((total, NUM_ACTIONS), dtype=bool)
+    movers = np.empty(total, dtype=np.int32)
+    lord_cards = np.empty((total, num_players), dtype=np.uint8)
+    batch = BatchedGameState.fromGameStates(
+        [GameState(num_players, trajectory.num_rounds, seed=trajectory.seed) for trajectory in trajectories])
+    features = np.empty((len(trajectories), state_size), dtype=np.float32)
+    for step in range(lengths.max()):
+        games = np.flatnonzero(lengths > step)
+        rows = offsets[games] + step
+        featurizeGameStateBatch(batch, features[:len(games)], games)
+        states[rows] = features[:len(games)]
+        masks[rows] = legalActionMaskBatch(batch, games)
+        movers[rows] = batch.currentPlayers(games)
+        lord_cards[rows] = np.take_along_axis(batch.lordCards[games], batch.turnOrder[games], axis=1)
+        takeActionBatch(batch, games, actions[rows])
+    if not np.all(batch.isOver()):
+        raise ValueError("Trajectories must hold finished games.")
+    featurizeGameStateBatch(batch, features)
+
+    # Each transition goes to the next row of the same game with the same player to move
+    game_of_row = np.repeat(np.arange(len(trajectories)), lengths)
+    order = np.lexsort((np.arange(total), movers, game_of_row))
+    same = ((game_of_row[order[1:]] == game_of_row[order[:-1]])
+            & (movers[order[1:]] == movers[order[:-1]]))
+    next_rows = np.full(total, -1)
+    next_rows[order[:-1][same]] = order[1:][same]
+    dones = next_rows < 0
+    next_states = states[next_rows]
+    # The final state as if it were the turn of the transition's player
+    positions = np.argmax(batch.turnOrder[game_of_row[dones]] == movers[dones, None], axis=1)
+    next_states[dones] = rotatePlayers(features[game_of_row[dones]], num_players, positions)
+    next_masks = masks[next_rows]
+    next_masks[dones] = False
+    if lords is not None:
+        lords.append(lord_cards)
+    return states, actions, rewards, next_states, dones.astype(np.float32), next_masks
+
+
+def replay_parallel(trajectories, num_workers=None, chunk_size=64, start_method=None):
+    """Rebuild the transitions of trajectories in a process pool.
+
+    Yields the arrays of replay_transitions for chunks of at most chunk_size
+    trajectories with the same number of players, in order within each number
+    of players, e.g. to stream them into ReplayBuffer.add_batch.
+    """
+    chunks = []
+    for num_players in sorted({trajectory.num_players for trajectory in trajectories}):
+        group = [trajectory for trajectory in trajectories if trajectory.num_players == num_players]
+        chunks += [group[start:start + chunk_size] for start in range(0, len(group), chunk_size)]
+    with worker_context(start_method, GAME_MODULES + ("trajectory",)).Pool(num_workers) as pool:
+        yield from pool.imap(replay_transitions, chunks)
+
+
+def save_trajectories(path, trajectories):
+    """Save trajectories to a compressed .npz archive."""
+    np.savez_compressed(
+        path,
+        seeds=np.array([trajectory.seed for trajectory in trajectories], dtype=np.int64),
+        num_players=np.array([trajectory.num_players for trajectory in trajectories], dtype=np.uint8),
+        num_rounds=np.array([trajectory.num_rounds for trajectory in trajectories], dtype=np.uint8),
+        lengths=np.array([len(trajectory.actions) for trajectory in trajectories], dtype=np.int32),
+        actions=np.concatenate([trajectory.actions for trajectory in trajectories]).astype(np.uint8),
+        rewards=np.concatenate([trajectory.rewards for trajectory in trajectories]).astype(np.float32))
+
+
+def load_trajectories(path):
+    """Load the trajectories saved by save_trajectories."""
+    with np.load(path) as archive:
+        offsets = np.concatenate([[0], np.cumsum(archive["lengths"])])
+        actions, rewards = archive["actions"], archive["rewards"]
+        return [Trajectory(int(seed), int(num_players), int(num_rounds),
+                           actions[offsets[i]:offsets[i + 1]], rewards[offsets[i]:offsets[i + 1]])
+                for i, (seed, num_players, num_rounds)
+                in enumerate(zip(archive["seeds"], archive["num_players"], archive["num_rounds"]))]
+
+
+def main():
+    # Log self-play games, then check that replaying their trajectories gives back their transitions
+    import os
+    import tempfile
+    import time
+    from q_network import Q_network
+    from actor_pool import play_game
+    q_network = Q_network(stateFeatureLen(3), NUM_ACTIONS, 256)
+    log, played = [], []
+    for i in range(64):
+        played.append(play_game(q_network, 0.5, num_players=3, log=log))
+    played = [np.concatenate(arrays) for arrays in zip(*played)]
+
+    def canonical(transitions):
+        states, actions = transitions[0], transitions[1]
+        order = np.lexsort(np.column_stack([states, actions]).T)
+        return [array[order] for array in transitions]
+
+    start = time.perf_counter()
+    replayed = [np.concatenate(arrays) for arrays in zip(*[replay_transitions(log[i:i + 16])
+                                                           for i in range(0, len(log), 16)])]
+    serial = time.perf_counter() - start
+    for expected, actual in zip(canonical(played), canonical(replayed)):
+        assert np.array_equal(expected, actual)
+    print(f"Replayed transitions match play_game on {len(log)} games.")
+
+    start = time.perf_counter()
+    parallel = list(replay_parallel(log * 8, chunk_size=32))
+    parallel_time = time.perf_counter() - start
+    moves = sum(len(trajectory.actions) for trajectory in log)
+    print(f"replay: {moves / serial:.0f} transitions/s serial, "
+          f"{8 * moves / parallel_time:.0f} transitions/s with {os.cpu_count()} processes")
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "trajectories.npz")
+        save_trajectories(path, log)
+        loaded = load_trajectories(path)
+        assert all(a.seed == b.seed and np.array_equal(a.actions, b.actions) and np.array_equal(a.rewards, b.rewards)
+                   for a, b in zip(log, loaded))
+        archive_size = os.path.getsize(path)
+    transition_size = sum(array.nbytes for array in played)
+    print(f"{moves} transitions: {transition_size / moves:.0f} bytes/move featurized, "
+          f"{archive_size / moves:.1f} bytes/move archived ({transition_size / archive_size:.0f}x smaller)")
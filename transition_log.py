@@ -0,0 +1,349 @@
+import os
+import json
+import queue
+import struct
+import threading
+import time
+import numpy as np
+from featurize import stateFeatureLen, NUM_ACTIONS
+
+# Append-only log of self-play transitions on disk, e.g. to train offline on corpora larger
+# than RAM, or to train new architectures on old games without replaying them.
+#
+# A log is one file: a header giving the schema, then chunks of transitions, then an index
+# footer giving the offset and number of rows of each chunk. Each chunk stores its fields one
+# after the other (field-major), each as a raw C-ordered array aligned to ALIGNMENT bytes,
+# so that a reader memory-maps the file and views each field of each chunk in place.
+#
+#   header: MAGIC, uint32 length, JSON {"num_players", "fields": [[name, dtype, shape], ...]}
+#   chunk:  CHUNK_MAGIC, uint64 rows, then each field
+#   footer: JSON {"chunks": [[offset, rows], ...]}, uint64 length, FOOTER_MAGIC
+#
+# Reopening a log to append truncates its footer, and rewrites it on close. A log whose
+# writer died without a footer is indexed by walking its chunk headers instead, up to the
+# last complete chunk.
+
+MAGIC = b"LOWTLOG1"
+CHUNK_MAGIC = b"LOWCHUNK"
+FOOTER_MAGIC = b"LOWINDEX"
+ALIGNMENT = 64
+
+
+def _aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def log_fields(num_players, store_lords=False):
+    """Fields of a transition log, as (name, dtype, shape per row), in the order of the arrays
+    of actor_pool.play_game (and ReplayBuffer.add_batch), with their dtypes, then optionally
+    the lord cards of the players in turn order (see scoring.rescoreRewards)."""
+    state_size = stateFeatureLen(num_players)
+    fields = [("states", "float32", (state_size,)), ("actions", "int64", ()), ("rewards", "float32", ()),
+              ("next_states", "float32", (state_size,)), ("dones", "float32", ()),
+              ("next_masks", "bool", (NUM_ACTIONS,))]
+    if store_lords:
+        fields.append(("lords", "uint8", (num_players,)))
+    return fields
+
+
+def _chunk_layout(fields, rows):
+    """Offsets of the fields of a chunk of rows from its start, and the size of the chunk."""
+    offsets = []
+    offset = ALIGNMENT # chunk header
+    for _, dtype, shape in fields:
+        offsets.append(offset)
+        offset = _aligned(offset + rows * np.dtype(dtype).itemsize * int(np.prod(shape)))
+    return offsets, offset
+
+
+def _read_header(file):
+    """Read the header of a log. Returns its schema and where the first chunk starts."""
+    if file.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a transition log.")
+    (length,) = struct.unpack("<I", file.read(4))
+    schema = json.loads(file.read(length))
+    schema["fields"] = [(name, dtype, tuple(shape)) for name, dtype, shape in schema["fields"]]
+    return schema, _aligned(len(MAGIC) + 4 + length)
+
+
+def _read_index(file, fields, data_start):
+    """Read the chunk index of a log, from its footer or else by walking its chunks.
+    Returns the (offset, rows) of each chunk and where the chunks end."""
+    size = file.seek(0, os.SEEK_END)
+    tail = 8 + len(FOOTER_MAGIC)
+    if size >= data_start + tail:
+        file.seek(size - tail)
+        (length,), magic = struct.unpack("<Q", file.read(8)), file.read(len(FOOTER_MAGIC))
+        if magic == FOOTER_MAGIC:
+            file.seek(size - tail - length)
+            chunks = [tuple(chunk) for chunk in json.loads(file.read(length))["chunks"]]
+            return chunks, size - tail - length
+    # No footer: keep the complete chunks
+    chunks, offset = [], data_start
+    while offset + ALIGNMENT <= size:
+        file.seek(offset)
+        if file.read(len(CHUNK_MAGIC)) != CHUNK_MAGIC:
+            break
+        (rows,) = struct.unpack("<Q", file.read(8))
+        chunk_size = _chunk_layout(fields, rows)[1]
+        if offset + chunk_size > size:
+            break
+        chunks.append((offset, rows))
+        offset += chunk_size
+    return chunks, offset
+
+
+class TransitionLogWriter:
+    """Stream transitions to a log on a background thread.
+
+    append copies transitions into the current chunk, and full chunks are written by a
+    background thread while self-play goes on. Chunk buffers are recycled, and at most
+    max_pending full chunks wait to be written, after which append blocks.
+    """
+
+    def __init__(self, path, num_players=3, chunk_rows=4096, store_lords=False, max_pending=4):
+        """Open a log to append to, creating it if needed.
+
+        Params
+        ======
+            path (str): the log file
+            num_players (int): number of players of the games logged
+            chunk_rows (int): transitions per chunk
+            store_lords (bool): whether to log the lord cards of the players, passed to append
+            max_pending (int): number of full chunks waiting to be written before append blocks
+        """
+        self.path = path
+        self.chunk_rows = chunk_rows
+        self.fields = log_fields(num_players, store_lords)
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            self.file = open(path, "r+b")
+            schema, data_start = _read_header(self.file)
+            if schema["fields"] != self.fields:
+                raise ValueError(f"{path} has fields {schema['fields']}, not {self.fields}.")
+            self.chunks, end = _read_index(self.file, self.fields, data_start)
+            self.file.truncate(end)
+            self.file.seek(end)
+        else:
+            self.file = open(path, "wb")
+            header = json.dumps({"num_players": num_players, "fields": self.fields}).encode()
+            self.file.write(MAGIC + struct.pack("<I", len(header)) + header)
+            self.file.write(bytes(_aligned(self.file.tell()) - self.file.tell()))
+            self.chunks = []
+
+        self.free = queue.Queue()
+        self.full = queue.Queue(max_pending)
+        self.buffer = self._new_buffer()
+        self.rows = 0
+        self.error = None
+        # Seconds spent waiting in append for a chunk to be written, and writing chunks
+        self.block_time = 0.
+        self.write_time = 0.
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def __len__(self):
+        """Number of transitions logged, including those not yet written."""
+        return sum(rows for _, rows in self.chunks) + self.full.qsize() * self.chunk_rows + self.rows
+
+    def _new_buffer(self):
+        try:
+            return self.free.get_nowait()
+        except queue.Empty:
+            return [np.empty((self.chunk_rows,) + shape, dtype=dtype) for _, dtype, shape in self.fields]
+
+    def append(self, *arrays):
+        """Log a batch of transitions, given as states, actions, rewards, next_states, dones
+        and next_masks arrays (e.g. from actor_pool.play_game), then lords with store_lords.
+        Errors of the writing thread are raised by the next call."""
+        self._raise_error()
+        if len(arrays) != len(self.fields):
+            raise ValueError(f"Expected {len(self.fields)} arrays, one per field.")
+        arrays = [np.asarray(array) for array in arrays]
+        start, total = 0, len(arrays[0])
+        while start < total:
+            count = min(total - start, self.chunk_rows - self.rows)
+            for column, array in zip(self.buffer, arrays):
+                column[self.rows:self.rows + count] = array[start:start + count]
+            self.rows += count
+            start += count
+            if self.rows == self.chunk_rows:
+                self._submit()
+
+    def _submit(self):
+        """Hand the current chunk to the writing thread and start a new one."""
+        wait_start = time.perf_counter()
+        self.full.put((self.buffer, self.rows))
+        self.block_time += time.perf_counter() - wait_start
+        self.buffer = self._new_buffer()
+        self.rows = 0
+
+    def flush(self):
+        """Write the transitions appended so far (as a possibly partial chunk), and wait until
+        all chunks are written."""
+        if self.rows:
+            self._submit()
+        self.full.join()
+        self.file.flush()
+        self._raise_error()
+
+    def close(self):
+        """Write the remaining transitions and the index footer, and close the log."""
+        self.flush()
+        self.full.put(None)
+        self.thread.join()
+        footer = json.dumps({"chunks": self.chunks}).encode()
+        self.file.write(footer + struct.pack("<Q", len(footer)) + FOOTER_MAGIC)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Writing a transition log chunk failed.") from error
+
+    def _write(self):
+        while True:
+            request = self.full.get()
+            if request is None:
+                self.full.task_done()
+                return
+            buffer, rows = request
+            start = time.perf_counter()
+            try:
+                offset = self.file.tell()
+                offsets, chunk_size = _chunk_layout(self.fields, rows)
+                header = CHUNK_MAGIC + struct.pack("<Q", rows)
+                self.file.write(header + bytes(ALIGNMENT - len(header)))
+                for field_offset, column in zip(offsets, buffer):
+                    self.file.write(bytes(offset + field_offset - self.file.tell()))
+                    self.file.write(memoryview(np.ascontiguousarray(column[:rows])).cast("B"))
+                self.file.write(bytes(offset + chunk_size - self.file.tell()))
+                self.chunks.append((offset, rows))
+            except Exception as error:
+                self.error = error
+            self.write_time += time.perf_counter() - start
+            self.free.put(buffer)
+            self.full.task_done()
+
+
+class TransitionLog:
+    """Read a transition log through a memory map, with zero-copy views of its chunks."""
+
+    def __init__(self, path):
+        """Open a log written by TransitionLogWriter (possibly still being written,
+        in which case only its complete chunks are read).
+
+        Params
+        ======
+            path (str): the log file
+        """
+        self.path = path
+        with open(path, "rb") as file:
+            schema, data_start = _read_header(file)
+            self.num_players = schema["num_players"]
+            self.fields = schema["fields"]
+            index, _ = _read_index(file, self.fields, data_start)
+        self.field_names = [name for name, _, _ in self.fields]
+        self.mmap = np.memmap(path, dtype=np.uint8, mode="r") if index else None
+        # Views of the fields of each chunk
+        self.chunks = []
+        for offset, rows in index:
+            offsets, _ = _chunk_layout(self.fields, rows)
+            self.chunks.append(tuple(
+                np.ndarray((rows,) + shape, dtype=dtype, buffer=self.mmap, offset=offset + field_offset)
+                for (_, dtype, shape), field_offset in zip(self.fields, offsets)))
+        self.chunk_offsets = [offset for offset, _ in index]
+        self.chunk_rows = np.array([rows for _, rows in index], dtype=np.int64)
+        # Index of the first transition of each chunk, and of the end of the log
+        self.chunk_starts = np.concatenate([[0], np.cumsum(self.chunk_rows)])
+
+    def __len__(self):
+        return int(self.chunk_starts[-1])
+
+    def chunk(self, i):
+        """Read-only views of the fields of chunk i, in the order of fields."""
+        return self.chunks[i]
+
+    def slices(self, start, stop):
+        """Yield read-only views of the fields of the transitions start to stop,
+        one tuple of views per chunk they span."""
+        stop = min(stop, len(self))
+        first = int(np.searchsorted(self.chunk_starts, start, side="right")) - 1
+        while start < stop:
+            chunk_start = self.chunk_starts[first]
+            end = min(stop, self.chunk_starts[first + 1])
+            yield tuple(column[start - chunk_start:end - chunk_start] for column in self.chunks[first])
+            start, first = end, first + 1
+
+    def read(self, start, stop):
+        """Return the fields of the transitions start to stop: views if they are in one
+        chunk, or else copies joining the chunks they span."""
+        parts = list(self.slices(start, stop))
+        if len(parts) == 1:
+            return parts[0]
+        if not parts:
+            return tuple(np.empty((0,) + shape, dtype=dtype) for _, dtype, shape in self.fields)
+        return tuple(np.concatenate(columns) for columns in zip(*parts))
+
+    def close(self):
+        """Drop the log's views, so that the file is unmapped once views taken from it are gone."""
+        self.chunks = []
+        self.mmap = None
+
+
+def main():
+    # Log self-play games from a vector env, then read them back and compare
+    import tempfile
+    from vector_env import VectorEnv, TransitionTracker
+    num_players = 3
+    env = VectorEnv(64, num_players, seed=0)
+    tracker = TransitionTracker(env)
+    observations, masks = env.reset()
+    tracker.start()
+    rng = np.random.default_rng(0)
+    logged = []
+    path = os.path.join(tempfile.mkdtemp(), "transitions.log")
+    writer = TransitionLogWriter(path, num_players, chunk_rows=1000)
+    start = time.perf_counter()
+    generate_time = 0.
+    for step in range(400):
+        generate_start = time.perf_counter()
+        actions = np.argmax(masks * rng.random(masks.shape), axis=1)
+        observations, rewards, dones, masks = env.step(actions)
+        transitions = tracker.record()
+        generate_time += time.perf_counter() - generate_start
+        writer.append(*transitions)
+        logged.append(transitions)
+        if step == 200:
+            # Reopen to append, as a new run would
+            writer.close()
+            writer = TransitionLogWriter(path, num_players, chunk_rows=1000)
+    writer.close()
+    elapsed = time.perf_counter() - start
+    logged = [np.concatenate(arrays) for arrays in zip(*logged)]
+    size = os.path.getsize(path)
+    print(f"Logged {len(logged[0])} transitions ({size / 2**20:.0f} MiB) in {elapsed:.2f}s, "
+          f"{elapsed - generate_time:.2f}s of it logging "
+          f"(append blocked {writer.block_time:.2f}s, background writes {writer.write_time:.2f}s)")
+
+    log = TransitionLog(path)
+    assert len(log) == len(logged[0])
+    for expected, actual in zip(logged, log.read(0, len(log))):
+        assert np.array_equal(expected, actual)
+    views = log.read(1000, 1500)
+    assert all(isinstance(view.base, np.memmap) or isinstance(view.base.base, np.memmap) for view in views)
+    assert all(np.array_equal(view, expected[1000:1500]) for view, expected in zip(views, logged))
+    assert sum(len(part[0]) for part in log.slices(900, 2100)) == 1200
+
+    # A log without its footer, as left by a writer that died, keeps its complete chunks
+    kept = int(log.chunk_starts[3])
+    with open(path, "r+b") as file:
+        file.truncate(log.chunk_offsets[3] + 100)
+    log.close()
+    recovered = TransitionLog(path)
+    assert len(recovered) == kept
+    for expected, actual in zip(logged, recovered.read(0, kept)):
+        assert np.array_equal(expected[:kept], actual)
+    recovered.close()
+    print(f"Recovered {kept} transitions from a log without its footer.")
@@ -0,0 +1,377 @@
+from multiprocessing import shared_memory
+import numpy as np
+from game import GameState
+from batched_game import BatchedGameState
+from featurize import featurizeGameStateBatch, rotatePlayers, stateFeatureLen, NUM_ACTIONS
+from actions import legalActionMaskBatch, takeActionBatch
+from scoring import batchScores
+from trajectory import NUM_ROUNDS
+from launcher import worker_context, GAME_MODULES
+
+
+class EnvBuffers:
+    """Arrays a vector env writes its outputs to (and reads its actions from), one row per game.
+
+    With shared=True they live in one shared memory block, so that subprocess workers
+    write the observations of their games in place instead of pickling them.
+    """
+
+    def __init__(self, num_games, num_players, shared=False, name=None):
+        """Create EnvBuffers, or attach to existing shared ones by name.
+
+        Params
+        ======
+            num_games (int): number of games
+            num_players (int): number of players in each game
+            shared (bool): whether to allocate the arrays in shared memory
+            name (str): name of the shared memory block to attach to, or None to create one
+        """
+        self.num_games = num_games
+        self.num_players = num_players
+        state_size = stateFeatureLen(num_players)
+        fields = [
+            ("observations", np.float32, (num_games, state_size)), # featurized for the player to move
+            ("masks", np.bool_, (num_games, NUM_ACTIONS)), # legal actions of the player to move
+            ("players", np.int32, (num_games,)), # index in playerNames of the player to move
+            ("actions", np.int64, (num_games,)),
+            ("rewards", np.float32, (num_games,)), # score change of the player who took the action
+            ("dones", np.bool_, (num_games,)), # whether the action ended the game
+            ("seeds", np.int64, (num_games,)), # GameState seed of the current game
+            # Final state of each game ended by the last step, featurized as
+            # if it were the turn of each player (indexed like playerNames)
+            ("final_observations", np.float32, (num_games, num_players, state_size)),
+        ]
+        self.shm = None
+        if shared or name is not None:
+            size = sum(np.dtype(dtype).itemsize * int(np.prod(shape)) for _, dtype, shape in fields)
+            self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+        offset = 0
+        for field, dtype, shape in fields:
+            if self.shm is None:
+                array = np.zeros(shape, dtype=dtype)
+            else:
+                array = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset)
+                offset += array.nbytes
+            setattr(self, field, array)
+
+    def __reduce__(self):
+        # Child processes attach to the same shared memory block
+        return (EnvBuffers, (self.num_games, self.num_players, True, self.shm.name))
+
+    def close(self):
+        if self.shm is not None:
+            self.shm.close()
+
+    def unlink(self):
+        if self.shm is not None:
+            self.shm.unlink()
+
+
+class VectorEnv:
+    """Step many self-play games at once, in lockstep in a BatchedGameState.
+
+    Each step takes one action for the player to move in every game, and returns
+    the featurized states of the players to move next, the score change (see
+    Player.score) of the players who acted, which games ended and the legal action
+    masks. Finished games are replaced by new ones straight away, so the observation
+    of a finished game is the first state of its next game, and its final state is
+    in final_observations. See TransitionTracker to pair steps into DQN transitions.
+    """
+
+    def __init__(self, num_games, num_players=3, num_rounds=NUM_ROUNDS, seed=None, buffers=None, offset=0):
+        """Initialize a VectorEnv object.
+
+        Params
+        ======
+            num_games (int): number of games played at once
+            num_players (int): number of players in each game
+            num_rounds (int): number of rounds in each game
+            seed (int): random seed drawing the GameState seed of each new game
+            buffers (EnvBuffers): arrays to write to (e.g. in shared memory), or None to allocate them
+            offset (int): row of buffers holding the first game
+        """
+        self.num_games = num_games
+        self.num_players = num_players
+        self.num_rounds = num_rounds
+        self.rng = np.random.default_rng(seed)
+        if buffers is None:
+            buffers = EnvBuffers(num_games, num_players)
+        rows = slice(offset, offset + num_games)
+        for field in ("observations", "masks", "players", "actions", "rewards", "dones", "seeds",
+                      "final_observations"):
+            setattr(self, field, getattr(buffers, field)[rows])
+        self.batch = None
+        self.scores = np.zeros((num_games, num_players))
+        self.games = np.arange(num_games)
+
+    def _new_games(self, games):
+        """Start new games in place of the given ones."""
+        self.seeds[games] = self.rng.integers(0, 2**32, size=len(games))
+        game_states = [GameState(self.num_players, self.num_rounds, seed=int(seed)) for seed in self.seeds[games]]
+        if self.batch is None:
+            self.batch = BatchedGameState.fromGameStates(game_states)
+        else:
+            self.batch.setGames(games, game_states)
+        self.scores[games] = batchScores(self.batch, games)
+
+    def _observe(self):
+        """Write the observations, legal action masks and players to move of all games."""
+        featurizeGameStateBatch(self.batch, self.observations)
+        legalActionMaskBatch(self.batch, out=self.masks)
+        self.players[:] = self.batch.currentPlayers()
+
+    def reset(self):
+        """Start new games in all slots. Returns the (reused) observations and legal action masks."""
+        self.batch = None
+        self._new_games(self.games)
+        self.dones[:] = False
+        self._observe()
+        return self.observations, self.masks
+
+    def step(self, actions=None):
+        """Take one action in every game (legal for its player to move), and reset the finished games.
+
+        Returns the (reused) observations, rewards, dones and legal action masks. If actions
+        is None, they are read from the actions array (as written by SubprocVectorEnv).
+        """
+        if actions is not None:
+            self.actions[:] = actions
+        movers = self.batch.currentPlayers().copy()
+        takeActionBatch(self.batch, self.games, self.actions)
+
+        scores = batchScores(self.batch)
+        self.rewards[:] = scores[self.games, movers] - self.scores[self.games, movers]
+        self.scores = scores
+
+        self.dones[:] = self.batch.isOver()
+        finished = np.flatnonzero(self.dones)
+        if len(finished):
+            final = np.empty((len(finished), self.observations.shape[1]), dtype=np.float32)
+            featurizeGameStateBatch(self.batch, final, finished)
+            for player in range(self.num_players):
+                positions = np.argmax(self.batch.turnOrder[finished] == player, axis=1)
+                self.final_observations[finished, player] = rotatePlayers(final, self.num_players, positions)
+            self._new_games(finished)
+        self._observe()
+        return self.observations, self.rewards, self.dones, self.masks
+
+    def close(self):
+        pass
+
+
+def run_worker(connection, buffers, offset, num_games, num_players, num_rounds, seed):
+    """Worker process of a SubprocVectorEnv: step a VectorEnv over its rows of the shared buffers."""
+    env = VectorEnv(num_games, num_players, num_rounds, seed, buffers, offset)
+    while True:
+        command = connection.recv()
+        if command == "reset":
+            env.reset()
+        elif command == "step":
+            env.step()
+        else:
+            break
+        connection.send(True)
+    buffers.close()
+
+
+class SubprocVectorEnv:
+    """VectorEnv whose games are split across worker processes, which write
+    their outputs into shared memory. Has the same interface as VectorEnv."""
+
+    def __init__(self, num_games, num_workers, num_players=3, num_rounds=NUM_ROUNDS, seed=None, start_method=None):
+        """Initialize a SubprocVectorEnv object and start its workers.
+
+        Params
+        ======
+            num_games (int): number of games played at once
+            num_workers (int): number of worker processes, each stepping a contiguous part of the games
+            num_players (int): number of players in each game
+            num_rounds (int): number of rounds in each game
+            seed (int): random seed, from which each worker gets its own
+            start_method (str): multiprocessing start method (see launcher.worker_context), or None for the default
+        """
+        self.num_games = num_games
+        self.num_players = num_players
+        self.buffers = EnvBuffers(num_games, num_players, shared=True)
+        for field in ("observations", "masks", "players", "actions", "rewards", "dones", "seeds",
+                      "final_observations"):
+            setattr(self, field, getattr(self.buffers, field))
+
+        context = worker_context(start_method, GAME_MODULES + ("vector_env",))
+        bounds = np.linspace(0, num_games, num_workers + 1).astype(int)
+        seeds = np.random.SeedSequence(seed).spawn(num_workers)
+        self.connections, self.processes = [], []
+        for start, end, worker_seed in zip(bounds[:-1], bounds[1:], seeds):
+            connection, child = context.Pipe()
+            process = context.Process(
+                target=run_worker, daemon=True,
+                args=(child, self.buffers, start, end - start, num_players, num_rounds, worker_seed))
+            process.start()
+            self.connections.append(connection)
+            self.processes.append(process)
+        self.waiting = False
+
+    def _send(self, command):
+        for connection in self.connections:
+            connection.send(command)
+        self.waiting = True
+
+    def _wait(self):
+        for connection in self.connections:
+            connection.recv()
+        self.waiting = False
+
+    def reset(self):
+        """Start new games in all slots. Returns the (shared) observations and legal action masks."""
+        self._send("reset")
+        self._wait()
+        return self.observations, self.masks
+
+    def step_async(self, actions):
+        """Start taking one action in every game, e.g. to overlap stepping with other work."""
+        self.actions[:] = actions
+        self._send("step")
+
+    def step_wait(self):
+        """Wait for the step started by step_async. Returns the same as VectorEnv.step."""
+        self._wait()
+        return self.observations, self.rewards, self.dones, self.masks
+
+    def step(self, actions):
+        """Take one action in every game, as in VectorEnv.step."""
+        self.step_async(actions)
+        return self.step_wait()
+
+    def close(self):
+        """Stop the workers and free the shared memory."""
+        if self.waiting:
+            self._wait()
+        for connection in self.connections:
+            connection.send("close")
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        self.buffers.close()
+        self.buffers.unlink()
+
+
+class TransitionTracker:
+    """Pair the steps of a vector env into DQN transitions, as in actor_pool.play_game: each goes
+    from a decision of a player to their next one (or to the end of the game, as if it were their
+    turn), with the change in their score as reward."""
+
+    def __init__(self, env):
+        """Initialize a TransitionTracker object.
+
+        Params
+        ======
+            env (VectorEnv or SubprocVectorEnv): the env, to call start on after each reset
+        """
+        self.env = env
+        num_games, num_players = env.num_games, env.num_players
+        state_size = stateFeatureLen(num_players)
+        self.games = np.arange(num_games)
+        # Last decision of each player of each game (indexed like playerNames) not yet paired
+        self.pending = np.zeros((num_games, num_players), dtype=bool)
+        self.pending_states = np.zeros((num_games, num_players, state_size), dtype=np.float32)
+        self.pending_actions = np.zeros((num_games, num_players), dtype=np.int64)
+        self.pending_rewards = np.zeros((num_games, num_players), dtype=np.float32)
+        self.states = np.zeros((num_games, state_size), dtype=np.float32)
+        self.players = np.zeros(num_games, dtype=np.int32)
+        self.no_masks = np.zeros((0, NUM_ACTIONS), dtype=bool)
+
+    def start(self):
+        """Forget all pending decisions, after resetting the env."""
+        self.pending[:] = False
+        self.states[:] = self.env.observations
+        self.players[:] = self.env.players
+
+    def record(self):
+        """Record the env's last step. Returns the transitions it completed as states, actions,
+        rewards, next_states, dones and next_masks arrays, e.g. for ReplayBuffer.add_batch."""
+        env = self.env
+        self.pending[self.games, self.players] = True
+        self.pending_states[self.games, self.players] = self.states
+        self.pending_actions[self.games, self.players] = env.actions
+        self.pending_rewards[self.games, self.players] = env.rewards
+
+        # Games going on, where the player to move has a pending decision
+        going_on = np.flatnonzero(~env.dones & self.pending[self.games, env.players])
+        next_players = env.players[going_on]
+        # Every pending decision of finished games
+        finished, final_players = np.nonzero(self.pending & env.dones[:, None])
+
+        games = np.concatenate([going_on, finished])
+        players = np.concatenate([next_players, final_players])
+        transitions = (self.pending_states[games, players], self.pending_actions[games, players],
+                       self.pending_rewards[games, players],
+                       np.concatenate([env.observations[going_on], env.final_observations[finished, final_players]]),
+                       np.concatenate([np.zeros(len(going_on)), np.ones(len(finished))]).astype(np.float32),
+                       np.concatenate([env.masks[going_on], np.zeros((len(finished), NUM_ACTIONS), dtype=bool)]))
+        self.pending[games, players] = False
+
+        self.states[:] = env.observations
+        self.players[:] = env.players
+        return transitions
+
+
+def main():
+    # Play random games in a VectorEnv, and check its rewards and transitions against GameState
+    import time
+    from actions import takeAction
+    from trajectory import Trajectory, replay_transitions
+    num_games = 64
+    rng = np.random.default_rng(0)
+    env = VectorEnv(num_games, seed=0)
+    tracker = TransitionTracker(env)
+    observations, masks = env.reset()
+    tracker.start()
+    seeds, actions_taken, rewards_given = env.seeds.copy(), [[] for _ in range(num_games)], [[] for _ in range(num_games)]
+    finished, transitions = [], []
+    while len(finished) < 100:
+        actions = np.array([rng.choice(np.flatnonzero(mask)) for mask in masks])
+        observations, rewards, dones, masks = env.step(actions)
+        transitions.append(tracker.record())
+        for g in range(num_games):
+            actions_taken[g].append(actions[g])
+            rewards_given[g].append(rewards[g])
+            if dones[g]:
+                finished.append(Trajectory(int(seeds[g]), 3, NUM_ROUNDS, np.array(actions_taken[g], dtype=np.uint8),
+                                           np.array(rewards_given[g], dtype=np.float32)))
+                seeds[g], actions_taken[g], rewards_given[g] = env.seeds[g], [], []
+
+    for trajectory in finished:
+        game = GameState(3, NUM_ROUNDS, seed=trajectory.seed)
+        for action, reward in zip(trajectory.actions, trajectory.rewards):
+            player = game.players[0]
+            score = player.score()
+            takeAction(game, int(action))
+            assert np.float32(player.score() - score) == reward
+        assert game.isOver()
+
+    # The tracked transitions of the finished games are exactly those of their trajectories
+    tracked = [np.concatenate(arrays) for arrays in zip(*transitions)]
+    expected = [np.concatenate(arrays) for arrays in zip(*[replay_transitions(finished[i:i + 32])
+                                                           for i in range(0, len(finished), 32)])]
+    def keys(arrays):
+        return [(state.tobytes(), int(action), next_state.tobytes(), float(reward), float(done), mask.tobytes())
+                for state, action, reward, next_state, done, mask in zip(*arrays)]
+    tracked_keys = set(keys(tracked))
+    assert all(key in tracked_keys for key in keys(expected))
+    assert tracked[4].sum() == 3 * len(finished)
+    print(f"VectorEnv matches GameState on {len(finished)} games ({len(expected[0])} transitions).")
+
+    # Compare the speed of both backends
+    for name, make_env in [("VectorEnv", lambda: VectorEnv(256, seed=0)),
+                           ("SubprocVectorEnv (2 workers)", lambda: SubprocVectorEnv(256, 2, seed=0))]:
+        env = make_env()
+        observations, masks = env.reset()
+        start = time.perf_counter()
+        for _ in range(50):
+            # Random legal actions
+            actions = np.argmax(masks * rng.random(masks.shape), axis=1)
+            observations, rewards, dones, masks = env.step(actions)
+        elapsed = time.perf_counter() - start
+        env.close()
+        print(f"{name}: {50 * env.num_games / elapsed:.0f} steps/s")
@@ -0,0 +1,212 @@
+import numpy as np
+from game_info import RESOURCES, QUESTS, DEFAULT_BUILDINGS, LORD_CARDS, RESOURCE_INDEX, QUEST_INDEX, BUILDING_INDEX
+from game import GameState
+from batched_game import NUM_AVAILABLE_QUESTS
+from player import PLAYER_RESOURCES
+from observer import GameObserver
+
+# Zobrist hashing: each (feature, value) pair of a game state gets a random
+# 64-bit key, and the hash of a state is the XOR of the keys of its pairs,
+# so that a mutation only XORs out the old keys and XORs in the new ones.
+# The order of the quest stack is hidden from the players and is not hashed
+# (which quests it holds follows from the rest of the state), nor is the
+# order of completed quests, which does not change how the game continues.
+
+MAX_PLAYERS = 5
+# Counts (of rounds, resources, agents) with precomputed keys
+MAX_COUNT = 128
+
+_rng = np.random.default_rng(0x5EED)
+def _keys(*shape):
+    return _rng.integers(0, 2**64, size=shape, dtype=np.uint64).tolist()
+
+ROUND_KEYS = _keys(MAX_COUNT)
+COMPLETING_QUEST_KEY = _keys(1)[0]
+TURN_ORDER_KEYS = _keys(MAX_PLAYERS, MAX_PLAYERS) # position, seat
+LORD_CARD_KEYS = _keys(MAX_PLAYERS, len(LORD_CARDS)) # seat, lord card
+BUILDING_KEYS = _keys(len(DEFAULT_BUILDINGS), MAX_PLAYERS) # building, seat
+AVAILABLE_QUEST_KEYS = _keys(NUM_AVAILABLE_QUESTS, len(QUESTS)) # slot, quest
+RESOURCE_KEYS = _keys(MAX_PLAYERS, len(RESOURCES), MAX_COUNT) # seat, resource, count
+AGENT_KEYS = _keys(MAX_PLAYERS, MAX_COUNT) # seat, agents
+ACTIVE_QUEST_KEYS = _keys(MAX_PLAYERS, len(QUESTS), len(QUESTS)) # seat, slot, quest
+COMPLETED_QUEST_KEYS = _keys(MAX_PLAYERS, len(QUESTS)) # seat, quest
+
+MASK64 = 2**64 - 1
+
+def countKey(keys: list[int], count: int) -> int:
+    '''
+    Return the key of a count, from a list of keys for the counts
+    below MAX_COUNT, or mixed from the first of them otherwise.
+    '''
+    if 0 <= count < MAX_COUNT:
+        return keys[count]
+    # splitmix64 finalizer
+    x = (keys[0] ^ count) & MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK64
+    return x ^ (x >> 31)
+
+def _playerHash(player, seat: int) -> int:
+    '''Hash of a player's resources, agents and quests.'''
+    value = countKey(AGENT_KEYS[seat], player.agents)
+    for resource in PLAYER_RESOURCES:
+        value ^= countKey(RESOURCE_KEYS[seat][RESOURCE_INDEX[resource]], player.resources[resource])
+    for slot, questId in enumerate(player.activeQuestIds):
+        value ^= ACTIVE_QUEST_KEYS[seat][slot][questId]
+    for questId in player.completedQuestIds:
+        value ^= COMPLETED_QUEST_KEYS[seat][questId]
+    return value
+
+def _turnOrderHash(gameState: GameState) -> int:
+    '''Hash of the turn order.'''
+    value = 0
+    for position, player in enumerate(gameState.players):
+        value ^= TURN_ORDER_KEYS[position][gameState.playerNames.index(player.name)]
+    return value
+
+def _availableQuestsHash(questIds) -> int:
+    '''Hash of the quests available at Cliffwatch Inn.'''
+    value = 0
+    for slot, questId in enumerate(questIds):
+        value ^= AVAILABLE_QUEST_KEYS[slot][questId]
+    return value
+
+def zobristHash(gameState: GameState) -> int:
+    '''Compute the 64-bit Zobrist hash of a game state from scratch.'''
+    value = countKey(ROUND_KEYS, gameState.roundsLeft) ^ _turnOrderHash(gameState)
+    if gameState.completingQuest:
+        value ^= COMPLETING_QUEST_KEY
+    boardState = gameState.boardState
+    for b, occupant in enumerate(boardState.occupancy):
+        if occupant >= 0:
+            value ^= BUILDING_KEYS[b][occupant]
+    value ^= _availableQuestsHash(boardState.availableQuestIds)
+    for player in gameState.players:
+        seat = gameState.playerNames.index(player.name)
+        value ^= LORD_CARD_KEYS[seat][LORD_CARDS.index(player.lordCard)] ^ _playerHash(player, seat)
+    return value
+
+
+class ZobristHash(GameObserver):
+    '''
+    The Zobrist hash of a GameState (as given by zobristHash), kept
+    up to date by XORing the keys that each mutation of the game,
+    board or players changes.
+    '''
+    def __init__(self, gameState: GameState, value: int = None, check: bool = False):
+        '''
+        Hash the game state once and start following its mutations.
+
+        Args:
+            gameState: the game state to hash.
+            value (optional): the hash of the game state if it is already
+                known, e.g. from the game it was cloned from.
+            check: whether to compare the hash against zobristHash
+                every time it is read (slow).
+        '''
+        self.gameState = gameState
+        self.check = check
+        self._seats = {name: seat for seat, name in enumerate(gameState.playerNames)}
+        if value is None:
+            value = zobristHash(gameState)
+        # GameState.completingQuest is set without notifying
+        # observers, so its key is only XORed in when reading
+        self._value = value ^ (COMPLETING_QUEST_KEY if gameState.completingQuest else 0)
+        gameState.observers += (self,)
+        gameState.boardState.observers += (self,)
+        for player in gameState.players:
+            player.observers += (self,)
+
+    def detach(self):
+        '''Stop following the game state.'''
+        for observed in [self.gameState, self.gameState.boardState, *self.gameState.players]:
+            observed.observers = tuple(observer for observer in observed.observers
+                                       if observer is not self)
+
+    @property
+    def value(self) -> int:
+        '''The current hash of the game state.'''
+        if self.check:
+            self.verify()
+        if self.gameState.completingQuest:
+            return self._value ^ COMPLETING_QUEST_KEY
+        return self._value
+
+    def verify(self):
+        '''Check the hash against zobristHash.'''
+        expected = zobristHash(self.gameState) ^ (COMPLETING_QUEST_KEY if self.gameState.completingQuest else 0)
+        if self._value != expected:
+            raise AssertionError("Zobrist hash differs from zobristHash.")
+
+    def resourceChanged(self, player, resource, oldNumber):
+        keys = RESOURCE_KEYS[self._seats[player.name]][RESOURCE_INDEX[resource]]
+        self._value ^= countKey(keys, oldNumber) ^ countKey(keys, player.resources[resource])
+
+    def agentsChanged(self, player, oldAgents):
+        keys = AGENT_KEYS[self._seats[player.name]]
+        self._value ^= countKey(keys, oldAgents) ^ countKey(keys, player.agents)
+
+    def questGained(self, player, quest):
+        slot = len(player.activeQuestIds) - 1
+        self._value ^= ACTIVE_QUEST_KEYS[self._seats[player.name]][slot][QUEST_INDEX[quest.name]]
+
+    def questCompleted(self, player, quest, slot):
+        seat = self._seats[player.name]
+        questKeys = ACTIVE_QUEST_KEYS[seat]
+        questId = QUEST_INDEX[quest.name]
+        value = questKeys[slot][questId] ^ COMPLETED_QUEST_KEYS[seat][questId]
+        # Later active quests shift down one slot
+        for laterSlot in range(slot, len(player.activeQuestIds)):
+            laterId = player.activeQuestIds[laterSlot]
+            value ^= questKeys[laterSlot + 1][laterId] ^ questKeys[laterSlot][laterId]
+        self._value ^= value
+
+    def buildingChanged(self, boardState, building, oldState):
+        buildingKeys = BUILDING_KEYS[BUILDING_INDEX[building]]
+        if oldState is not None:
+            self._value ^= buildingKeys[self._seats[oldState]]
+        occupant = boardState.occupancy[BUILDING_INDEX[building]]
+        if occupant >= 0:
+            self._value ^= buildingKeys[occupant]
+
+    def availableQuestsChanged(self, boardState, oldQuests):
+        self._value ^= (_availableQuestsHash([QUEST_INDEX[quest.name] for quest in oldQuests])
+                        ^ _availableQuestsHash(boardState.availableQuestIds))
+
+    def roundsLeftChanged(self, gameState, oldRoundsLeft):
+        self._value ^= countKey(ROUND_KEYS, oldRoundsLeft) ^ countKey(ROUND_KEYS, gameState.roundsLeft)
+
+    def turnOrderChanged(self, gameState, oldPlayers):
+        oldOrder = 0
+        for position, player in enumerate(oldPlayers):
+            oldOrder ^= TURN_ORDER_KEYS[position][self._seats[player.name]]
+        self._value ^= oldOrder ^ _turnOrderHash(gameState)
+
+    def stateRestored(self, gameState):
+        self._value = zobristHash(gameState) ^ (COMPLETING_QUEST_KEY if gameState.completingQuest else 0)
+
+
+def main():
+    # Follow random games, checking the hash after every move and after undoing it
+    from random import choice
+    from timeit import timeit
+    from actions import legalActions, takeAction
+    hashes = set()
+    for _ in range(50):
+        gameState = GameState()
+        hasher = ZobristHash(gameState, check=True)
+        while not gameState.isOver():
+            hashes.add(hasher.value)
+            snapshot = gameState.snapshot()
+            move = choice(legalActions(gameState))
+            takeAction(gameState, move)
+            after = hasher.value
+            gameState.restore(snapshot)
+            hasher.value
+            takeAction(gameState, move)
+            assert hasher.value == after
+    print(f"Zobrist hash matches zobristHash on 50 games ({len(hashes)} distinct hashes).")
+
+    hasher.check = False
+    print(f"zobristHash: {timeit(lambda: zobristHash(gameState), number=2000) / 2000 * 1e6:.1f}us, "
+          f"ZobristHash.value: {timeit(lambda: hasher.value, number=2000) / 2000 * 1e6:.2f}us")